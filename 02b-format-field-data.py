@@ -0,0 +1,242 @@
+def main():
+    
+    import argparse
+    import fieldio
+    import fieldprofile
+    
+    parser = argparse.ArgumentParser(description='''\
+    This script formats the underway and discrete data extracted from the database, as in 02-field-formatting.ipynb: unnecessary and all-NaN columns are dropped, underway columns renamed, bb standard error columns inserted, and both tables sorted by time.
+    The data is read from csv (or parquet/feather) exports, or straight from the database tables. With --chunksize, the tables are read and sorted in chunks, so an archive larger than memory can be formatted.''')
+    
+    parser.add_argument('--uwfile', nargs=1, type=str, required=False, default=[None], help='''\
+    File path to the underway data exported from the database (e.g. 01a-underway-gnats.csv). Alternatively, give --database and --uwTable.''')
+    
+    parser.add_argument('--discretefile', nargs=1, type=str, required=False, default=[None], help='''\
+    File path to the discrete data exported from the database (e.g. 02a-discrete-gnats.csv). Alternatively, give --database and --discreteTable.''')
+    
+    parser.add_argument('--database', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Database to read the underway and discrete tables from: the path of a SQLite file, or a SQLAlchemy URL (requires sqlalchemy).''')
+    
+    parser.add_argument('--uwTable', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Name of the underway table (or view) in --database.''')
+    
+    parser.add_argument('--discreteTable', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Name of the discrete table (or view) in --database.''')
+    
+    parser.add_argument('--ofileUnderway', nargs=1, type=str, required=False, default=[None], help='''\
+    File path to save the formatted underway data to (e.g. 01b-underway-formatted-gnats.csv), or a directory path ending in / for a dataset partitioned by cruise. Required if an underway source is given.''')
+    
+    parser.add_argument('--ofileDiscrete', nargs=1, type=str, required=False, default=[None], help='''\
+    File path to save the formatted discrete data to (e.g. 02b-discrete-formatted-gnats.csv), or a directory path ending in / for a dataset partitioned by cruise. Required if a discrete source is given.''')
+    
+    parser.add_argument('--uwTimeColumn', nargs=1, type=str, required=False, default=['UWTime'], help='''\
+    Optional. Underway datetime column, which the underway data is sorted by. Defaults to UWTime.''')
+    
+    parser.add_argument('--discreteTimeColumn', nargs=1, type=str, required=False, default=['StationTime'], help='''\
+    Optional. Discrete datetime column, which the discrete data is sorted by. Defaults to StationTime.''')
+    
+    parser.add_argument('--uwDropColumns', nargs='*', type=str, required=False, default=UW_DROP_COLUMNS, help='''\
+    Optional. Underway columns to drop. They are not read at all. Defaults to: {}.'''.format(' '.join(UW_DROP_COLUMNS)))
+    
+    parser.add_argument('--discreteDropColumns', nargs='*', type=str, required=False, default=D_DROP_COLUMNS, help='''\
+    Optional. Discrete columns to drop. They are not read at all. Defaults to: {}.'''.format(' '.join(D_DROP_COLUMNS)))
+    
+    parser.add_argument('--cruiseNameColumn', nargs=1, type=str, required=False, default=['CruiseName'], help='''\
+    Optional. Cruise name column of both tables, which datasets are partitioned by and --cruises selects from. Defaults to CruiseName.''')
+    
+    parser.add_argument('--cruises', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only format these cruises, given as cruise names or shell-style patterns (e.g. AMT2* s01??). Only their rows are read (from a database, only their rows are queried) and only their partitions of the output datasets are replaced. The outputs must be datasets.''')
+    
+    parser.add_argument('--naValues', nargs='*', type=float, required=False, default=[-999], help='''\
+    Optional. Fill values to read as missing. Defaults to -999.''')
+    
+    parser.add_argument('--fileFormat', nargs=1, type=str, required=False, default=[None], choices=['csv', 'parquet', 'feather'], help='''\
+    Optional. Format of the input and output files. If not given, the format is inferred from each file extension.''')
+    
+    parser.add_argument('--chunksize', nargs=1, type=int, required=False, default=[None], help='''\
+    Optional. Streaming mode for tables larger than memory: read this many rows at a time, track all-NaN columns and sort each chunk as it is read, spill the chunks to disk, and merge them in time order into the output file.''')
+    
+    parser.add_argument('--spillDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory for the temporary files of the streaming mode. Defaults to the system temporary directory.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each step, with suggested PBS ncpus/mem values.''')
+    
+    
+    args = parser.parse_args()
+    dict_args = vars(args)
+    
+    ### Define Dictionary Variables: ########################################
+    
+    uw_fp = dict_args['uwfile'][0]
+    d_fp = dict_args['discretefile'][0]
+    database = dict_args['database'][0]
+    uw_table = dict_args['uwTable'][0]
+    d_table = dict_args['discreteTable'][0]
+    ofile_uw = dict_args['ofileUnderway'][0]
+    ofile_d = dict_args['ofileDiscrete'][0]
+    uw_time = dict_args['uwTimeColumn'][0]
+    d_time = dict_args['discreteTimeColumn'][0]
+    uw_drop_cols = dict_args['uwDropColumns']
+    d_drop_cols = dict_args['discreteDropColumns']
+    na_values = dict_args['naValues']
+    file_format = dict_args['fileFormat'][0]
+    chunksize = dict_args['chunksize'][0]
+    spill_dir = dict_args['spillDir'][0]
+    time_format = dict_args['timeFormat'][0]
+    profile_fp = dict_args['profile'][0]
+    cruisename = dict_args['cruiseNameColumn'][0]
+    cruises = dict_args['cruises']
+    
+    if (uw_table is not None or d_table is not None) and database is None:
+        parser.error('--uwTable and --discreteTable need --database.')
+    if uw_fp is not None and uw_table is not None:
+        parser.error('Give either --uwfile or --uwTable, not both.')
+    if d_fp is not None and d_table is not None:
+        parser.error('Give either --discretefile or --discreteTable, not both.')
+    if uw_fp is None and uw_table is None and d_fp is None and d_table is None:
+        parser.error('Give an underway source (--uwfile or --uwTable), a discrete source (--discretefile or --discreteTable), or both.')
+    if (uw_fp is not None or uw_table is not None) and ofile_uw is None:
+        parser.error('--ofileUnderway is required to format the underway data.')
+    if (d_fp is not None or d_table is not None) and ofile_d is None:
+        parser.error('--ofileDiscrete is required to format the discrete data.')
+    if cruises is not None and not all(fieldio.isDataset(fp) for fp in [ofile_uw, ofile_d] if fp is not None):
+        parser.error('--cruises needs dataset outputs (directory paths ending in /), so that the other cruises are kept.')
+    
+    con = fieldio.openDatabase(database) if database is not None else None
+    profiler = fieldprofile.openProfiler(profile_fp, '02b-format-field-data')
+    
+    ### UW Formatting: ###
+    # Drop unnecessary columns and NaN columns, rename columns, calculate and insert bb standard error columns, sort by datetime.
+    
+    if uw_fp is not None or uw_table is not None:
+        source = tableSource(uw_fp, con, uw_table, file_format)
+        with fieldprofile.step(profiler, 'format underway') as record:
+            record['rows_in'], record['rows_out'] = formatTable(source, ofile_uw, uw_time, uw_drop_cols, formatUnderway, na_values, file_format, chunksize, spill_dir, time_format, cruisename, cruises)
+    
+    ### Discrete Formatting: ###
+    # The discrete file was taken largely from the StationDataTable in the database. This table combines both Balch Lab discrete samples, and CTD data.
+    # However, for GNATS cruises, there is no CTD data. Therefore, all of the CTD related variables/columns will be null, and are dropped with the other NaN columns.
+    
+    if d_fp is not None or d_table is not None:
+        source = tableSource(d_fp, con, d_table, file_format)
+        with fieldprofile.step(profiler, 'format discrete') as record:
+            record['rows_in'], record['rows_out'] = formatTable(source, ofile_d, d_time, d_drop_cols, None, na_values, file_format, chunksize, spill_dir, time_format, cruisename, cruises)
+    
+    # SQLite connections are closed, SQLAlchemy engines disposed:
+    if con is not None:
+        if hasattr(con, 'dispose'):
+            con.dispose()
+        else:
+            con.close()
+    if profiler is not None:
+        profiler.save()
+
+#########################################################################
+
+UW_DROP_COLUMNS = ['CruiseID', 'UWStation', 'Cast']
+D_DROP_COLUMNS = ['StationNumber', 'BalchSampleNumber', 'Niskin', 'TimeFired', 'Forel-Ule']
+UW_RENAME_COLUMNS = {'Temperature':'UWTemperature', 'Salinity':'UWSalinity', 'SigmaTheta':'UWSigmaTheta'}
+BB_STD_COLUMNS = ['bbprimeStd', 'bbtot532Std', 'bbacidStd']
+
+def tableSource(fp, con, table, file_format):
+    
+    import fieldio
+    
+    # A table to format: either a file, or a table in the database. Returns (columns, read(columns, chunksize) --> iterator of chunks).
+    if fp is not None:
+        return fieldio.tableColumns(fp, file_format), lambda columns, chunksize, **kwargs: iterSource(fp, columns, chunksize, file_format, **kwargs)
+    return fieldio.sqlColumns(con, table), lambda columns, chunksize, **kwargs: fieldio.iterSql(con, table, chunksize, columns, **kwargs)
+
+def iterSource(fp, columns, chunksize, file_format, datetime_cols=None, na_values=None, schema=None, cruises=None, cruisename=None):
+    
+    import fieldio
+    
+    if chunksize is None:
+        yield fieldio.readTable(fp, columns, datetime_cols, file_format, schema, na_values, cruises, cruisename)
+    else:
+        yield from fieldio.iterTable(fp, chunksize, columns, datetime_cols, file_format, schema, na_values, cruises, cruisename)
+
+def formatTable(source, ofile, time_col, drop_cols, format_func, na_values, file_format, chunksize=None, spill_dir=None, time_format=None, cruisename=None, cruises=None):
+    
+    import os
+    import tempfile
+    import fieldio
+    import fieldschema
+    
+    # Dropped columns are pruned from the read, and columns that are NaN in every row are found as the chunks come in.
+    # Each chunk is sorted by time and spilled; the spills are then merged in time order, so the output is written sorted without holding the whole table.
+    # With cruises, only the rows of the matching cruises are read, and only their partitions of a dataset output are replaced.
+    # Returns the number of rows read and written.
+    file_cols, read = source
+    columns = [col for col in file_cols if col not in drop_cols]
+    schema = fieldschema.tableSchema(datetime_cols=[time_col], time_format=time_format)
+    
+    if chunksize is None:
+        table = next(read(columns, None, na_values=na_values, schema=schema, cruises=cruises, cruisename=cruisename))
+        nan_cols = table.columns[table.isnull().all()].tolist()
+        table = finalizeTable(table.drop(columns=nan_cols), time_col, format_func)
+        fieldio.writeTable(sortByTime(table, time_col), ofile, fmt=file_format, cruisename=cruisename, cruises=cruises)
+        return len(table), len(table)
+    
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        
+        spill_fps = []
+        chunk_dtypes = []
+        has_data = None
+        n_rows = 0
+        for chunk in read(columns, chunksize, na_values=na_values, schema=schema, cruises=cruises, cruisename=cruisename):
+            has_data = chunk.notnull().any() if has_data is None else has_data | chunk.notnull().any()
+            chunk_dtypes.append([(col, chunk[col].dtype, chunk[col].isnull().all()) for col in chunk.columns])
+            spill_fps.append(os.path.join(tmp_dir, 'chunk{:05d}.pkl'.format(len(spill_fps))))
+            # Sorted chunks are spilled in small pieces, so that merging many chunks only holds a piece of each:
+            fieldio.spillTable(sortByTime(chunk, time_col), spill_fps[-1], max(1000, chunksize//64))
+            n_rows += len(chunk)
+        
+        nan_cols = [] if has_data is None else has_data.index[~has_data].tolist()
+        dtypes = fieldio.commonDtypes(chunk_dtypes)
+        writer = fieldio.TableWriter(ofile, file_format, cruisename, cruises)
+        # Merged chunks follow each other in time order, but hold rows of several spills, so each is sorted again:
+        for chunk in fieldio.mergeSortedSpills(spill_fps, time_col, dtypes):
+            writer.write(finalizeTable(sortByTime(chunk, time_col).drop(columns=nan_cols), time_col, format_func))
+        if n_rows == 0:
+            writer.write(finalizeTable(dtypesTable(dtypes).drop(columns=nan_cols), time_col, format_func))
+        writer.close()
+    
+    return n_rows, n_rows
+
+def finalizeTable(table, time_col, format_func):
+    
+    if format_func is not None:
+        table = format_func(table)
+    return table.reset_index(drop=True)
+
+def sortByTime(table, time_col):
+    
+    # Rows with equal times keep their order in the database export; rows without a time go last.
+    return table.sort_values(by=time_col, kind='stable', ignore_index=True)
+
+def dtypesTable(dtypes):
+    
+    import pandas as pd
+    
+    return pd.DataFrame({col:pd.Series(dtype=dtype) for col,dtype in dtypes.items()})
+
+def formatUnderway(uw):
+    
+    import bbkernels
+    
+    # Rename Columns:
+    uw = uw.rename(columns=UW_RENAME_COLUMNS)
+    
+    # BB St.Err. Columns (unless the bb Std column was dropped as all-NaN):
+    for std_col in BB_STD_COLUMNS:
+        if std_col in uw.columns and 'numSamples' in uw.columns:
+            uw.insert(uw.columns.get_loc(std_col)+1, std_col.replace('Std', 'StErr'), bbkernels.standardError(uw[std_col], uw['numSamples']))
+    
+    return uw
+
+if __name__ == "__main__": main()
@@ -16,6 +16,6 @@ source activate ~/sunnysenv
 scriptDir=/mnt/storage/labs/mitchell/spinkham/gitHubRepos/cms_dev/field-workflow
 dataDir=/mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow
 
-python $scriptDir/x03a-shift-bb-data.py --uwfile $dataDir/01b-underway-formatted-gnats.csv --bbcycleParametersFile $dataDir/x01-pH-cycle-duration-limits-dict.pickle --cruiseNameColumn CruiseName --datetimeColumn UWTime --numSamplesColumn numSamples --ofileShiftedData $dataDir/01c-underway-shifted-gnats.csv
+python $scriptDir/x03a-shift-bb-data.py --uwfile $dataDir/01b-underway-formatted-gnats.csv --bbcycleParametersFile $dataDir/x01-pH-cycle-duration-limits-dict.pickle --cruiseNameColumn CruiseName --datetimeColumn UWTime --numSamplesColumn numSamples --ofileShiftedData $dataDir/01c-underway-shifted-gnats.csv --workers 32 --profile $dataDir/logs/03b-shift-bb-data-profile.json
 
-python $scriptDir/x03b-calculate-bbprime-average.py --uwfile $dataDir/01c-underway-shifted-gnats.csv --cruiseNameColumn CruiseName --datetimeColumn UWTime --bbtotColumn bbtot532 --numSamplesColumn numSamples --bbtotStdColumn bbtot532Std --bbacidColumn bbacid --bbacidStdColumn bbacidStd --bbprimeColumn bbprime --bbprimeStd bbprimeStd --ofileAveragedBB $dataDir/01d-underway-averaged-bb-gnats.csv
\ No newline at end of file
+python $scriptDir/x03b-calculate-bbprime-average.py --uwfile $dataDir/01c-underway-shifted-gnats.csv --cruiseNameColumn CruiseName --datetimeColumn UWTime --bbtotColumn bbtot532 --numSamplesColumn numSamples --bbtotStdColumn bbtot532Std --bbacidColumn bbacid --bbacidStdColumn bbacidStd --bbprimeColumn bbprime --bbprimeStd bbprimeStd --ofileAveragedBB $dataDir/01d-underway-averaged-bb-gnats.csv --workers 32 --profile $dataDir/logs/03c-calculate-bbprime-average-profile.json
\ No newline at end of file
@@ -4,6 +4,13 @@ def main():
     import numpy as np
     import pickle
     import argparse
+    import tempfile
+    import fieldio
+    import fieldschema
+    import fieldparallel
+    import fieldcache
+    import fieldprofile
+    import bbkernels
     
     parser = argparse.ArgumentParser(description='''\
     This script shifts bb data up one timestamp where applicable within a given underway file.''')
@@ -24,7 +31,40 @@ def main():
     Name of column containing the number of samples set for the bb cycling.''')
     
     parser.add_argument('--ofileShiftedData', nargs=1, type=str, required=True, help='''\
-    Full filepath, name, and extension of the output file in which to save the bb-shifted dataframe. Must be csv.''')
+    Full filepath, name, and extension of the output file in which to save the bb-shifted dataframe. Must be csv, parquet, or feather, or a directory path ending in / for a dataset partitioned by cruise.''')
+    
+    parser.add_argument('--fileFormat', nargs=1, type=str, required=False, default=[None], choices=['csv', 'parquet', 'feather'], help='''\
+    Optional. Format of the input and output files. If not given, the format is inferred from each file extension.''')
+    
+    parser.add_argument('--loadColumns', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only load the columns this script uses (cruise name, timestamp, numSamples and bb columns) plus any columns listed here. Other columns are left out of the output.''')
+    
+    parser.add_argument('--workers', nargs=1, type=int, required=False, default=[1], help='''\
+    Optional. Number of worker processes. Cruises are processed independently, so with more than 1 worker they are spread over a process pool. Defaults to 1.''')
+    
+    parser.add_argument('--cacheDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory of the per-cruise result cache. Cruises whose input rows and parameters have not changed since a previous run are read from the cache instead of being recomputed.''')
+    
+    parser.add_argument('--cacheMaxSize', nargs=1, type=float, required=False, default=[None], help='''\
+    Optional. Maximum size of the cache in GB. The least recently used results are evicted beyond this size.''')
+    
+    parser.add_argument('--chunksize', nargs=1, type=int, required=False, default=[None], help='''\
+    Optional. Streaming mode for underway files larger than memory: read the underway file this many rows at a time, spill the rows to disk by cruise, and process and write one cruise at a time.''')
+    
+    parser.add_argument('--spillDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory for the temporary per-cruise files of the streaming mode. Defaults to the system temporary directory.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--float32', action='store_true', help='''\
+    Optional. Store the bb columns as float32 instead of float64, halving their memory.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each step and each cruise, with suggested PBS ncpus/mem values.''')
+    
+    parser.add_argument('--cruises', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only process these cruises, given as cruise names or shell-style patterns (e.g. AMT2* s01??). Only their rows are read (only their partitions, from a dataset) and only their partitions of the output dataset are replaced. The output must be a dataset.''')
 
     
     args = parser.parse_args()
@@ -38,46 +78,102 @@ def main():
     datetime = dict_args['datetimeColumn'][0]
     numsamples = dict_args['numSamplesColumn'][0]
     ofile_shifted = dict_args['ofileShiftedData'][0]
+    file_format = dict_args['fileFormat'][0]
+    load_cols = dict_args['loadColumns']
+    workers = dict_args['workers'][0]
+    cache_dir = dict_args['cacheDir'][0]
+    cache_max_gb = dict_args['cacheMaxSize'][0]
+    chunksize = dict_args['chunksize'][0]
+    spill_dir = dict_args['spillDir'][0]
+    time_format = dict_args['timeFormat'][0]
+    use_float32 = dict_args['float32']
+    profile_fp = dict_args['profile'][0]
+    cruises = dict_args['cruises']
+    
+    # Outputs of the other cruises can only be left as they are in a dataset:
+    if cruises is not None and not fieldio.isDataset(ofile_shifted):
+        parser.error('--cruises needs a dataset output (a directory path ending in /), so that the other cruises are kept')
     
     ### Read in Data ###
     
-    uw = pd.read_csv(uw_fp)
+    uw_cols = fieldio.stageColumns(uw_fp, [cruisename, datetime, numsamples], load_cols, match=lambda col: 'bb' in col, fmt=file_format)
+    uw_schema = fieldschema.tableSchema(cruisename_cols=[cruisename], datetime_cols=[datetime], float32=(lambda col: 'bb' in col) if use_float32 else None, time_format=time_format)
     with open(cycle_fp, 'rb') as handle:
         cycleDict = pickle.load(handle) 
     
     
-    ### Insert a Cycle Duration Column. ###
-    ## Note that the cycle duration associated with a row is the difference in time between the current row and the next row.
-
-    crz_list = uw[cruisename].unique()
-    uw[datetime] = pd.to_datetime(uw[datetime])
-    insert_idx = uw.columns.get_loc(numsamples) + 1
-    
-    # Perform operation per each individual cruise
-    crz_dfs = []
-    for crz in crz_list:
-        crz_df = uw.loc[uw[cruisename]==crz]
-        crz_df = crz_df.sort_values(datetime)
+    ### Flag and Shift the BB Data: ###
+    # With several workers, each cruise is flagged and shifted in its own process. The cruises come back in their order of first appearance, as from a single process.
+    # With a cache, only cruises whose rows or parameters changed since the last run are recomputed.
+    
+    cache = fieldcache.openCache(cache_dir, '03b-shift-bb-data', cache_max_gb, modules=[bbkernels, fieldschema])
+    profiler = fieldprofile.openProfiler(profile_fp, '03b-shift-bb-data', workers)
+    
+    if chunksize is not None:
+        # Streaming mode: the underway file is read in chunks and spilled to disk by cruise. Cruises are then flagged, shifted and written out one at a time.
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+            with fieldprofile.step(profiler, 'spill'):
+                spill_fps, dtypes = fieldio.spillByCruise(uw_fp, cruisename, tmp_dir, chunksize, uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises)
+            with fieldprofile.step(profiler, 'shift', parallel=True) as record:
+                writer = fieldio.TableWriter(ofile_shifted, file_format, cruisename, cruises)
+                for crz,shifted_crz_df in fieldparallel.streamCruises(shiftBBData, spill_fps, dtypes, workers, cache, profiler=profiler, cycleDict=cycleDict, cruisename=cruisename, datetime=datetime, numsamples=numsamples):
+                    writer.write(shifted_crz_df)
+                    record['rows_out'] = (record['rows_out'] or 0) + len(shifted_crz_df)
+                writer.close()
         
-        # Calculate and record the time in-between successive rows
-        cycle = []
-        for i in range(len(crz_df) - 1):
-            cycle.append((crz_df[datetime].iloc[i+1] - crz_df[datetime].iloc[i]).total_seconds())
-        # For the last row, append a nan-time as there is no subsequent row with which to calculate a delta t
-        cycle.append(pd.NaT)
+    else:
+        with fieldprofile.step(profiler, 'read') as record:
+            uw = fieldio.readTable(uw_fp, columns=uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises, cruisename=cruisename)
+            record['rows_out'] = len(uw)
         
-        # Append the delta t's between rows as a new column:
-        crz_df.insert(insert_idx, 'cycle_duration[s]', cycle)
-        crz_dfs.append(crz_df)
+        # Profiling also goes cruise by cruise, so that every cruise gets its own metrics.
+        with fieldprofile.step(profiler, 'shift', parallel=True) as record:
+            record['rows_in'] = len(uw)
+            if workers > 1 or cache is not None or profiler is not None:
+                crz_pos = fieldparallel.cruisePositions(uw, cruisename)
+                shifted_crz_dfs = fieldparallel.mapCruises(shiftBBData, (uw,), [(pos,) for pos in crz_pos.values()], workers, cache=cache, labels=list(crz_pos.keys()), profiler=profiler, cycleDict=cycleDict, cruisename=cruisename, datetime=datetime, numsamples=numsamples)
+                shifted_uw_df = pd.concat(shifted_crz_dfs)
+            else:
+                shifted_uw_df = shiftBBData(uw, cycleDict, cruisename, datetime, numsamples)
+            record['rows_out'] = len(shifted_uw_df)
         
-    cycle_df = pd.concat(crz_dfs)
+        # Save out Shifted Dataframe:
+        with fieldprofile.step(profiler, 'write') as record:
+            fieldio.writeTable(shifted_uw_df, ofile_shifted, fmt=file_format, cruisename=cruisename, cruises=cruises)
+            record['rows_in'] = len(shifted_uw_df)
     
-    ### Separate GNATS/EN616 From AMT System Cruises: ###
-    gnats_df = cycle_df.loc[(cycle_df[cruisename].str[0]=='s')|(cycle_df[cruisename]=='en616')]
-    gnats_crz = gnats_df[cruisename].unique()
+    if cache is not None:
+        print(cache.report())
+    if profiler is not None:
+        profiler.save()
+    
+#########################################################################
+
+def shiftBBData(uw, cycleDict, cruisename, datetime, numsamples):
+    
+    import pandas as pd
+    import numpy as np
+    import warnings
+    import fieldschema
+    import bbkernels
     
-    amt_df = cycle_df.loc[(cycle_df[cruisename].str[0]!='s')&(cycle_df[cruisename]!='en616')]
-    amt_crz = amt_df[cruisename].unique()
+    times = fieldschema.parseTimes(uw[datetime])
+    
+    ### Order Rows by Cruise, then by Time: ###
+    # Cruises keep their order of first appearance in the file. Rows without a cruise name are dropped, as they never matched a cruise before.
+    crz_codes, crz_names = pd.factorize(uw[cruisename])
+    order = np.lexsort((times.values, times.isnull().values, crz_codes))
+    order = order[crz_codes[order] >= 0]
+    crz_codes = crz_codes[order]
+    
+    # From here on all cruises are handled at once as arrays, with the first row of every cruise as group boundary (bbkernels). The shifted table is built once, at the end.
+    starts = bbkernels.groupStarts(crz_codes)
+    times = times.to_numpy()[order]
+    nsamples = bbkernels.columnRows(uw[numsamples], order)
+    
+    ### Insert a Cycle Duration Column. ###
+    ## Note that the cycle duration associated with a row is the difference in time between the current row and the next row.
+    cycle = bbkernels.cycleDuration(times, starts)
     
     ### Create a Cycle Duration Flag Column ###
     # 0: No flag
@@ -87,70 +183,54 @@ def main():
     # 4: amt cruise with nSamples set to odd/inconsistent value.
     ## Note that cycle min/max limits were set based on the numSamples setting.  Histograms/distributions were plotted for all cruises with the same numSamples, and limits set by these distributions. These limits were stored in the bbCycleParameters Pickle File. 
     
-    cycle_flag_idx = cycle_df.columns.get_loc('cycle_duration[s]') + 1
-    
-    # All gnats cruises as well as en616 had nSamples = 30, so we only have 1 minimum and 1 maximum cycle limit for all gnats. 
-    if len(gnats_df) > 0:
-        gmin_cycle = cycleDict['gnats'][0]
-        gmax_cycle = cycleDict['gnats'][1]
-
-        if 'cycle_duration_flag' not in gnats_df.columns:
-            gnats_df.insert(cycle_flag_idx, 'cycle_duration_flag', 0)
-        gnats_df.loc[gnats_df['cycle_duration[s]'] < gmin_cycle, 'cycle_duration_flag'] = 1
-        gnats_df.loc[gnats_df['cycle_duration[s]'] > gmax_cycle, 'cycle_duration_flag'] = 2
-        gnats_df.loc[gnats_df['cycle_duration[s]'].isnull()==True, 'cycle_duration_flag'] = 3
-    
-    flagged_gnats_df = gnats_df.copy()
+    # All gnats cruises as well as en616 had nSamples = 30, so we only have 1 minimum and 1 maximum cycle limit for all gnats.
+    # For AMT cruises, limits are looked up from the numSamples of each row.
+    is_gnats = np.array([str(crz)[:1]=='s' or crz=='en616' for crz in crz_names], dtype=bool)[crz_codes]
+    limits = cycleLimitsTable(cycleDict).reindex(nsamples)
+    min_cycle = limits['min_cycle'].values
+    max_cycle = limits['max_cycle'].values
+    if is_gnats.any():
+        min_cycle = np.where(is_gnats, cycleDict['gnats'][0], min_cycle)
+        max_cycle = np.where(is_gnats, cycleDict['gnats'][1], max_cycle)
     
+    # There were a few odd entries with a few rows having nSamples set to 10, 25, or 120. This was most likely interactively set for testing parameters/calibrations. These rows are flagged with flag=4, as is any other numSamples setting without cycle limits.
+    odd_nsamples = ~is_gnats & np.isnan(min_cycle)
+    unknown_nsamples = pd.unique(nsamples[odd_nsamples & ~pd.Series(nsamples).isin([10, 25, 120]).values])
+    if len(unknown_nsamples) > 0:
+        warnings.warn('No bb cycle limits for numSamples = {}; these rows are flagged with cycle_duration_flag = 4.'.format(sorted(unknown_nsamples.tolist())))
     
-     # For AMT cruises, we have limits set based on the nSamples per cruise.
-    # There were a few odd entries with a few rows having nSamples set to 10, 25, or 200. This was most likely interactively set for testing parameters/calibrations. Lets section out these rows/cruises, and flag the data with flag=4.
-    if len(amt_df) > 0:
-    
-        amt_nsample_dfs = []
-        amt_nsamples = [20, 30, 40, 45, 50, 60, 65, 70, 75, 80, 85, 90, 100]
-        for ns,key in zip(amt_nsamples, cycleDict.keys()):
-            nsample_df = amt_df.loc[amt_df[numsamples]==ns]
-            nsmin_cycle = cycleDict[key][0]
-            nsmax_cycle = cycleDict[key][1]
-
-            if 'cycle_duration_flag' not in nsample_df.columns:
-                nsample_df.insert(cycle_flag_idx, 'cycle_duration_flag', 0)
-                nsample_df.loc[nsample_df['cycle_duration[s]'] < nsmin_cycle, 'cycle_duration_flag'] = 1
-                nsample_df.loc[nsample_df['cycle_duration[s]'] > nsmax_cycle, 'cycle_duration_flag'] = 2
-                nsample_df.loc[nsample_df['cycle_duration[s]'].isnull()==True, 'cycle_duration_flag'] = 3
-
-            amt_nsample_dfs.append(nsample_df)
-
-        for ns in [10, 25, 120]:
-            nsample_df = amt_df.loc[amt_df[numsamples]==ns]
-            nsample_df.loc[:, 'cycle_duration_flag'] = 4
-            amt_nsample_dfs.append(nsample_df)
-
-        flagged_amt_df = pd.concat(amt_nsample_dfs)
-    else:
-        flagged_amt_df = amt_df.copy()
+    flags = np.select([odd_nsamples, np.isnan(cycle), cycle > max_cycle, cycle < min_cycle], [4, 3, 2, 1], default=0)
     
     ### SHIFT THE BB DATA UP ONE TIMESTAMP ##########################################
+    # Each bb column takes the value of the next row of its cruise. The last row of each cruise has no next row, and always has a null cycle duration.
+    # Nullify data that was flagged and therefore should not have been shifted.
+    
+    bbcols = [col for col in uw.columns if ('bb' in col)&('470' not in col)&('676' not in col)]
+    shifted = {}
+    for col in uw.columns:
+        if col == datetime:
+            shifted[col] = times
+        elif col in bbcols:
+            shifted[col] = bbkernels.nextRow(bbkernels.columnRows(uw[col], order), starts)
+            shifted[col][flags!=0] = np.nan
+        else:
+            shifted[col] = bbkernels.columnRows(uw[col], order)
+        # The cycle duration and its flag follow the numSamples column:
+        if col == numsamples:
+            shifted['cycle_duration[s]'] = cycle
+            shifted['cycle_duration_flag'] = flags
+    
+    return pd.DataFrame(shifted, index=uw.index[order])
+
+def cycleLimitsTable(cycleDict):
     
-    flagged_uw_df = pd.concat([flagged_gnats_df, flagged_amt_df])
-    bbcols = [col for col in flagged_uw_df.columns if ('bb' in col)&('470' not in col)&('676' not in col)]
-    
-    shifted_bb_dfs = []
-    for crz in crz_list:
-        crz_df = flagged_uw_df.loc[flagged_uw_df[cruisename]==crz]
-        crz_df = crz_df.sort_values(datetime)
-        crz_df[bbcols] = crz_df[bbcols].shift(periods=-1)
-        shifted_bb_dfs.append(crz_df)
-        
-    shifted_uw_df = pd.concat(shifted_bb_dfs)
-    
-    # Nullify data that was flagged and therefore should not have been shifted:
-    shifted_uw_df.loc[shifted_uw_df['cycle_duration_flag']!=0, bbcols] = np.nan
+    import pandas as pd
     
-    # Save out Shifted Dataframe:
-    shifted_uw_df.to_csv(ofile_shifted, index=False)
+    # The AMT numSamples settings are paired, in order, with the keys of the bbCycleParameters dictionary:
+    amt_nsamples = [20, 30, 40, 45, 50, 60, 65, 70, 75, 80, 85, 90, 100]
+    limits = [(ns, cycleDict[key][0], cycleDict[key][1]) for ns,key in zip(amt_nsamples, cycleDict.keys())]
     
+    return pd.DataFrame(limits, columns=['numSamples', 'min_cycle', 'max_cycle']).set_index('numSamples')
     
 if __name__ == "__main__": main() 
     
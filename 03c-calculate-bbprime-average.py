@@ -4,6 +4,13 @@ def main():
     import numpy as np
     import pickle
     import argparse
+    import tempfile
+    import fieldio
+    import fieldschema
+    import fieldparallel
+    import fieldcache
+    import fieldprofile
+    import bbkernels
     
     parser = argparse.ArgumentParser(description='''\
     This script calculates bbprime from bbtot and the average of the two surrounding bbacids.''')
@@ -39,7 +46,40 @@ def main():
     Name of column containing the bbprime error data.''')
     
     parser.add_argument('--ofileAveragedBB', nargs=1, type=str, required=True, help='''\
-    Full filepath, name, and extension of the output file in which to save the bb-shifted dataframe. Must be csv.''')
+    Full filepath, name, and extension of the output file in which to save the bb-shifted dataframe. Must be csv, parquet, or feather, or a directory path ending in / for a dataset partitioned by cruise.''')
+    
+    parser.add_argument('--fileFormat', nargs=1, type=str, required=False, default=[None], choices=['csv', 'parquet', 'feather'], help='''\
+    Optional. Format of the input and output files. If not given, the format is inferred from each file extension.''')
+    
+    parser.add_argument('--loadColumns', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only load the columns this script uses (cruise name, timestamp, numSamples and bb columns) plus any columns listed here. Other columns are left out of the output.''')
+    
+    parser.add_argument('--workers', nargs=1, type=int, required=False, default=[1], help='''\
+    Optional. Number of worker processes. Cruises are processed independently, so with more than 1 worker they are spread over a process pool. Defaults to 1.''')
+    
+    parser.add_argument('--cacheDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory of the per-cruise result cache. Cruises whose input rows and parameters have not changed since a previous run are read from the cache instead of being recomputed.''')
+    
+    parser.add_argument('--cacheMaxSize', nargs=1, type=float, required=False, default=[None], help='''\
+    Optional. Maximum size of the cache in GB. The least recently used results are evicted beyond this size.''')
+    
+    parser.add_argument('--chunksize', nargs=1, type=int, required=False, default=[None], help='''\
+    Optional. Streaming mode for underway files larger than memory: read the underway file this many rows at a time, spill the rows to disk by cruise, and process and write one cruise at a time.''')
+    
+    parser.add_argument('--spillDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory for the temporary per-cruise files of the streaming mode. Defaults to the system temporary directory.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--float32', action='store_true', help='''\
+    Optional. Store the bb columns as float32 instead of float64, halving their memory.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each step and each cruise, with suggested PBS ncpus/mem values.''')
+    
+    parser.add_argument('--cruises', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only process these cruises, given as cruise names or shell-style patterns (e.g. AMT2* s01??). Only their rows are read (only their partitions, from a dataset) and only their partitions of the output dataset are replaced. The output must be a dataset.''')
 
     
     args = parser.parse_args()
@@ -58,93 +98,134 @@ def main():
     bbprime = dict_args['bbprimeColumn'][0]
     bbprime_std = dict_args['bbprimeStdColumn'][0]
     ofile_avg_bb = dict_args['ofileAveragedBB'][0]
+    file_format = dict_args['fileFormat'][0]
+    load_cols = dict_args['loadColumns']
+    workers = dict_args['workers'][0]
+    cache_dir = dict_args['cacheDir'][0]
+    cache_max_gb = dict_args['cacheMaxSize'][0]
+    chunksize = dict_args['chunksize'][0]
+    spill_dir = dict_args['spillDir'][0]
+    time_format = dict_args['timeFormat'][0]
+    use_float32 = dict_args['float32']
+    profile_fp = dict_args['profile'][0]
+    cruises = dict_args['cruises']
+    
+    # Outputs of the other cruises can only be left as they are in a dataset:
+    if cruises is not None and not fieldio.isDataset(ofile_avg_bb):
+        parser.error('--cruises needs a dataset output (a directory path ending in /), so that the other cruises are kept')
     
     ### Read in Data ########################################################
     
-    uw = pd.read_csv(uw_fp)
+    uw_cols = fieldio.stageColumns(uw_fp, [cruisename, datetime, numsamples], load_cols, match=lambda col: 'bb' in col, fmt=file_format)
+    uw_schema = fieldschema.tableSchema(cruisename_cols=[cruisename], datetime_cols=[datetime], float32=(lambda col: 'bb' in col) if use_float32 else None, time_format=time_format)
+    
+    ### Average the BB Data: ###############################################
+    # With several workers, each cruise is averaged in its own process. The cruises come back in their order of first appearance, as from a single process.
+    # With a cache, only cruises whose rows or parameters changed since the last run are recomputed.
+    
+    cache = fieldcache.openCache(cache_dir, '03c-calculate-bbprime-average', cache_max_gb, modules=[bbkernels])
+    profiler = fieldprofile.openProfiler(profile_fp, '03c-calculate-bbprime-average', workers)
+    
+    if chunksize is not None:
+        # Streaming mode: the underway file is read in chunks and spilled to disk by cruise. Cruises are then averaged and written out one at a time.
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+            with fieldprofile.step(profiler, 'spill'):
+                spill_fps, dtypes = fieldio.spillByCruise(uw_fp, cruisename, tmp_dir, chunksize, uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises)
+            with fieldprofile.step(profiler, 'average', parallel=True) as record:
+                writer = fieldio.TableWriter(ofile_avg_bb, file_format, cruisename, cruises)
+                for crz,averaged_crz_df in fieldparallel.streamCruises(averageBBData, spill_fps, dtypes, workers, cache, profiler=profiler, cruisename=cruisename, numsamples=numsamples, bbtot=bbtot, bbtot_std=bbtot_std, bbacid=bbacid, bbacid_std=bbacid_std, bbprime=bbprime, bbprime_std=bbprime_std):
+                    writer.write(averaged_crz_df)
+                    record['rows_out'] = (record['rows_out'] or 0) + len(averaged_crz_df)
+                writer.close()
+        
+    else:
+        with fieldprofile.step(profiler, 'read') as record:
+            uw = fieldio.readTable(uw_fp, columns=uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises, cruisename=cruisename)
+            record['rows_out'] = len(uw)
+        
+        # Profiling also goes cruise by cruise, so that every cruise gets its own metrics.
+        with fieldprofile.step(profiler, 'average', parallel=True) as record:
+            record['rows_in'] = len(uw)
+            if workers > 1 or cache is not None or profiler is not None:
+                crz_pos = fieldparallel.cruisePositions(uw, cruisename)
+                averaged_crz_dfs = fieldparallel.mapCruises(averageBBData, (uw,), [(pos,) for pos in crz_pos.values()], workers, cache=cache, labels=list(crz_pos.keys()), profiler=profiler, cruisename=cruisename, numsamples=numsamples, bbtot=bbtot, bbtot_std=bbtot_std, bbacid=bbacid, bbacid_std=bbacid_std, bbprime=bbprime, bbprime_std=bbprime_std)
+                acid_shifted_df = pd.concat(averaged_crz_dfs)
+            else:
+                acid_shifted_df = averageBBData(uw, cruisename, numsamples, bbtot, bbtot_std, bbacid, bbacid_std, bbprime, bbprime_std)
+            record['rows_out'] = len(acid_shifted_df)
+        
+        ### SAVE OUT AVERAGE BB DATAFRAME ################################################
+        with fieldprofile.step(profiler, 'write') as record:
+            fieldio.writeTable(acid_shifted_df, ofile_avg_bb, fmt=file_format, cruisename=cruisename, cruises=cruises)
+            record['rows_in'] = len(acid_shifted_df)
+        
+    if cache is not None:
+        print(cache.report())
+    if profiler is not None:
+        profiler.save()
     
-    # We don't want to accidentally average two bbacids spanning two different cruises. Therefore, we will apply this script per cruise.
-    # Generate a list of unique cruises:
-    crz_list = uw[cruisename].unique()
+#########################################################################  
+
+def averageBBData(uw, cruisename, numsamples, bbtot, bbtot_std, bbacid, bbacid_std, bbprime, bbprime_std):
     
-    # Convert datetime column into pandas datetime objects:
-    uw[datetime] = pd.to_datetime(uw[datetime])
+    import pandas as pd
+    import numpy as np
+    import bbkernels
+    
+    # We don't want to accidentally average two bbacids spanning two different cruises. Therefore, we will apply this script per cruise.
+    # Number the cruises in order of first appearance (rows without a cruise name get -1):
+    crz_codes = pd.factorize(uw[cruisename])[0]
+    
+    # Group the rows by cruise, keeping the row order within each cruise. Rows without a cruise name are dropped, as they never matched a cruise before.
+    # All cruises are then handled at once as arrays, with the first row of every cruise as group boundary (bbkernels), so that no average spans two cruises.
+    # New columns are placed in the column list as they are computed, and the averaged table is built once, at the end.
+    order = np.argsort(crz_codes, kind='stable')
+    order = order[crz_codes[order] >= 0]
+    starts = bbkernels.groupStarts(crz_codes[order])
+    columns = list(uw.columns)
+    values = {col:bbkernels.columnRows(uw[col], order) for col in columns}
     
     # If bb standard error columns do not exist, create them:
-    if 'bbtot532StErr' not in uw.columns:
-        idx = uw.columns.get_loc(bbtot) + 1
-        uw.insert(idx, 'bbtot532StErr', uw[bbtot_std]/np.sqrt(uw[numsamples]))
-    if 'bbacidStErr' not in uw.columns:
-        idx = uw.columns.get_loc(bbacid) + 1
-        uw.insert(idx, 'bbacidStErr', uw[bbacid_std]/np.sqrt(uw[numsamples]))
-    if 'bbprimeStErr' not in uw.columns:
-        idx = uw.columns.get_loc(bbprime) + 1
-        uw.insert(idx, 'bbprimeStErr', uw[bbprime_std]/np.sqrt(uw[numsamples]))
-        
-                  
+    for col,std_col,err_col in [(bbtot, bbtot_std, 'bbtot532StErr'), (bbacid, bbacid_std, 'bbacidStErr'), (bbprime, bbprime_std, 'bbprimeStErr')]:
+        if err_col not in values:
+            columns.insert(columns.index(col) + 1, err_col)
+            values[err_col] = bbkernels.standardError(values[std_col], values[numsamples])
     
     ### DESIGNATE BBACID[i] AND BBACID[i-1]: #####################################
     # 1) Rename bbacid to bbacid[i].
-    # 2) Create a new column named bbacid[i-1].
-    # 3) Copy bbacid[i] into bbacid[i-1].
-    # 4) Shift bbacid[i-1] down one row.
+    # 2) Create a new column named bbacid[i-1], after the last bb column.
+    # 3) Fill bbacid[i-1] with bbacid[i] of the previous row of the same cruise (NaN for the first row of each cruise).
     
-    bbcols = [col for col in uw.columns if 'bb' in col]
-    insert_idx = uw.columns.get_loc(bbcols[-1]) + 1
+    bbcols = [col for col in columns if 'bb' in col]
+    insert_idx = columns.index(bbcols[-1]) + 1
     
-    uw.rename(columns={bbacid:'bbacid[i]', 'bbacidStErr':'bbacidStErr[i]'}, inplace=True)
-    previous_acid_cols = ['bbacid[i-1]', 'bbacidStErr[i-1]']
+    for col,renamed in [(bbacid, 'bbacid[i]'), ('bbacidStErr', 'bbacidStErr[i]')]:
+        columns[columns.index(col)] = renamed
+        values[renamed] = values.pop(col)
     
-    shifted_acid_dfs = []
-    for crz in crz_list:
-        crz_df = uw.loc[uw[cruisename]==crz]
-        crz_df.insert(insert_idx, 'bbacid[i-1]', crz_df['bbacid[i]'])
-        crz_df.insert(insert_idx + 1, 'bbacidStErr[i-1]', crz_df['bbacidStErr[i]'])
-        crz_df[previous_acid_cols] = crz_df[previous_acid_cols].shift(periods=1)
-        shifted_acid_dfs.append(crz_df)
-    
-    acid_shifted_df = pd.concat(shifted_acid_dfs)
+    columns[insert_idx:insert_idx] = ['bbacid[i-1]', 'bbacidStErr[i-1]']
+    values['bbacid[i-1]'] = bbkernels.previousRow(values['bbacid[i]'], starts)
+    values['bbacidStErr[i-1]'] = bbkernels.previousRow(values['bbacidStErr[i]'], starts)
     
     ### PROPAGATE ERROR ON BBACID AVERAGE AND BBPRIME AVERAGE ##########################
     # 1) Create a bbacid average column and propagate the error: sqrt(acid[i]^2 + acid[i-1]^2)/2
     # 2) Calculate a bbprime average column: bbtot[i] - bbacid_average.
     # 3) Propagate error on bbprime average: sqrt(bbtot_err^2 + bbacid_average_err^2)
     
-    if 'bbacidAvg' not in acid_shifted_df.columns:
-        
-        insert_idx = acid_shifted_df.columns.get_loc('bbacidStErr[i-1]') + 1
-        
-        bba_avg = acid_shifted_df[['bbacid[i]', 'bbacid[i-1]']].mean(axis=1, skipna=False)
-        bba_avg_err = bbacidAvgError(acid_shifted_df['bbacidStErr[i]'], acid_shifted_df['bbacidStErr[i-1]'])
-        
-        acid_shifted_df.insert(insert_idx, 'bbacidAvg', bba_avg)
-        acid_shifted_df.insert(insert_idx + 1, 'bbacidAvgStErr', bba_avg_err)
+    if 'bbacidAvg' not in values:
         
-    if 'bbprimeAvg' not in acid_shifted_df.columns:
+        insert_idx = columns.index('bbacidStErr[i-1]') + 1
+        columns[insert_idx:insert_idx] = ['bbacidAvg', 'bbacidAvgStErr']
+        values['bbacidAvg'] = bbkernels.acidAverage(values['bbacid[i]'], starts, previous=values['bbacid[i-1]'])
+        values['bbacidAvgStErr'] = bbkernels.acidAverageError(values['bbacidStErr[i]'], starts, previous=values['bbacidStErr[i-1]'])
         
-        insert_idx = acid_shifted_df.columns.get_loc('bbprimeStErr') + 1
+    if 'bbprimeAvg' not in values:
         
-        bbp_avg = acid_shifted_df[bbtot] - acid_shifted_df['bbacidAvg']
-        bbp_avg_err = bbprimeError(acid_shifted_df['bbtot532StErr'], acid_shifted_df['bbacidAvgStErr'])
-        
-        acid_shifted_df.insert(insert_idx, 'bbprimeAvg', bbp_avg)
-        acid_shifted_df.insert(insert_idx + 1, 'bbprimeAvgStErr', bbp_avg_err)
-        
-    ### SAVE OUT AVERAGE BB DATAFRAME ################################################
-    acid_shifted_df.to_csv(ofile_avg_bb, index=False)
+        insert_idx = columns.index('bbprimeStErr') + 1
+        columns[insert_idx:insert_idx] = ['bbprimeAvg', 'bbprimeAvgStErr']
+        values['bbprimeAvg'] = bbkernels.asArray(values[bbtot]) - bbkernels.asArray(values['bbacidAvg'])
+        values['bbprimeAvgStErr'] = bbkernels.quadratureSum(values['bbtot532StErr'], values['bbacidAvgStErr'])
     
-#########################################################################  
-    
-def bbacidAvgError(err1, err2):
-    import numpy as np
-
-    avgErr = np.sqrt(err1**2 + err2**2)/2
-    return avgErr
-
-def bbprimeError(tot_err, acid_err):
-    import numpy as np
-
-    bbpErr = np.sqrt(tot_err**2 + acid_err**2)
-    return bbpErr    
+    return pd.DataFrame({col:values[col] for col in columns}, index=uw.index[order])
     
-if __name__ == "__main__": main()  
\ No newline at end of file
+if __name__ == "__main__": main()
@@ -16,4 +16,4 @@ source activate ~/sunnysenv
 scriptDir=/mnt/storage/labs/mitchell/spinkham/gitHubRepos/cms_dev/field-workflow
 dataDir=/mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow
 
-python $scriptDir/x04-merge-field-data.py --uwFile $dataDir/01d-underway-averaged-bb-gnats.csv --discreteFile $dataDir/02b-discrete-formatted-gnats.csv --uwIdCol UWid --discreteIdCol StationDataID --uwCruiseNameCol CruiseName --discreteCruiseNameCol CruiseName --uwTimeCol UWTime --discreteTimeCol StationTime --uwLongitudeCol UWLongitude --discreteLongitudeCol Longitude --uwLatitudeCol UWLatitude --discreteLatitudeCol Latitude --discreteShallowestCol Shallowest --discreteDepthCol Depth --ofileFieldData $dataDir/04-merged-field-data.csv
\ No newline at end of file
+python $scriptDir/x04-merge-field-data.py --uwFile $dataDir/01d-underway-averaged-bb-gnats.csv --discreteFile $dataDir/02b-discrete-formatted-gnats.csv --uwIdCol UWid --discreteIdCol StationDataID --uwCruiseNameCol CruiseName --discreteCruiseNameCol CruiseName --uwTimeCol UWTime --discreteTimeCol StationTime --uwLongitudeCol UWLongitude --discreteLongitudeCol Longitude --uwLatitudeCol UWLatitude --discreteLatitudeCol Latitude --discreteShallowestCol Shallowest --discreteDepthCol Depth --ofileFieldData $dataDir/04-merged-field-data.csv --workers 32 --profile $dataDir/logs/04b-merge-field-data-profile.json
\ No newline at end of file
@@ -4,6 +4,13 @@ def main():
     import numpy as np
     import pickle
     import argparse
+    import tempfile
+    import os
+    import fieldio
+    import fieldschema
+    import fieldcache
+    import fieldparallel
+    import fieldprofile
     
     parser = argparse.ArgumentParser(description='''\
     This takes in an underway file and a discrete file and merges them together by nearest timestamp within 5 minutes. Note that the merge occurs differently for GNATS cruises than for AMT style cruises. Therefore, as an input argument, we need to specify whether or not our data is solely Gnats, solely AMT, or both. Additionally, in the merged dataframe, we create an overall ID, which is: "cruisename_uwid" or if not uwid exists: "cruisename_discreteid". ''')
@@ -49,14 +56,89 @@ def main():
     
     parser.add_argument('--discreteDepthCol', nargs=1, type=str, required=True, help='''\
     Name of column that contains discrete depths.''')
-   
-    parser.add_argument('--ofileFieldData', nargs=1, type=str, required=True, help='''\
-    Full path, name, and extension of where to save merged field csv.''')  
-
+    
+    parser.add_argument('--ofileFieldData', nargs=1, type=str, required=False, default=[None], help='''\
+    Full path, name, and extension of where to save merged field data. Must be csv, parquet, or feather, or a directory path ending in / for a dataset partitioned by cruise. Required unless --ofileSweep is given.''')  
+    
+    parser.add_argument('--timeTolerance', nargs=1, type=str, required=False, default=['5min'], help='''\
+    Maximum time difference allowed between a GNATS discrete sample and its nearest underway record, as a pandas timedelta string. Defaults to 5min.''')
+    
+    parser.add_argument('--amtTimeWindow', nargs=1, type=str, required=False, default=['6h'], help='''\
+    Maximum time difference allowed between an AMT surface sample and its underway match, as a pandas timedelta string. Defaults to 6h.''')
+    
+    parser.add_argument('--amtMatchRadius', nargs=1, type=float, required=False, default=[1.11], help='''\
+    Maximum great-circle distance in km allowed between an AMT surface sample and its underway match. Of the underway records within both the time window and this radius, the nearest in time is matched. Defaults to 1.11 km (0.01 degrees of latitude).''')
+    
+    parser.add_argument('--fileFormat', nargs=1, type=str, required=False, default=[None], choices=['csv', 'parquet', 'feather'], help='''\
+    Optional. Format of the input and output files. If not given, the format is inferred from each file extension.''')
+    
+    parser.add_argument('--loadColumns', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only load the id, cruise name, time, position, shallowest and depth columns plus any columns listed here from the underway and discrete files. Other columns are left out of the output.''')
+    
+    parser.add_argument('--workers', nargs=1, type=int, required=False, default=[1], help='''\
+    Optional. Number of worker processes. Cruises are processed independently, so with more than 1 worker they are spread over a process pool. Defaults to 1.''')
+    
+    parser.add_argument('--cacheDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory of the per-cruise result cache. Cruises whose input rows and parameters have not changed since a previous run are read from the cache instead of being recomputed.''')
+    
+    parser.add_argument('--cacheMaxSize', nargs=1, type=float, required=False, default=[None], help='''\
+    Optional. Maximum size of the cache in GB. The least recently used results are evicted beyond this size.''')
+    
+    parser.add_argument('--chunksize', nargs=1, type=int, required=False, default=[None], help='''\
+    Optional. Streaming mode for underway files larger than memory: read the underway file this many rows at a time, spill the rows to disk by cruise, and process and write one cruise at a time.''')
+    
+    parser.add_argument('--spillDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory for the temporary per-cruise files of the streaming mode. Defaults to the system temporary directory.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--float32', action='store_true', help='''\
+    Optional. Store measurement columns (all float columns but latitude, longitude and depth) as float32 instead of float64, halving their memory.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each step and each cruise, with suggested PBS ncpus/mem values.''')
+    
+    parser.add_argument('--ofileSweep', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Sweep mode: instead of merging with one set of tolerances, match every cruise for every point of a tolerance grid in one pass, and save a summary to this file: for each cruise (and for all GNATS / all AMT cruises) and grid point, the number of samples matched, the number of underway records matched, and the mean, median, 90th percentile and maximum time and distance offsets.''')
+    
+    parser.add_argument('--sweepTimeTolerances', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. GNATS time tolerances of the sweep grid, as pandas timedelta strings, e.g. 1min 2min 5min 10min. Defaults to --timeTolerance.''')
+    
+    parser.add_argument('--sweepAmtTimeWindows', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. AMT time windows of the sweep grid, as pandas timedelta strings, e.g. 1h 3h 6h. Defaults to --amtTimeWindow.''')
+    
+    parser.add_argument('--sweepAmtRadii', nargs='*', type=float, required=False, default=None, help='''\
+    Optional. AMT match radii (km) of the sweep grid, e.g. 0.5 1.11 2.22. Every time window is combined with every radius. Defaults to --amtMatchRadius.''')
+    
+    parser.add_argument('--ofileSweepMatches', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Sweep mode: file to save every matched pair of every grid point to, with its time (s) and distance (km) offset.''')
+    
+    parser.add_argument('--sweepMergedDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Sweep mode: directory to save the merged field data of every grid point to, one file per grid point (e.g. gnats_5min.csv, amt_6h_1.11km.csv, in the format of --ofileSweep), each holding the cruises of that program.''')
+    
+    parser.add_argument('--cruises', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only process these cruises, given as cruise names or shell-style patterns (e.g. AMT2* s01??). Only their rows are read (only their partitions, from a dataset) and only their partitions of the output datasets are replaced. The outputs must be datasets.''')
+    
+    parser.add_argument('--xbtFile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. XBT file (csv, parquet, or feather) to merge alongside the underway and discrete data. Each discrete datapoint is given the XBT record of its station nearest in depth, with the XBT columns prefixed XBT (e.g. XBTTemperature1). Not used in sweep mode.''')
+    
+    parser.add_argument('--xbtStationIdCol', nargs=1, type=str, required=False, default=['StationInfoID'], help='''\
+    Optional. Station id column of the XBT data. Defaults to StationInfoID.''')
+    
+    parser.add_argument('--discreteStationIdCol', nargs=1, type=str, required=False, default=['StationInfoID'], help='''\
+    Optional. Station id column of the discrete data, joined to the XBT station ids. XBT records take the cruise of their station. Defaults to StationInfoID.''')
+    
+    parser.add_argument('--xbtDepthCol', nargs=1, type=str, required=False, default=['Depth'], help='''\
+    Optional. Depth column of the XBT data. Defaults to Depth.''')
+    
+    parser.add_argument('--xbtTimeCol', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Time column of the XBT data, parsed into timestamps.''')
+    
     
     args = parser.parse_args()
     dict_args = vars(args)
-
+    
     ### Define Dictionary Variables: ########################################
     
     uw_fp = dict_args['uwFile'][0]
@@ -74,146 +156,670 @@ def main():
     d_shallowest = dict_args['discreteShallowestCol'][0]
     d_depth = dict_args['discreteDepthCol'][0]
     ofile = dict_args['ofileFieldData'][0]
+    time_tolerance = dict_args['timeTolerance'][0]
+    amt_time_window = dict_args['amtTimeWindow'][0]
+    amt_radius = dict_args['amtMatchRadius'][0]
+    file_format = dict_args['fileFormat'][0]
+    load_cols = dict_args['loadColumns']
+    workers = dict_args['workers'][0]
+    cache_dir = dict_args['cacheDir'][0]
+    cache_max_gb = dict_args['cacheMaxSize'][0]
+    chunksize = dict_args['chunksize'][0]
+    spill_dir = dict_args['spillDir'][0]
+    time_format = dict_args['timeFormat'][0]
+    use_float32 = dict_args['float32']
+    profile_fp = dict_args['profile'][0]
+    sweep_fp = dict_args['ofileSweep'][0]
+    sweep_tolerances = dict_args['sweepTimeTolerances'] or [time_tolerance]
+    sweep_windows = dict_args['sweepAmtTimeWindows'] or [amt_time_window]
+    sweep_radii = dict_args['sweepAmtRadii'] or [amt_radius]
+    sweep_matches_fp = dict_args['ofileSweepMatches'][0]
+    sweep_merged_dir = dict_args['sweepMergedDir'][0]
+    
+    cruises = dict_args['cruises']
+    xbt_fp = dict_args['xbtFile'][0]
+    xbt_station = dict_args['xbtStationIdCol'][0]
+    d_station = dict_args['discreteStationIdCol'][0]
+    xbt_depth = dict_args['xbtDepthCol'][0]
+    xbt_time = dict_args['xbtTimeCol'][0]
+    
+    if ofile is None and sweep_fp is None:
+        parser.error('one of --ofileFieldData or --ofileSweep is required')
+    if xbt_fp is not None and sweep_fp is not None:
+        parser.error('--xbtFile is not used in sweep mode')
+    # Outputs of the other cruises can only be left as they are in a dataset:
+    if cruises is not None and ofile is not None and sweep_fp is None and not fieldio.isDataset(ofile):
+        parser.error('--cruises needs a dataset output (a directory path ending in /), so that the other cruises are kept')
+    
+    # Read in Data, turning datetime strings into pandas timestamps:
+    uw_cols = fieldio.stageColumns(uw_fp, [uw_id, uw_cruisename, uw_time, uw_longitude, uw_latitude], load_cols, fmt=file_format)
+    d_cols = fieldio.stageColumns(d_fp, [d_id, d_cruisename, d_time, d_longitude, d_latitude, d_shallowest, d_depth] + ([d_station] if xbt_fp is not None else []), load_cols, fmt=file_format)
+    # Cruise names are read as categoricals and IDs as nullable integers; measurements optionally as float32.
+    measurement = (lambda col: col not in [uw_longitude, uw_latitude, d_longitude, d_latitude, d_depth]) if use_float32 else None
+    uw_schema = fieldschema.tableSchema(cruisename_cols=[uw_cruisename], id_cols=[uw_id], datetime_cols=[uw_time], float32=measurement, time_format=time_format)
+    d_schema = fieldschema.tableSchema(cruisename_cols=[d_cruisename], id_cols=[d_id], datetime_cols=[d_time], float32=measurement, time_format=time_format)
+    profiler = fieldprofile.openProfiler(profile_fp, '04b-merge-field-data', workers)
+    with fieldprofile.step(profiler, 'read discrete') as record:
+        d = fieldio.readTable(d_fp, columns=d_cols, fmt=file_format, schema=d_schema, cruises=cruises, cruisename=d_cruisename)
+        record['rows_out'] = len(d)
+    xbt = None
+    if xbt_fp is not None:
+        with fieldprofile.step(profiler, 'read xbt') as record:
+            xbt = fieldio.readTable(xbt_fp, fmt=file_format, datetime_cols=[xbt_time] if xbt_time is not None else None)
+            record['rows_out'] = len(xbt)
+    
+    # Merge Underway and field data cruise by cruise:
+    cache = fieldcache.openCache(cache_dir, '04b-merge-field-data', cache_max_gb, modules=[fieldschema])
+    sweep_args = dict(uw_id=uw_id, d_id=d_id, uw_cruisename=uw_cruisename, d_cruisename=d_cruisename, uw_time=uw_time, d_time=d_time, uw_longitude=uw_longitude, d_longitude=d_longitude, uw_latitude=uw_latitude, d_latitude=d_latitude, d_shallowest=d_shallowest, d_depth=d_depth, time_tolerances=sweep_tolerances, amt_time_windows=sweep_windows, amt_radii=sweep_radii, merged=sweep_merged_dir is not None)
+    
+    if sweep_fp is not None and chunksize is not None:
+        # Sweep mode, streaming: as the streaming merge below, but each cruise is matched for the whole tolerance grid. The merged grid points are spilled and written one file at a time.
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+            with fieldprofile.step(profiler, 'spill'):
+                spill_fps, dtypes = fieldio.spillByCruise(uw_fp, uw_cruisename, tmp_dir, chunksize, uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises)
+            d_crz_pos = fieldparallel.cruisePositions(d, d_cruisename)
+            crz_list = list(spill_fps.keys()) + [crz for crz in d_crz_pos.keys() if crz not in spill_fps]
+            
+            matches = {}
+            samples = {}
+            merged_fps = {}
+            merged_dtypes = {}
+            with fieldprofile.step(profiler, 'sweep', parallel=True) as record:
+                for crz,(matches_crz, samples_crz, merged_crz) in fieldparallel.streamCruises(sweepCruise, spill_fps, dtypes, workers, cache, crz_list=crz_list, tables=(d,), table_positions=(d_crz_pos,), profiler=profiler, **sweep_args):
+                    matches[crz] = matches_crz
+                    samples[crz] = samples_crz
+                    for label,merged_crz_df in (merged_crz or {}).items():
+                        merged_fps.setdefault(label, {})[crz] = os.path.join(tmp_dir, 'merged{:05d}.pkl'.format(sum(len(fps) for fps in merged_fps.values())))
+                        merged_dtypes.setdefault(label, {})[crz] = fieldio.spillTable(merged_crz_df, merged_fps[label][crz], chunksize)
+                    record['rows_out'] = (record['rows_out'] or 0) + len(matches_crz)
+            
+            merge_order = mergeCruiseOrder(spill_fps.keys(), d_crz_pos.keys())
+            with fieldprofile.step(profiler, 'write') as record:
+                for label in merged_fps:
+                    crz_order = [crz for crz in merge_order if crz in merged_fps[label]]
+                    record['rows_in'] = (record['rows_in'] or 0) + writeFieldStream([merged_fps[label][crz] for crz in crz_order], [merged_dtypes[label][crz] for crz in crz_order], sweepFile(sweep_merged_dir, label, file_format, sweep_fp), file_format, uw_id, d_id, uw_time, uw_longitude, d_longitude, uw_latitude, d_latitude)
+                writeSweep(pd.concat([matches[crz] for crz in merge_order], ignore_index=True), pd.concat([samples[crz] for crz in merge_order], ignore_index=True), sweep_fp, sweep_matches_fp, file_format, uw_id, sweep_tolerances, sweep_windows, sweep_radii)
+    
+    elif sweep_fp is not None:
+        # Sweep mode: the candidate matches of each cruise are searched once, and every point of the tolerance grid is matched from them.
+        with fieldprofile.step(profiler, 'read underway') as record:
+            uw = fieldio.readTable(uw_fp, columns=uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises, cruisename=uw_cruisename)
+            record['rows_out'] = len(uw)
+        uw_crz_pos = fieldparallel.cruisePositions(uw, uw_cruisename)
+        d_crz_pos = fieldparallel.cruisePositions(d, d_cruisename)
+        no_rows = np.array([], dtype=int)
+        crz_list = mergeCruiseOrder(uw_crz_pos.keys(), d_crz_pos.keys())
+        partitions = [(uw_crz_pos.get(crz, no_rows), d_crz_pos.get(crz, no_rows)) for crz in crz_list]
+        with fieldprofile.step(profiler, 'sweep', parallel=True) as record:
+            results = fieldparallel.mapCruises(sweepCruise, (uw, d), partitions, workers, cache=cache, labels=crz_list, profiler=profiler, **sweep_args)
+            record['rows_in'] = len(uw) + len(d)
+            record['rows_out'] = sum(len(matches_crz) for matches_crz,_,_ in results)
+        
+        with fieldprofile.step(profiler, 'write') as record:
+            merged = {}
+            for _,_,merged_crz in results:
+                for label,merged_crz_df in (merged_crz or {}).items():
+                    merged.setdefault(label, []).append(merged_crz_df)
+            for label,merged_dfs in merged.items():
+                field = finalizeFieldData(pd.concat(merged_dfs), uw_id, d_id, uw_time, uw_longitude, d_longitude, uw_latitude, d_latitude)
+                fieldio.writeTable(field, sweepFile(sweep_merged_dir, label, file_format, sweep_fp), fmt=file_format)
+                record['rows_in'] = (record['rows_in'] or 0) + len(field)
+            writeSweep(pd.concat([matches_crz for matches_crz,_,_ in results], ignore_index=True), pd.concat([samples_crz for _,samples_crz,_ in results], ignore_index=True), sweep_fp, sweep_matches_fp, file_format, uw_id, sweep_tolerances, sweep_windows, sweep_radii)
+    
+    elif chunksize is not None:
+        # Streaming mode: the underway file is read in chunks and spilled to disk by cruise. Cruises are then merged one at a time and spilled again.
+        # The merged cruises are finally interleaved by time, chunk by chunk, into the merged field data file.
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+            with fieldprofile.step(profiler, 'spill'):
+                spill_fps, dtypes = fieldio.spillByCruise(uw_fp, uw_cruisename, tmp_dir, chunksize, uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises)
+            d_crz_pos = fieldparallel.cruisePositions(d, d_cruisename)
+            crz_list = list(spill_fps.keys()) + [crz for crz in d_crz_pos.keys() if crz not in spill_fps]
+            
+            # XBT records are placed in the cruises of their stations, and merged with each cruise as a third table:
+            merge_func, tables, table_positions, xbt_args = mergeCruise, (d,), (d_crz_pos,), {}
+            if xbt is not None:
+                xbt = prepareXbt(xbt, d, xbt_station, d_station, d_cruisename)
+                merge_func, tables, table_positions = mergeCruiseXbt, (d, xbt), (d_crz_pos, fieldparallel.cruisePositions(xbt, d_cruisename))
+                xbt_args = dict(d_station=d_station, xbt_station=xbt_station, xbt_depth=xbt_depth)
+            
+            merged_fps = {}
+            merged_dtypes = {}
+            with fieldprofile.step(profiler, 'merge', parallel=True) as record:
+                for crz,merged_crz_df in fieldparallel.streamCruises(merge_func, spill_fps, dtypes, workers, cache, crz_list=crz_list, tables=tables, table_positions=table_positions, profiler=profiler, **xbt_args, uw_id=uw_id, d_id=d_id, uw_cruisename=uw_cruisename, d_cruisename=d_cruisename, uw_time=uw_time, d_time=d_time, uw_longitude=uw_longitude, d_longitude=d_longitude, uw_latitude=uw_latitude, d_latitude=d_latitude, d_shallowest=d_shallowest, d_depth=d_depth, time_tolerance=time_tolerance, amt_time_window=amt_time_window, amt_radius=amt_radius):
+                    merged_fps[crz] = os.path.join(tmp_dir, 'merged{:05d}.pkl'.format(len(merged_fps)))
+                    merged_dtypes[crz] = fieldio.spillTable(merged_crz_df, merged_fps[crz], chunksize)
+                    record['rows_out'] = (record['rows_out'] or 0) + len(merged_crz_df)
+            
+            merge_order = mergeCruiseOrder(spill_fps.keys(), d_crz_pos.keys())
+            with fieldprofile.step(profiler, 'write') as record:
+                record['rows_in'] = writeFieldStream([merged_fps[crz] for crz in merge_order], [merged_dtypes[crz] for crz in merge_order], ofile, file_format, uw_id, d_id, uw_time, uw_longitude, d_longitude, uw_latitude, d_latitude, cruises)
+    
+    else:
+        with fieldprofile.step(profiler, 'read underway') as record:
+            uw = fieldio.readTable(uw_fp, columns=uw_cols, fmt=file_format, schema=uw_schema, cruises=cruises, cruisename=uw_cruisename)
+            record['rows_out'] = len(uw)
+        with fieldprofile.step(profiler, 'merge', parallel=True) as record:
+            field = mergeFieldData(uw, d, uw_id, d_id, uw_cruisename, d_cruisename, uw_time, d_time, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, time_tolerance, amt_time_window, amt_radius, workers, cache, profiler, xbt, d_station, xbt_station, xbt_depth)
+            record['rows_in'] = len(uw) + len(d) + (len(xbt) if xbt is not None else 0)
+            record['rows_out'] = len(field)
+        
+        # Save out merged field data file:
+        with fieldprofile.step(profiler, 'write') as record:
+            fieldio.writeTable(field, ofile, fmt=file_format, cruisename='CruiseName', cruises=cruises)
+            record['rows_in'] = len(field)
+    
+    if cache is not None:
+        print(cache.report())
+    if profiler is not None:
+        profiler.save()
+
+def mergeFieldData(uw, d, uw_id, d_id, uw_cruisename, d_cruisename, uw_time, d_time, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, time_tolerance='5min', amt_time_window='6h', amt_radius=1.11, workers=1, cache=None, profiler=None, xbt=None, d_station='StationInfoID', xbt_station='StationInfoID', xbt_depth='Depth'):
     
-    # Read in Data:
-    uw = pd.read_csv(uw_fp)
-    d = pd.read_csv(d_fp)
+    import pandas as pd
+    import numpy as np
+    import fieldparallel
+    
+    # Merge Underway and field data for gnats cruises, and for amt cruises, and optionally XBT data by station.
+    # Merge data cruise by cruise, spreading the cruises over a process pool if there are several workers:
+    uw_crz_pos = fieldparallel.cruisePositions(uw, uw_cruisename)
+    d_crz_pos = fieldparallel.cruisePositions(d, d_cruisename)
+    no_rows = np.array([], dtype=int)
+    # Cruises found in the cache, if one is given, are not merged again.
+    crz_list = mergeCruiseOrder(uw_crz_pos.keys(), d_crz_pos.keys())
+    partitions = [(uw_crz_pos.get(crz, no_rows), d_crz_pos.get(crz, no_rows)) for crz in crz_list]
+    
+    # XBT records are placed in the cruises of their stations, and merged with each cruise as a third table:
+    if xbt is not None:
+        xbt = prepareXbt(xbt, d, xbt_station, d_station, d_cruisename)
+        xbt_crz_pos = fieldparallel.cruisePositions(xbt, d_cruisename)
+        partitions = [positions + (xbt_crz_pos.get(crz, no_rows),) for crz,positions in zip(crz_list, partitions)]
+        merged_cruise_dfs = fieldparallel.mapCruises(mergeCruiseXbt, (uw, d, xbt), partitions, workers, cache=cache, labels=crz_list, profiler=profiler, d_station=d_station, xbt_station=xbt_station, xbt_depth=xbt_depth, uw_id=uw_id, d_id=d_id, uw_cruisename=uw_cruisename, d_cruisename=d_cruisename, uw_time=uw_time, d_time=d_time, uw_longitude=uw_longitude, d_longitude=d_longitude, uw_latitude=uw_latitude, d_latitude=d_latitude, d_shallowest=d_shallowest, d_depth=d_depth, time_tolerance=time_tolerance, amt_time_window=amt_time_window, amt_radius=amt_radius)
+    else:
+        merged_cruise_dfs = fieldparallel.mapCruises(mergeCruise, (uw, d), partitions, workers, cache=cache, labels=crz_list, profiler=profiler, uw_id=uw_id, d_id=d_id, uw_cruisename=uw_cruisename, d_cruisename=d_cruisename, uw_time=uw_time, d_time=d_time, uw_longitude=uw_longitude, d_longitude=d_longitude, uw_latitude=uw_latitude, d_latitude=d_latitude, d_shallowest=d_shallowest, d_depth=d_depth, time_tolerance=time_tolerance, amt_time_window=amt_time_window, amt_radius=amt_radius)
+    
+    # No cruises (e.g. when --cruises matches none) make an empty table:
+    if len(merged_cruise_dfs) == 0:
+        merged_cruise_dfs = [pd.DataFrame(columns=['CruiseName', d_id, 'yyyy-mm-ddThh:mm:ss', d_time, d_latitude, d_longitude, uw_id, uw_time, uw_latitude, uw_longitude])]
+    
+    return finalizeFieldData(pd.concat(merged_cruise_dfs), uw_id, d_id, uw_time, uw_longitude, d_longitude, uw_latitude, d_latitude)
+
+def mergeCruiseOrder(uw_cruises, d_cruises):
     
-    # Turn datetime strings into pandas timestamps:
-    uw.loc[:, uw_time] = pd.to_datetime(uw[uw_time])
-    d.loc[:, d_time] = pd.to_datetime(d[d_time])
+    import numpy as np
     
     # Generate a list of all cruises to iterate through:
-    uw_cruises = [crz for crz in uw[uw_cruisename].unique()]
-    d_cruises = [crz for crz in d[d_cruisename].unique()]
-    crz_list = np.unique(uw_cruises + d_cruises)
+    crz_list = np.unique([crz for crz in uw_cruises] + [crz for crz in d_cruises])
     
-    # Generate a list of GNATS cruises, and a list of AMT cruises:
+    # Generate a list of GNATS cruises, and a list of AMT cruises. GNATS cruises are merged first:
     gnats_crz = [crz for crz in crz_list if crz[0]=='s']
     amt_crz = [crz for crz in crz_list if crz not in gnats_crz]
     
-    # Merge Underway and field data for gnats cruises, and for amt cruises.
-    # Merge data cruise by cruise:
-    merged_cruise_dfs = []    
-    for crz in gnats_crz:
-        uw_crz_df = uw.loc[uw[uw_cruisename]==crz]
-        d_crz_df = d.loc[d[d_cruisename]==crz]
-        merged_cruise_dfs.append(underwayDiscreteMergeGnats(uw_crz_df, d_crz_df, uw_time, d_time, uw_cruisename, d_cruisename))
+    return gnats_crz + amt_crz
+
+def mergeCruise(uw_crz_df, d_crz_df, uw_id, d_id, uw_cruisename, d_cruisename, uw_time, d_time, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, time_tolerance='5min', amt_time_window='6h', amt_radius=1.11, matches=None, xbt_crz_df=None, d_station='StationInfoID', xbt_station='StationInfoID', xbt_depth='Depth'):
     
-    for crz in amt_crz:
-        merged_cruise_dfs.append(underwayDiscreteMergeAMT(uw.loc[uw[uw_cruisename]==crz], d.loc[d[d_cruisename]==crz], uw_id, d_id, uw_time, d_time, uw_cruisename, d_cruisename, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth))
+    crz = uw_crz_df[uw_cruisename].iloc[0] if len(uw_crz_df) > 0 else d_crz_df[d_cruisename].iloc[0]
     
-        
-    field = pd.concat(merged_cruise_dfs)
-    field.sort_values(by=['yyyy-mm-ddThh:mm:ss', uw_time], inplace=True, ignore_index=True)
+    # XBT records (as prepared by prepareXbt) are joined to the discrete datapoints of the same station, at the nearest depth:
+    xbt = None
+    if xbt_crz_df is not None:
+        xbt_match = xbtStationMatch(d_crz_df[d_station], d_crz_df[d_depth], xbt_crz_df[xbt_station], xbt_crz_df[xbtColumn(xbt_depth)])
+        xbt = (xbt_crz_df.drop(columns=[xbt_station, d_cruisename]), xbt_match)
     
-    # Combine Underway lat/lons with discrete lat/lons. If a discrete lat/lon exists, report it. Otherwise, fill with underway coordinates.
-    field[d_latitude] = field[d_latitude].fillna(field[uw_latitude])
-    field[d_longitude] = field[d_longitude].fillna(field[uw_longitude])
+    # GNATS cruises are merged by nearest time, AMT cruises by nearest time and position:
+    if crz[0]=='s':
+        return underwayDiscreteMergeGnats(uw_crz_df, d_crz_df, uw_time, d_time, uw_cruisename, d_cruisename, time_tolerance, matches, xbt)
+    else:
+        return underwayDiscreteMergeAMT(uw_crz_df, d_crz_df, uw_id, d_id, uw_time, d_time, uw_cruisename, d_cruisename, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, amt_time_window, amt_radius, matches, xbt)
+
+def mergeCruiseXbt(uw_crz_df, d_crz_df, xbt_crz_df, **kwargs):
     
-    # Create a universal id which will be used in the matchup process:
-    data_ids = [crz + '_' + str(uwid).split(sep='.')[0] if np.isnan(uwid)==False else crz + '_' + str(did).split(sep='.')[0] for crz,uwid,did in zip(field['CruiseName'],field[uw_id],field[d_id])]
-    field.insert(0,'ID',data_ids)
-        
-    # Save out merged field data file:
-    field.to_csv(ofile, index=False)
-        
-def underwayDiscreteMergeGnats(uw_crz_df, d_crz_df, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col):
+    # mergeCruise with the XBT records of the cruise as a third table, for fieldparallel.mapCruises and streamCruises:
+    return mergeCruise(uw_crz_df, d_crz_df, xbt_crz_df=xbt_crz_df, **kwargs)
+
+def prepareXbt(xbt, d, xbt_station, d_station, d_cruisename):
     
     import pandas as pd
-    import numpy as np
     
-    crz = uw_crz_df[uw_cruisename_col].unique()[0]
+    # XBT files carry no cruise name: each XBT record takes the cruise of the discrete station with the same station id, looked up in a hash table of the discrete stations.
+    # All XBT columns but the station id are prefixed with XBT (e.g. XBTTemperature1), so that they are kept apart from the discrete columns.
+    station_cruise = pd.Series(d[d_cruisename].astype(str).to_numpy(), index=d[d_station].to_numpy())
+    station_cruise = station_cruise[station_cruise.index.notna()]
+    station_cruise = station_cruise[~station_cruise.index.duplicated()]
+    
+    xbt = xbt.rename(columns={col:xbtColumn(col) for col in xbt.columns if col != xbt_station})
+    xbt_crz = station_cruise.reindex(xbt[xbt_station].to_numpy()).to_numpy()
     
-    # Drop Cruisename column:
-    uw_crz_df = uw_crz_df.drop(columns = uw_cruisename_col)
-    d_crz_df = d_crz_df.drop(columns = d_cruisename_col)
+    # XBT records of stations without discrete data cannot be placed in a cruise, and are left out:
+    has_crz = pd.notna(xbt_crz)
+    if not has_crz.all():
+        print('{} XBT records of {} stations without discrete data are left out.'.format((~has_crz).sum(), xbt.loc[~has_crz, xbt_station].nunique()))
+    xbt = xbt.loc[has_crz].reset_index(drop=True)
+    xbt.insert(0, d_cruisename, xbt_crz[has_crz])
     
-    # Ensure Datetime Columns are pandas timestamps, not strings:
-    uw_crz_df.loc[:, uw_time_col] = pd.to_datetime(uw_crz_df[uw_time_col])
-    d_crz_df.loc[:, d_time_col] = pd.to_datetime(d_crz_df[d_time_col])
+    return xbt
+
+def xbtColumn(col):
+    
+    return 'XBT' + col
+
+def xbtStationMatch(d_stations, d_depths, xbt_stations, xbt_depths):
     
-    # Create Matching Datetime column in underway and discrete dataframes, so that when we merge, this column will populate with both underway and discrete datetimes:
-    uw_crz_df['yyyy-mm-ddThh:mm:ss'] = uw_crz_df[uw_time_col]
-    d_crz_df.insert(1, 'yyyy-mm-ddThh:mm:ss', d_crz_df[d_time_col])
+    import numpy as np
+    import pandas as pd
     
-    uw_nearest_idx = []
-    d_nearest_idx = []
+    # For every discrete datapoint, find the position of the XBT record of the same station that is nearest in depth (-1 if there is none).
+    # The stations are hash joined, so only the pairs of records of the same station are compared. Equally near records go to the first one in the XBT table.
+    d_pos = np.flatnonzero(pd.notna(d_stations).to_numpy())
+    xbt_pos = np.flatnonzero(pd.notna(xbt_stations).to_numpy())
+    pairs = pd.merge(pd.DataFrame({'station':d_stations.to_numpy()[d_pos], 'd':d_pos}), pd.DataFrame({'station':xbt_stations.to_numpy()[xbt_pos], 'xbt':xbt_pos}), on='station')
+    pair_d = pairs['d'].to_numpy()
+    pair_xbt = pairs['xbt'].to_numpy()
+    pair_dz = np.abs(d_depths.to_numpy(dtype=float, na_value=np.nan)[pair_d] - xbt_depths.to_numpy(dtype=float, na_value=np.nan)[pair_xbt])
+    
+    # Pairs without both depths are not matched:
+    finite = np.isfinite(pair_dz)
+    pair_d, pair_xbt, pair_dz = pair_d[finite], pair_xbt[finite], pair_dz[finite]
+    
+    order = np.lexsort((pair_xbt, pair_dz, pair_d))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pair_d[order][1:] != pair_d[order][:-1]
+    
+    xbt_match = np.full(len(d_stations), -1)
+    xbt_match[pair_d[order][first]] = pair_xbt[order][first]
+    return xbt_match
+
+def sweepCruise(uw_crz_df, d_crz_df, uw_id, d_id, uw_cruisename, d_cruisename, uw_time, d_time, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, time_tolerances=('5min',), amt_time_windows=('6h',), amt_radii=(1.11,), merged=False):
     
-    for idx in d_crz_df.index:
+    import pandas as pd
+    import numpy as np
+    import fieldschema
+    
+    # Match one cruise for every point of a tolerance grid: the time tolerances for a GNATS cruise, the time windows x radii for an AMT cruise.
+    # The candidate matches are searched once, at the largest tolerances of the grid, and each grid point keeps the best candidate within its own tolerances.
+    # Returns the matched pairs of every grid point, the number of samples that could be matched, and (if merged is True) the merged cruise of every grid point.
+    crz = uw_crz_df[uw_cruisename].iloc[0] if len(uw_crz_df) > 0 else d_crz_df[d_cruisename].iloc[0]
+    uw_times = fieldschema.parseTimes(uw_crz_df[uw_time])
+    d_times = fieldschema.parseTimes(d_crz_df[d_time])
+    grid = {}
+    
+    if crz[0]=='s':
+        program = 'gnats'
+        samples = np.arange(len(d_crz_df))
         
-        # Calculate the delta time for current discrete data point to all underway datapoints:
-        delta_dts = abs(uw_crz_df[uw_time_col] - d_crz_df[d_time_col].loc[idx])
+        # The nearest underway record does not depend on the tolerance, so each tolerance keeps the nearest records that are close enough in time:
+        best_pos, best_dt = nearestTimeMatch(uw_times, d_times, max(time_tolerances, key=pd.Timedelta))
+        best_dt = np.asarray(best_dt, dtype='timedelta64[ns]').view('int64')
+        for tolerance in time_tolerances:
+            grid[(tolerance, np.nan)] = np.where((best_pos >= 0) & (best_dt <= pd.Timedelta(tolerance).value), best_pos, -1)
+    
+    else:
+        program = 'amt'
+        samples = np.flatnonzero(((d_crz_df[d_shallowest]==1)&(d_crz_df[d_depth]<=10)).to_numpy())
+        surf = d_crz_df.iloc[samples]
         
-        # If there are some underway data points are within 5 minutes of the current discrete datapoint:
-        # Save the index of the underway datapoint with the smallest time delta.
-        if len(delta_dts.loc[delta_dts <= pd.Timedelta('5min')]) > 0:
-            uw_idx = delta_dts.loc[delta_dts <= pd.Timedelta('5min')].idxmin()
-            uw_nearest_idx.append(uw_idx)
-            d_nearest_idx.append(idx)
+        # All candidate pairs within the largest time window and radius:
+        pairs = list(spaceTimeCandidates(uw_times, uw_crz_df[uw_latitude], uw_crz_df[uw_longitude], d_times.iloc[samples], surf[d_latitude], surf[d_longitude], max(amt_time_windows, key=pd.Timedelta), max(amt_radii)))
+        pair_d, pair_uw, pair_dt, pair_dist = [np.concatenate([batch[i] for batch in pairs]) for i in range(4)] if len(pairs) > 0 else [np.array([], dtype=int)]*3 + [np.array([])]
         
-    # Partition the underway and discrete data in nearest vs. non-nearest data:
-    uw_nearest = uw_crz_df.loc[uw_crz_df.index.isin(uw_nearest_idx)]
-    d_nearest = d_crz_df.loc[d_crz_df.index.isin(d_nearest_idx)]
+        # For each radius, the best candidate of each sample within that radius. Each time window then keeps the best candidates that are close enough in time,
+        # which are the ones spaceTimeMatch would have picked with that window and radius.
+        for radius in amt_radii:
+            best_pos = np.full(len(samples), -1)
+            best_dt = np.zeros(len(samples), dtype='int64')
+            near = pair_dist <= radius
+            if near.any():
+                first = bestCandidates(pair_d[near], pair_uw[near], pair_dt[near], pair_dist[near])
+                best_pos[pair_d[near][first]] = pair_uw[near][first]
+                best_dt[pair_d[near][first]] = pair_dt[near][first]
+            for window in amt_time_windows:
+                grid[(window, radius)] = np.where((best_pos >= 0) & (best_dt <= pd.Timedelta(window).value), best_pos, -1)
+    
+    # The matched pairs of every grid point, with their time and distance offsets:
+    uw_ns = np.asarray(uw_times, dtype='datetime64[ns]').view('int64')
+    d_ns = np.asarray(d_times, dtype='datetime64[ns]').view('int64')
+    matches = []
+    for (tolerance, radius),pos in grid.items():
+        hit = pos >= 0
+        d_pos = samples[hit]
+        uw_pos = pos[hit]
+        matches.append(pd.DataFrame({'CruiseName':str(crz), 'program':program, 'time_tolerance':tolerance, 'radius_km':radius,
+                                     d_id:d_crz_df[d_id].to_numpy()[d_pos], uw_id:uw_crz_df[uw_id].to_numpy()[uw_pos],
+                                     'dt_s':np.abs(uw_ns[uw_pos] - d_ns[d_pos])/1e9,
+                                     'distance_km':greatCircleDistance(d_crz_df[d_latitude].to_numpy(dtype=float)[d_pos], d_crz_df[d_longitude].to_numpy(dtype=float)[d_pos], uw_crz_df[uw_latitude].to_numpy(dtype=float)[uw_pos], uw_crz_df[uw_longitude].to_numpy(dtype=float)[uw_pos])}))
+    matches = pd.concat(matches, ignore_index=True)
+    samples = pd.DataFrame({'CruiseName':[str(crz)], 'program':[program], 'n_samples':[len(samples)]})
+    
+    # The merged cruise of every grid point, from the grid point's matches:
+    merged_crz = None
+    if merged:
+        merged_crz = {sweepLabel(program, tolerance, radius):mergeCruise(uw_crz_df, d_crz_df, uw_id, d_id, uw_cruisename, d_cruisename, uw_time, d_time, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, matches=pos) for (tolerance, radius),pos in grid.items()}
+    
+    return matches, samples, merged_crz
 
-    uw_unmatched = uw_crz_df.loc[~uw_crz_df.index.isin(uw_nearest_idx)]
-    d_unmatched = d_crz_df.loc[~d_crz_df.index.isin(d_nearest_idx)]
+def sweepSummary(matches, samples, uw_id, time_tolerances, amt_time_windows, amt_radii):
+    
+    import pandas as pd
+    import numpy as np
+    
+    # One row per cruise and grid point, plus one row per program (CruiseName ALL) and grid point over all its cruises:
+    # the number of samples that could be matched (all discrete samples for GNATS, surface samples for AMT), how many were matched, to how many underway records,
+    # and the distribution of the time (s) and distance (km) offsets of the matches.
+    grid = pd.DataFrame([('gnats', tolerance, np.nan) for tolerance in time_tolerances] + [('amt', window, radius) for radius in amt_radii for window in amt_time_windows], columns=['program', 'time_tolerance', 'radius_km'])
+    every = pd.concat([samples, samples.groupby('program', as_index=False, sort=False)['n_samples'].sum().assign(CruiseName='ALL')], ignore_index=True)
+    matches = pd.concat([matches, matches.assign(CruiseName='ALL')], ignore_index=True)
+    summary = every.merge(grid, on='program')
+    
+    keys = ['CruiseName', 'program', 'time_tolerance', 'radius_km']
+    groups = matches.groupby(keys, dropna=False)
+    stats = pd.concat([groups.size().rename('n_matched'),
+                       groups[uw_id].nunique().rename('n_uw_matched'),
+                       groups['dt_s'].agg(['mean', 'median', lambda dt: dt.quantile(0.9), 'max']).set_axis(['dt_mean_s', 'dt_median_s', 'dt_p90_s', 'dt_max_s'], axis=1),
+                       groups['distance_km'].agg(['mean', 'median', lambda dist: dist.quantile(0.9), 'max']).set_axis(['distance_mean_km', 'distance_median_km', 'distance_p90_km', 'distance_max_km'], axis=1)], axis=1).reset_index()
+    summary = summary.merge(stats, on=keys, how='left')
+    summary[['n_matched', 'n_uw_matched']] = summary[['n_matched', 'n_uw_matched']].fillna(0).astype(int)
+    summary.insert(summary.columns.get_loc('n_matched') + 1, 'match_fraction', summary['n_matched']/summary['n_samples'].where(summary['n_samples'] > 0))
+    
+    return summary
 
-    # Apply merge as of with a 5 minute time tolerance to the nearest data subsets:
-    nearest_merge = pd.merge_asof(d_nearest, uw_nearest, on='yyyy-mm-ddThh:mm:ss', direction='nearest', allow_exact_matches=True)
+def writeSweep(matches, samples, sweep_fp, sweep_matches_fp, file_format, uw_id, time_tolerances, amt_time_windows, amt_radii):
+    
+    import fieldio
+    
+    summary = sweepSummary(matches, samples, uw_id, time_tolerances, amt_time_windows, amt_radii)
+    fieldio.writeTable(summary, sweep_fp, fmt=file_format)
+    if sweep_matches_fp is not None:
+        fieldio.writeTable(matches, sweep_matches_fp, fmt=file_format)
+    
+    # Print the totals of every grid point, e.g. to pick the tolerances from the job log:
+    print(summary.loc[summary['CruiseName'] == 'ALL', ['program', 'time_tolerance', 'radius_km', 'n_samples', 'n_matched', 'dt_median_s', 'distance_median_km']].to_string(index=False))
 
-    # Apply a regular merge to the rest of the data:
-    unmatched_merge = pd.merge(d_unmatched, uw_unmatched, how='outer', on='yyyy-mm-ddThh:mm:ss')
+def sweepFile(merged_dir, label, file_format, sweep_fp):
+    
+    import os
+    
+    # Merged field data of one grid point, in the format of the sweep summary file:
+    ext = '.' + file_format if file_format is not None else os.path.splitext(sweep_fp)[1]
+    os.makedirs(merged_dir, exist_ok=True)
+    return os.path.join(merged_dir, label + ext)
 
-    # Concat the nearest and unmatched merged dataframes into a single merged dataframe.
-    # Sort by merged datetime column (which contains both underway and discrete datetimes).
-    gnats_field = pd.concat([nearest_merge, unmatched_merge])
-    gnats_field.sort_values(['yyyy-mm-ddThh:mm:ss'], inplace=True, ignore_index=True)
+def sweepLabel(program, tolerance, radius):
     
-    gnats_field.insert(0, 'CruiseName', crz)
+    import numpy as np
+    
+    # File name stem of the merged field data of one grid point, e.g. gnats_5min or amt_6h_1.11km:
+    return program + '_' + str(tolerance) if np.isnan(radius) else '{}_{}_{}km'.format(program, tolerance, radius)
 
-    return gnats_field        
-        
+def finalizeFieldData(field, uw_id, d_id, uw_time, uw_longitude, d_longitude, uw_latitude, d_latitude):
     
-def underwayDiscreteMergeAMT(uw_crz_df, d_crz_df, uw_id_col, d_id_col, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col, uw_longitude_col, d_longitude_col, uw_latitude_col, d_latitude_col, d_shallowest_col, d_depth_col):
+    import fieldschema
     
-    crz = uw_crz_df[uw_cruisename_col].unique()[0]
+    field = field.sort_values(by=['yyyy-mm-ddThh:mm:ss', uw_time], ignore_index=True)
     
-    # Drop Cruisename column:
-    uw_crz_df = uw_crz_df.drop(columns = uw_cruisename_col)
-    d_crz_df = d_crz_df.drop(columns = d_cruisename_col)
+    # Combine Underway lat/lons with discrete lat/lons. If a discrete lat/lon exists, report it. Otherwise, fill with underway coordinates.
+    field[d_latitude] = field[d_latitude].fillna(field[uw_latitude])
+    field[d_longitude] = field[d_longitude].fillna(field[uw_longitude])
+    
+    # Create a universal id which will be used in the matchup process: cruise name and underway id, or cruise name and discrete id for rows without an underway id.
+    data_ids = fieldschema.idStrings(field[uw_id]).where(field[uw_id].notna(), fieldschema.idStrings(field[d_id]))
+    field.insert(0,'ID',field['CruiseName'].astype(str) + '_' + data_ids)
     
-    # Ensure Datetime Columns are pandas timestamps, not strings:
-    uw_crz_df[uw_time_col] = pd.to_datetime(uw_crz_df[uw_time_col])
-    d_crz_df[d_time_col] = pd.to_datetime(d_crz_df[d_time_col])
+    return field
+
+def writeFieldStream(merged_fps, merged_dtypes, ofile, file_format, uw_id, d_id, uw_time, uw_longitude, d_longitude, uw_latitude, d_latitude, cruises=None):
+    
+    import os
+    import fieldio
+    
+    # Interleave the spilled, merged cruises by time into the merged field data file, chunk by chunk.
+    # merged_fps and merged_dtypes must be in the order the cruises are concatenated in memory (mergeCruiseOrder), so that rows with equal timestamps keep the same order.
+    # Every chunk is given all columns of all cruises, in the same order as the in-memory concatenation. Returns the number of rows written.
+    # To a dataset, only the partitions of the cruises matching cruises are replaced.
+    dtypes = fieldio.commonDtypes(merged_dtypes)
+    writer = fieldio.TableWriter(ofile, file_format, 'CruiseName', cruises)
+    n_rows = 0
+    for field_chunk in fieldio.mergeSortedSpills([fp for fp in merged_fps if os.path.exists(fp)], 'yyyy-mm-ddThh:mm:ss', dtypes):
+        field_chunk = field_chunk.reindex(columns=list(dtypes))
+        writer.write(finalizeFieldData(field_chunk, uw_id, d_id, uw_time, uw_longitude, d_longitude, uw_latitude, d_latitude))
+        n_rows += len(field_chunk)
+    writer.close()
+    
+    return n_rows
+
+def underwayDiscreteMergeGnats(uw_crz_df, d_crz_df, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col, time_tolerance='5min', matches=None, xbt=None):
+    
+    import fieldschema
+    
+    crz = uw_crz_df[uw_cruisename_col].unique()[0] if len(uw_crz_df) > 0 else d_crz_df[d_cruisename_col].unique()[0]
+    
+    # Ensure Datetime Columns are pandas timestamps, not strings. Timestamps parsed when the tables were read are left as they are:
+    uw_times = fieldschema.parseTimes(uw_crz_df[uw_time_col])
+    d_times = fieldschema.parseTimes(d_crz_df[d_time_col])
+    
+    # For every discrete datapoint, find the position of the underway datapoint with the smallest time delta within the time tolerance (unless the matches are given, as by a tolerance sweep):
+    if matches is None:
+        uw_nearest_pos, _ = nearestTimeMatch(uw_times, d_times, time_tolerance)
+    else:
+        uw_nearest_pos = matches
+    
+    # Pair each nearest discrete datapoint with its underway datapoint (several discrete datapoints may share one underway datapoint), and merge the rest of the data on equal timestamps:
+    return assembleCruise(crz, uw_crz_df, d_crz_df, uw_nearest_pos, uw_times, d_times, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col, xbt)
+
+def nearestTimeMatch(uw_times, d_times, time_tolerance='5min'):
+    
+    import pandas as pd
+    import numpy as np
+    
+    # Work in integer nanoseconds, leaving out underway timestamps that are null:
+    nat = np.iinfo('int64').min
+    uw_ns = np.asarray(pd.to_datetime(uw_times), dtype='datetime64[ns]').view('int64')
+    d_ns = np.asarray(pd.to_datetime(d_times), dtype='datetime64[ns]').view('int64')
+    tolerance = pd.Timedelta(time_tolerance).value
+    
+    uw_nearest_pos = np.full(len(d_ns), -1)
+    delta_dts = np.full(len(d_ns), nat)
+    valid_pos = np.flatnonzero(uw_ns != nat)
+    if len(valid_pos) == 0 or len(d_ns) == 0:
+        return uw_nearest_pos, pd.to_timedelta(delta_dts)
+    
+    # Sort the underway timestamps once. A stable sort keeps duplicate timestamps in their original order.
+    order = valid_pos[np.argsort(uw_ns[valid_pos], kind='stable')]
+    sorted_ns = uw_ns[order]
+    n = len(sorted_ns)
+    
+    # The nearest underway timestamp is either the first one at/after the discrete timestamp, or the last one before it.
+    # Of a run of duplicate timestamps, take the first, as idxmin would.
+    after = np.searchsorted(sorted_ns, d_ns, side='left')
+    has_after = after < n
+    has_before = after > 0
+    after = np.minimum(after, n - 1)
+    before = np.searchsorted(sorted_ns, sorted_ns[np.maximum(after - 1, 0)], side='left')
+    before = np.where(has_after, before, np.searchsorted(sorted_ns, sorted_ns[n - 1], side='left'))
+    
+    after_dt = np.where(has_after, sorted_ns[after] - d_ns, np.iinfo('int64').max)
+    before_dt = np.where(has_before, d_ns - sorted_ns[before], np.iinfo('int64').max)
+    
+    # Ties between the two candidates go to whichever underway row comes first, as idxmin would.
+    take_before = (before_dt < after_dt) | ((before_dt == after_dt) & (order[before] < order[after]))
+    nearest = np.where(take_before, order[before], order[after])
+    nearest_dt = np.where(take_before, before_dt, after_dt)
+    
+    # Only keep matches within the time tolerance:
+    within = (d_ns != nat) & (nearest_dt <= tolerance)
+    uw_nearest_pos[within] = nearest[within]
+    delta_dts[within] = nearest_dt[within]
+    
+    return uw_nearest_pos, pd.to_timedelta(delta_dts)
+
+def underwayDiscreteMergeAMT(uw_crz_df, d_crz_df, uw_id_col, d_id_col, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col, uw_longitude_col, d_longitude_col, uw_latitude_col, d_latitude_col, d_shallowest_col, d_depth_col, time_window='6h', radius=1.11, matches=None, xbt=None):
+    
+    import numpy as np
+    import fieldschema
     
-    # Create Matching Datetime column in underway and discrete dataframes, so that when we merge, this column will populate with both underway and discrete datetimes:
-    uw_crz_df['yyyy-mm-ddThh:mm:ss'] = uw_crz_df[uw_time_col]
-    d_crz_df.insert(1, 'yyyy-mm-ddThh:mm:ss', d_crz_df[d_time_col])
+    crz = uw_crz_df[uw_cruisename_col].unique()[0] if len(uw_crz_df) > 0 else d_crz_df[d_cruisename_col].unique()[0]
+    
+    # Ensure Datetime Columns are pandas timestamps, not strings. Timestamps parsed when the tables were read are left as they are:
+    uw_times = fieldschema.parseTimes(uw_crz_df[uw_time_col])
+    d_times = fieldschema.parseTimes(d_crz_df[d_time_col])
     
     # Partition discrete data into surface vs at depth based on Shallowest flag, and depth<=10.
-    surf = d_crz_df.loc[(d_crz_df[d_shallowest_col]==1)&(d_crz_df[d_depth_col]<=10)]
-    depth = d_crz_df.loc[~d_crz_df.index.isin(surf.index)]
+    is_surf = ((d_crz_df[d_shallowest_col]==1)&(d_crz_df[d_depth_col]<=10)).to_numpy()
+    surf = d_crz_df.loc[is_surf]
+    
+    # Match each surface sample to the underway record nearest in time, out of those within the time window (6 hours by default) and within the distance radius of the sample (unless the matches are given, as by a tolerance sweep):
+    if matches is None:
+        uw_nearest_pos, _, _ = spaceTimeMatch(uw_times, uw_crz_df[uw_latitude_col], uw_crz_df[uw_longitude_col], d_times.loc[is_surf], surf[d_latitude_col], surf[d_longitude_col], time_window, radius)
+    else:
+        uw_nearest_pos = matches
+    d_match = np.full(len(d_crz_df), -1)
+    d_match[np.flatnonzero(is_surf)] = uw_nearest_pos
+    
+    # Pair each matched surface sample with its underway record, and merge the rest of the data (including all samples at depth) on equal timestamps:
+    return assembleCruise(crz, uw_crz_df, d_crz_df, d_match, uw_times, d_times, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col, xbt)
+
+def assembleCruise(crz, uw_crz_df, d_crz_df, d_match, uw_times, d_times, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col, xbt=None):
+    
+    import pandas as pd
+    import numpy as np
+    
+    # Build the merged cruise from row positions into the discrete and underway data (-1 where a merged row has none):
+    #   - every matched discrete datapoint, in discrete order, with the underway datapoint it was matched to (d_match)
+    #   - the unmatched discrete and underway datapoints, outer joined on equal timestamps
+    # sorted by the merge timestamp. Each column is then gathered once from its positions, instead of merging, concatenating and sorting whole frames.
+    # xbt: optional (XBT table, position of the XBT record of every discrete datapoint), whose columns are gathered for the discrete datapoints in the same way.
+    d_matched = d_match >= 0
+    uw_matched = np.zeros(len(uw_crz_df), dtype=bool)
+    uw_matched[d_match[d_matched]] = True
+    d_rest = np.flatnonzero(~d_matched)
+    uw_rest = np.flatnonzero(~uw_matched)
+    
+    # Outer join of the unmatched datapoints on their timestamps, a hash join of positions only. Equal timestamps, and missing ones, are paired as in pd.merge:
+    outer = pd.merge(pd.DataFrame({'yyyy-mm-ddThh:mm:ss':d_times.iloc[d_rest].to_numpy(), 'd':d_rest}), pd.DataFrame({'yyyy-mm-ddThh:mm:ss':uw_times.iloc[uw_rest].to_numpy(), 'uw':uw_rest}), how='outer', on='yyyy-mm-ddThh:mm:ss')
+    merge_times = pd.concat([d_times.loc[d_matched].reset_index(drop=True), outer['yyyy-mm-ddThh:mm:ss']], ignore_index=True)
+    
+    # Sort by merge timestamp, with the same sort as the merged frames were sorted with:
+    order = merge_times.sort_values().index.to_numpy()
+    d_pos = np.concatenate([np.flatnonzero(d_matched), outer['d'].fillna(-1).to_numpy(dtype=int)])[order]
+    uw_pos = np.concatenate([d_match[d_matched], outer['uw'].fillna(-1).to_numpy(dtype=int)])[order]
+    
+    # Columns: the discrete columns with the merge timestamp second, then the underway columns. Names in both get the suffixes _x and _y, as in pd.merge.
+    d_cols = [col for col in d_crz_df.columns if col != d_cruisename_col]
+    uw_cols = [col for col in uw_crz_df.columns if col != uw_cruisename_col and col != 'yyyy-mm-ddThh:mm:ss']
+    both = set(d_cols) & set(uw_cols)
+    columns = {}
+    for i,col in enumerate(d_cols):
+        if i == 1:
+            columns['yyyy-mm-ddThh:mm:ss'] = merge_times.to_numpy()[order]
+        columns[col + '_x' if col in both else col] = takeRows(d_times if col == d_time_col else d_crz_df[col], d_pos)
+    if len(d_cols) < 2:
+        columns['yyyy-mm-ddThh:mm:ss'] = merge_times.to_numpy()[order]
+    for col in uw_cols:
+        columns[col + '_y' if col in both else col] = takeRows(uw_times if col == uw_time_col else uw_crz_df[col], uw_pos)
+    if xbt is not None:
+        xbt_crz_df, xbt_match = xbt
+        xbt_pos = np.where(d_pos >= 0, xbt_match[d_pos], -1)
+        for col in xbt_crz_df.columns:
+            columns[col] = takeRows(xbt_crz_df[col], xbt_pos)
+    
+    field = pd.DataFrame(columns)
+    field.insert(0, 'CruiseName', crz)
+    
+    return field
+
+def takeRows(values, positions):
+    
+    import numpy as np
+    import pandas as pd
+    
+    # Rows of a column at the given positions, missing where a position is -1. Columns are upcast as pd.merge would, e.g. int to float.
+    values = values.to_numpy() if isinstance(values.dtype, np.dtype) else values.array
+    return pd.api.extensions.take(values, positions, allow_fill=True)
+
+def spaceTimeMatch(uw_times, uw_latitudes, uw_longitudes, d_times, d_latitudes, d_longitudes, time_window='6h', radius=1.11, max_pairs=5000000):
+    
+    import pandas as pd
+    import numpy as np
+    
+    # For every discrete sample, find the position of the underway record nearest in time, out of those within the time window and within `radius` km (great-circle distance).
+    # Returns the positions (-1 where there is no match), the time differences, and the distances in km.
+    # Ties in time go to the nearer record, then to whichever underway row comes first.
+    nat = np.iinfo('int64').min
+    n_d = len(d_times)
+    uw_nearest_pos = np.full(n_d, -1)
+    delta_dts = np.full(n_d, nat)
+    distances = np.full(n_d, np.nan)
     
-    # Merge surface data with merge_asof and a time tolerance of 6 hours:
-    surf_merge = pd.merge_asof(surf, uw_crz_df, on='yyyy-mm-ddThh:mm:ss', direction='nearest', allow_exact_matches=True)
+    for pair_d, pair_uw, pair_dt, pair_dist in spaceTimeCandidates(uw_times, uw_latitudes, uw_longitudes, d_times, d_latitudes, d_longitudes, time_window, radius, max_pairs):
+        
+        # Keep the best candidate of each sample:
+        first = bestCandidates(pair_d, pair_uw, pair_dt, pair_dist)
+        uw_nearest_pos[pair_d[first]] = pair_uw[first]
+        delta_dts[pair_d[first]] = pair_dt[first]
+        distances[pair_d[first]] = pair_dist[first]
     
-    # Only Keep merged data if the underway and discrete gps coordinates are within 0.01 degrees of each other:
-    surf_merge = surf_merge.loc[((abs(surf_merge[d_longitude_col] - surf_merge[uw_longitude_col])<=0.01)&(abs(surf_merge[d_latitude_col] - surf_merge[uw_latitude_col])<=0.01))]
+    return uw_nearest_pos, pd.to_timedelta(delta_dts), distances
+
+def spaceTimeCandidates(uw_times, uw_latitudes, uw_longitudes, d_times, d_latitudes, d_longitudes, time_window='6h', radius=1.11, max_pairs=5000000):
+    
+    import pandas as pd
+    import numpy as np
     
-    # Collect all the discrete and underway data that did not get merged in the surface merge:
-    uw_unmatched = uw_crz_df.loc[~uw_crz_df[uw_id_col].isin(surf_merge[uw_id_col])]
-    d_unmatched = d_crz_df.loc[~d_crz_df[d_id_col].isin(surf_merge[d_id_col])]
+    # Every (discrete sample, underway record) pair within the time window and within `radius` km, as arrays of sample positions, underway positions, time differences (ns) and distances (km).
+    # The pairs come in batches, each holding all the pairs of its samples.
+    nat = np.iinfo('int64').min
+    uw_ns = np.asarray(pd.to_datetime(uw_times), dtype='datetime64[ns]').view('int64')
+    d_ns = np.asarray(pd.to_datetime(d_times), dtype='datetime64[ns]').view('int64')
+    uw_lat = np.asarray(uw_latitudes, dtype=float)
+    uw_lon = np.asarray(uw_longitudes, dtype=float)
+    d_lat = np.asarray(d_latitudes, dtype=float)
+    d_lon = np.asarray(d_longitudes, dtype=float)
+    window = pd.Timedelta(time_window).value
+    
+    # The index: underway records with a time and position, sorted by time. A stable sort keeps duplicate timestamps in their original order.
+    valid_pos = np.flatnonzero((uw_ns != nat) & np.isfinite(uw_lat) & np.isfinite(uw_lon))
+    order = valid_pos[np.argsort(uw_ns[valid_pos], kind='stable')]
+    sorted_ns = uw_ns[order]
+    
+    # The records within the time window of each sample are one contiguous run of the index:
+    d_valid = (d_ns != nat) & np.isfinite(d_lat) & np.isfinite(d_lon)
+    lo = np.searchsorted(sorted_ns, np.where(d_valid, d_ns - window, 0), side='left')
+    hi = np.searchsorted(sorted_ns, np.where(d_valid, d_ns + window, 0), side='right')
+    counts = np.where(d_valid, hi - lo, 0)
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    
+    # Query the samples in batches of at most max_pairs candidate pairs (or one sample, if it alone has more), to bound memory on long transects:
+    start = 0
+    while start < len(d_ns):
+        
+        stop = max(start + 1, np.searchsorted(bounds, bounds[start] + max_pairs, side='right') - 1)
+        batch = np.arange(start, stop)
+        start = stop
+        
+        # Every (sample, underway record) candidate pair of the batch:
+        pair_d = np.repeat(batch, counts[batch])
+        pair_uw = order[lo[pair_d] + np.arange(len(pair_d)) - np.repeat(bounds[batch] - bounds[batch[0]], counts[batch])]
+        pair_dt = np.abs(uw_ns[pair_uw] - d_ns[pair_d])
+        pair_dist = greatCircleDistance(d_lat[pair_d], d_lon[pair_d], uw_lat[pair_uw], uw_lon[pair_uw])
+        
+        within = pair_dist <= radius
+        if within.any():
+            yield pair_d[within], pair_uw[within], pair_dt[within], pair_dist[within]
+
+def bestCandidates(pair_d, pair_uw, pair_dt, pair_dist):
     
-    # Merge the unmatched underway and discrete data:
-    unmatched_merge = pd.merge(d_unmatched, uw_unmatched, how='outer', on='yyyy-mm-ddThh:mm:ss')
+    import numpy as np
     
-    # Concat the surface and unmatched merged dataframes into a single merged dataframe:
-    amt_field = pd.concat([surf_merge, unmatched_merge])
-    amt_field.sort_values('yyyy-mm-ddThh:mm:ss', inplace=True, ignore_index=True)
+    # Index of the best pair of each sample: nearest in time, then nearest in distance, then the first underway row.
+    best = np.lexsort((pair_uw, pair_dist, pair_dt, pair_d))
+    return best[np.concatenate([[True], pair_d[best][1:] != pair_d[best][:-1]])]
+
+def greatCircleDistance(lat1, lon1, lat2, lon2):
     
-    amt_field.insert(0, 'CruiseName', crz)
+    import numpy as np
     
-    return amt_field
+    # Haversine distance in km:
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*6371.0088*np.arcsin(np.sqrt(np.minimum(a, 1)))
 
 if __name__ == "__main__": main()  
\ No newline at end of file
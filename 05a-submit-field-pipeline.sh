@@ -0,0 +1,20 @@
+#!/bin/bash
+
+#PBS -N field-pipeline
+#PBS -q route
+
+#PBS -l ncpus=32,mem=256gb
+#PBS -l walltime=4:00:00
+#PBS -o /mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow/logs
+#PBS -e /mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow/logs
+
+# Load modules and environment
+module use /mod/bigelow
+module load anaconda3
+source activate ~/sunnysenv
+
+scriptDir=/mnt/storage/labs/mitchell/spinkham/gitHubRepos/cms_dev/field-workflow
+dataDir=/mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow
+
+# Runs 03b, 03c and 04b in one process. Add --ofileShiftedData/--ofileAveragedBB to also save the 01c/01d intermediates.
+python $scriptDir/05b-run-field-pipeline.py --uwFile $dataDir/01b-underway-formatted-gnats.csv --discreteFile $dataDir/02b-discrete-formatted-gnats.csv --bbcycleParametersFile $dataDir/x01-pH-cycle-duration-limits-dict.pickle --uwIdCol UWid --discreteIdCol StationDataID --uwCruiseNameCol CruiseName --discreteCruiseNameCol CruiseName --uwTimeCol UWTime --discreteTimeCol StationTime --uwLongitudeCol UWLongitude --discreteLongitudeCol Longitude --uwLatitudeCol UWLatitude --discreteLatitudeCol Latitude --discreteShallowestCol Shallowest --discreteDepthCol Depth --numSamplesCol numSamples --bbtotCol bbtot532 --bbtotStdCol bbtot532Std --bbacidCol bbacid --bbacidStdCol bbacidStd --bbprimeCol bbprime --bbprimeStdCol bbprimeStd --ofileFieldData $dataDir/04-merged-field-data.csv --workers 32 --profile $dataDir/logs/05b-run-field-pipeline-profile.json
\ No newline at end of file
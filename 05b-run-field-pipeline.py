@@ -0,0 +1,418 @@
+def main():
+    
+    import pickle
+    import argparse
+    import tempfile
+    import os
+    import pandas as pd
+    import fieldio
+    import fieldschema
+    import fieldcache
+    import fieldparallel
+    import fieldprofile
+    import bbkernels
+    
+    parser = argparse.ArgumentParser(description='''\
+    This script runs the bb shift (03b), bb average (03c), and field merge (04b) stages in a single process. The underway data is carried through all three stages in memory, one cruise at a time, and only the merged field data is written out unless intermediate output files are requested.''')
+    
+    parser.add_argument('--uwFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the formatted underway file.''')
+    
+    parser.add_argument('--discreteFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the formatted discrete file.''')
+    
+    parser.add_argument('--bbcycleParametersFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the python dictionary pickle file containing acceptable bb cycling durations on a per cruise basis.''')
+    
+    parser.add_argument('--uwIdCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway ids.''')
+    
+    parser.add_argument('--discreteIdCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete ids.''')
+    
+    parser.add_argument('--uwCruiseNameCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway cruisenames.''')
+    
+    parser.add_argument('--discreteCruiseNameCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete cruisenames.''')
+    
+    parser.add_argument('--uwTimeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway timestamps.''')
+    
+    parser.add_argument('--discreteTimeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete timestamps.''')
+    
+    parser.add_argument('--uwLongitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway longitudes.''')
+    
+    parser.add_argument('--discreteLongitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete longitudes.''')
+    
+    parser.add_argument('--uwLatitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway latitudes.''')
+    
+    parser.add_argument('--discreteLatitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete latitudes.''')
+    
+    parser.add_argument('--discreteShallowestCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete station shallowest sample info.''')
+    
+    parser.add_argument('--discreteDepthCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete depths.''')
+    
+    parser.add_argument('--numSamplesCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the number of samples set for the bb cycling.''')
+    
+    parser.add_argument('--bbtotCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbtot data.''')
+    
+    parser.add_argument('--bbtotStdCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbtot error data.''')
+    
+    parser.add_argument('--bbacidCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbacid data.''')
+    
+    parser.add_argument('--bbacidStdCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbacid error data.''')
+    
+    parser.add_argument('--bbprimeCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbprime data.''')
+    
+    parser.add_argument('--bbprimeStdCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbprime error data.''')
+    
+    parser.add_argument('--timeTolerance', nargs=1, type=str, required=False, default=['5min'], help='''\
+    Maximum time difference allowed between a GNATS discrete sample and its nearest underway record, as a pandas timedelta string. Defaults to 5min.''')
+    
+    parser.add_argument('--amtTimeWindow', nargs=1, type=str, required=False, default=['6h'], help='''\
+    Maximum time difference allowed between an AMT surface sample and its underway match, as a pandas timedelta string. Defaults to 6h.''')
+    
+    parser.add_argument('--amtMatchRadius', nargs=1, type=float, required=False, default=[1.11], help='''\
+    Maximum great-circle distance in km allowed between an AMT surface sample and its underway match. Defaults to 1.11 km (0.01 degrees of latitude).''')
+    
+    parser.add_argument('--xbtFile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. XBT file (csv, parquet, or feather) to merge alongside the underway and discrete data, as 04b does. Each discrete datapoint is given the XBT record of its station nearest in depth, with the XBT columns prefixed XBT (e.g. XBTTemperature1).''')
+    
+    parser.add_argument('--xbtStationIdCol', nargs=1, type=str, required=False, default=['StationInfoID'], help='''\
+    Optional. Station id column of the XBT data. Defaults to StationInfoID.''')
+    
+    parser.add_argument('--discreteStationIdCol', nargs=1, type=str, required=False, default=['StationInfoID'], help='''\
+    Optional. Station id column of the discrete data, joined to the XBT station ids. XBT records take the cruise of their station. Defaults to StationInfoID.''')
+    
+    parser.add_argument('--xbtDepthCol', nargs=1, type=str, required=False, default=['Depth'], help='''\
+    Optional. Depth column of the XBT data. Defaults to Depth.''')
+    
+    parser.add_argument('--xbtTimeCol', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Time column of the XBT data, parsed into timestamps.''')
+    
+    parser.add_argument('--ofileFieldData', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of where to save merged field data. Must be csv, parquet, or feather, or a directory path ending in / for a dataset partitioned by cruise.''')
+    
+    parser.add_argument('--ofileShiftedData', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional, for debugging. Full path, name, and extension of where to save the bb-shifted underway data (the 03b output).''')
+    
+    parser.add_argument('--ofileAveragedBB', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional, for debugging. Full path, name, and extension of where to save the bb-averaged underway data (the 03c output).''')
+    
+    parser.add_argument('--seabassDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory to export the merged field data to as SeaBASS files, one per cruise (as 07b-export-seabass.py does). The data is flagged by the QC rules first (as 06b-qc-field-data.py does), so this needs --seabassSpecFile and --qcRulesFile. The merged field data file itself is written without flags.''')
+    
+    parser.add_argument('--seabassSpecFile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Full path, name, and extension of the json file describing the SeaBASS files, e.g. 07-seabass-export.json.''')
+    
+    parser.add_argument('--qcRulesFile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Full path, name, and extension of the json file of QC rules the SeaBASS export is flagged by, e.g. 06-qc-rules.json.''')
+    
+    parser.add_argument('--workers', nargs=1, type=int, required=False, default=[1], help='''\
+    Optional. Number of worker processes. Cruises are processed independently, so with more than 1 worker they are spread over a process pool. Defaults to 1.''')
+    
+    parser.add_argument('--cacheDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory of the per-cruise result cache. Cruises whose input rows and parameters have not changed since a previous run are read from the cache instead of being recomputed.''')
+    
+    parser.add_argument('--cacheMaxSize', nargs=1, type=float, required=False, default=[None], help='''\
+    Optional. Maximum size of the cache in GB. The least recently used results are evicted beyond this size.''')
+    
+    parser.add_argument('--chunksize', nargs=1, type=int, required=False, default=[None], help='''\
+    Optional. Streaming mode for underway files larger than memory: read the underway file this many rows at a time, spill the rows to disk by cruise, and process and write one cruise at a time.''')
+    
+    parser.add_argument('--spillDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory for the temporary per-cruise files of the streaming mode. Defaults to the system temporary directory.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--float32', action='store_true', help='''\
+    Optional. Store measurement columns (all float columns but latitude, longitude and depth) as float32 instead of float64, halving their memory.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each step and each cruise, with suggested PBS ncpus/mem values.''')
+    
+    parser.add_argument('--fileFormat', nargs=1, type=str, required=False, default=[None], choices=['csv', 'parquet', 'feather'], help='''\
+    Optional. Format of the input and output files. If not given, the format is inferred from each file extension.''')
+    
+    parser.add_argument('--cruises', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only process these cruises, given as cruise names or shell-style patterns (e.g. AMT2* s01??). Only their rows are read (only their partitions, from a dataset) and only their partitions of the output datasets are replaced. The outputs must be datasets.''')
+    
+    
+    args = parser.parse_args()
+    dict_args = vars(args)
+    
+    ### Define Dictionary Variables: ########################################
+    
+    uw_fp = dict_args['uwFile'][0]
+    d_fp = dict_args['discreteFile'][0]
+    xbt_fp = dict_args['xbtFile'][0]
+    xbt_time = dict_args['xbtTimeCol'][0]
+    cycle_fp = dict_args['bbcycleParametersFile'][0]
+    ofile = dict_args['ofileFieldData'][0]
+    ofile_shifted = dict_args['ofileShiftedData'][0]
+    ofile_avg_bb = dict_args['ofileAveragedBB'][0]
+    seabass_dir = dict_args['seabassDir'][0]
+    seabass_spec_fp = dict_args['seabassSpecFile'][0]
+    qc_rules_fp = dict_args['qcRulesFile'][0]
+    file_format = dict_args['fileFormat'][0]
+    workers = dict_args['workers'][0]
+    cache_dir = dict_args['cacheDir'][0]
+    cache_max_gb = dict_args['cacheMaxSize'][0]
+    chunksize = dict_args['chunksize'][0]
+    spill_dir = dict_args['spillDir'][0]
+    time_format = dict_args['timeFormat'][0]
+    use_float32 = dict_args['float32']
+    profile_fp = dict_args['profile'][0]
+    cruises = dict_args['cruises']
+    
+    # Outputs of the other cruises can only be left as they are in a dataset:
+    if cruises is not None and not all(fieldio.isDataset(fp) for fp in [ofile, ofile_shifted, ofile_avg_bb] if fp is not None):
+        parser.error('--cruises needs dataset outputs (directory paths ending in /), so that the other cruises are kept')
+    if (seabass_dir is None) != (seabass_spec_fp is None):
+        parser.error('--seabassDir and --seabassSpecFile must be given together')
+    if (seabass_dir is None) != (qc_rules_fp is None):
+        parser.error('--seabassDir needs --qcRulesFile, so that flagged data is not exported (and --qcRulesFile is only used by the SeaBASS export)')
+    
+    cols = {'uw_id':dict_args['uwIdCol'][0], 'd_id':dict_args['discreteIdCol'][0],
+            'uw_cruisename':dict_args['uwCruiseNameCol'][0], 'd_cruisename':dict_args['discreteCruiseNameCol'][0],
+            'uw_time':dict_args['uwTimeCol'][0], 'd_time':dict_args['discreteTimeCol'][0],
+            'uw_longitude':dict_args['uwLongitudeCol'][0], 'd_longitude':dict_args['discreteLongitudeCol'][0],
+            'uw_latitude':dict_args['uwLatitudeCol'][0], 'd_latitude':dict_args['discreteLatitudeCol'][0],
+            'd_shallowest':dict_args['discreteShallowestCol'][0], 'd_depth':dict_args['discreteDepthCol'][0],
+            'numsamples':dict_args['numSamplesCol'][0],
+            'bbtot':dict_args['bbtotCol'][0], 'bbtot_std':dict_args['bbtotStdCol'][0],
+            'bbacid':dict_args['bbacidCol'][0], 'bbacid_std':dict_args['bbacidStdCol'][0],
+            'bbprime':dict_args['bbprimeCol'][0], 'bbprime_std':dict_args['bbprimeStdCol'][0],
+            'time_tolerance':dict_args['timeTolerance'][0],
+            'amt_time_window':dict_args['amtTimeWindow'][0], 'amt_radius':dict_args['amtMatchRadius'][0],
+            'd_station':dict_args['discreteStationIdCol'][0], 'xbt_station':dict_args['xbtStationIdCol'][0], 'xbt_depth':dict_args['xbtDepthCol'][0]}
+    
+    ### Read in Data ###
+    
+    # Cruise names are read as categoricals and IDs as nullable integers; measurements optionally as float32.
+    measurement = (lambda col: col not in [cols['uw_longitude'], cols['uw_latitude'], cols['d_longitude'], cols['d_latitude'], cols['d_depth']]) if use_float32 else None
+    uw_schema = fieldschema.tableSchema(cruisename_cols=[cols['uw_cruisename']], id_cols=[cols['uw_id']], datetime_cols=[cols['uw_time']], float32=measurement, time_format=time_format)
+    d_schema = fieldschema.tableSchema(cruisename_cols=[cols['d_cruisename']], id_cols=[cols['d_id']], datetime_cols=[cols['d_time']], float32=measurement, time_format=time_format)
+    profiler = fieldprofile.openProfiler(profile_fp, '05b-run-field-pipeline', workers)
+    with fieldprofile.step(profiler, 'read discrete') as record:
+        d = fieldio.readTable(d_fp, fmt=file_format, schema=d_schema, cruises=cruises, cruisename=cols['d_cruisename'])
+        record['rows_out'] = len(d)
+    xbt = None
+    if xbt_fp is not None:
+        with fieldprofile.step(profiler, 'read xbt') as record:
+            xbt = fieldio.readTable(xbt_fp, fmt=file_format, datetime_cols=[xbt_time] if xbt_time is not None else None)
+            record['rows_out'] = len(xbt)
+    with open(cycle_fp, 'rb') as handle:
+        cycleDict = pickle.load(handle)
+    
+    ### Run the Stages: ###
+    
+    # Cached cruises depend on all three stages and the helpers they call, so a change to any of them recomputes every cruise:
+    stage_modules = [fieldparallel.loadStage(script) for script in ['03b-shift-bb-data.py', '03c-calculate-bbprime-average.py', '04b-merge-field-data.py']]
+    cache = fieldcache.openCache(cache_dir, '05b-run-field-pipeline', cache_max_gb, modules=stage_modules + [bbkernels, fieldschema])
+    keep_intermediates = (ofile_shifted is not None) or (ofile_avg_bb is not None)
+    
+    if chunksize is not None:
+        # Streaming mode: the underway file is read in chunks and spilled to disk by cruise. Cruises are then run through all stages one at a time.
+        # Intermediates are written as each cruise finishes; merged cruises are spilled again and finally interleaved by time into the merged field data file.
+        merge_stage = fieldparallel.loadStage('04b-merge-field-data.py')
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+            with fieldprofile.step(profiler, 'spill'):
+                spill_fps, dtypes = fieldio.spillByCruise(uw_fp, cols['uw_cruisename'], tmp_dir, chunksize, fmt=file_format, schema=uw_schema, cruises=cruises)
+            d_crz_pos = fieldparallel.cruisePositions(d, cols['d_cruisename'])
+            crz_list = list(spill_fps.keys()) + [crz for crz in d_crz_pos.keys() if crz not in spill_fps]
+            
+            # XBT records are placed in the cruises of their stations, and carried with each cruise as a third table:
+            cruise_func, tables, table_positions = runCruise, (d,), (d_crz_pos,)
+            if xbt is not None:
+                xbt = merge_stage.prepareXbt(xbt, d, cols['xbt_station'], cols['d_station'], cols['d_cruisename'])
+                cruise_func, tables, table_positions = runCruiseXbt, (d, xbt), (d_crz_pos, fieldparallel.cruisePositions(xbt, cols['d_cruisename']))
+            
+            shifted_writer = fieldio.TableWriter(ofile_shifted, file_format, cols['uw_cruisename'], cruises) if ofile_shifted is not None else None
+            averaged_writer = fieldio.TableWriter(ofile_avg_bb, file_format, cols['uw_cruisename'], cruises) if ofile_avg_bb is not None else None
+            merged_fps = {}
+            merged_dtypes = {}
+            with fieldprofile.step(profiler, 'run stages', parallel=True) as record:
+                for crz,(merged_crz_df, shifted_crz_df, averaged_crz_df) in fieldparallel.streamCruises(cruise_func, spill_fps, dtypes, workers, cache, crz_list=crz_list, tables=tables, table_positions=table_positions, profiler=profiler, cycleDict=cycleDict, cols=cols, keep_intermediates=keep_intermediates):
+                    if shifted_writer is not None and shifted_crz_df is not None:
+                        shifted_writer.write(shifted_crz_df)
+                    if averaged_writer is not None and averaged_crz_df is not None and crz in spill_fps:
+                        averaged_writer.write(averaged_crz_df)
+                    merged_fps[crz] = os.path.join(tmp_dir, 'merged{:05d}.pkl'.format(len(merged_fps)))
+                    merged_dtypes[crz] = fieldio.spillTable(merged_crz_df, merged_fps[crz], chunksize)
+                    record['rows_out'] = (record['rows_out'] or 0) + len(merged_crz_df)
+                for writer in [shifted_writer, averaged_writer]:
+                    if writer is not None:
+                        writer.close()
+            
+            merge_order = merge_stage.mergeCruiseOrder(spill_fps.keys(), d_crz_pos.keys())
+            with fieldprofile.step(profiler, 'write') as record:
+                record['rows_in'] = merge_stage.writeFieldStream([merged_fps[crz] for crz in merge_order], [merged_dtypes[crz] for crz in merge_order], ofile, file_format, cols['uw_id'], cols['d_id'], cols['uw_time'], cols['uw_longitude'], cols['d_longitude'], cols['uw_latitude'], cols['d_latitude'], cruises)
+            
+            # Flag the merged field data by the QC rules and export it to SeaBASS from the file just written, spilled again by cruise as in the streaming mode of 07b.
+            # Each cruise is flagged and exported by the same worker, so the flags are never written out:
+            if seabass_dir is not None:
+                qc_stage = fieldparallel.loadStage('06b-qc-field-data.py')
+                export_stage = fieldparallel.loadStage('07b-export-seabass.py')
+                rules = qc_stage.loadQcRules(qc_rules_fp)
+                spec = export_stage.loadSeaBASSSpec(seabass_spec_fp)
+                os.makedirs(seabass_dir, exist_ok=True)
+                available = fieldio.tableColumns(ofile, file_format)
+                export_cols = export_stage.exportColumns(spec, 'CruiseName', available)
+                export_stage.warnAbsent(spec, export_cols)
+                qc_cols = [col for col in qc_stage.ruleColumns(rules) if col in available]
+                qc_schema = fieldschema.tableSchema(cruisename_cols=['CruiseName'], datetime_cols=list(dict.fromkeys([spec['time']] + [rule['time'] for rule in rules if rule['time'] in available])), time_format=time_format)
+                export_dir = os.path.join(tmp_dir, 'seabass')
+                os.makedirs(export_dir)
+                with fieldprofile.step(profiler, 'qc and export seabass', parallel=True) as record:
+                    export_fps, export_dtypes = fieldio.spillByCruise(ofile, 'CruiseName', export_dir, chunksize, columns=list(dict.fromkeys(export_cols + qc_cols)), fmt=file_format, schema=qc_schema, cruises=cruises)
+                    results = [result for _,result in fieldparallel.streamCruises(exportCruiseQc, export_fps, export_dtypes, workers, profiler=profiler, rules=rules, ofile_dir=seabass_dir, spec=spec, cruisename='CruiseName')]
+                    qc_summary = qc_stage.qcSummary(export_fps.keys(), rules, [counts for _,counts in results])
+                    summary = export_stage.exportSummary(export_fps.keys(), [result for result,_ in results])
+                    record['rows_in'] = int(summary['rows_read'].sum())
+                    record['rows_out'] = int(summary['rows_written'].sum())
+                print(qc_stage.qcReport(qc_summary))
+                print(export_stage.seabassReport(summary, seabass_dir))
+        
+    else:
+        with fieldprofile.step(profiler, 'read underway') as record:
+            uw = fieldio.readTable(uw_fp, fmt=file_format, schema=uw_schema, cruises=cruises, cruisename=cols['uw_cruisename'])
+            record['rows_out'] = len(uw)
+        with fieldprofile.step(profiler, 'run stages', parallel=True) as record:
+            field, shifted_uw_df, acid_shifted_df = runFieldPipeline(uw, d, cycleDict, cols, keep_intermediates=keep_intermediates, workers=workers, cache=cache, profiler=profiler, xbt=xbt)
+            record['rows_in'] = len(uw) + len(d) + (len(xbt) if xbt is not None else 0)
+            record['rows_out'] = len(field)
+        
+        with fieldprofile.step(profiler, 'write') as record:
+            # Save out intermediate files, if requested:
+            if ofile_shifted is not None:
+                fieldio.writeTable(shifted_uw_df, ofile_shifted, fmt=file_format, cruisename=cols['uw_cruisename'], cruises=cruises)
+            if ofile_avg_bb is not None:
+                fieldio.writeTable(acid_shifted_df, ofile_avg_bb, fmt=file_format, cruisename=cols['uw_cruisename'], cruises=cruises)
+            
+            # Save out merged field data file:
+            fieldio.writeTable(field, ofile, fmt=file_format, cruisename='CruiseName', cruises=cruises)
+            record['rows_in'] = len(field)
+        
+        # Flag the merged field data by the QC rules as 06b does, and export it to SeaBASS straight from memory:
+        if seabass_dir is not None:
+            qc_stage = fieldparallel.loadStage('06b-qc-field-data.py')
+            export_stage = fieldparallel.loadStage('07b-export-seabass.py')
+            rules = qc_stage.loadQcRules(qc_rules_fp)
+            spec = export_stage.loadSeaBASSSpec(seabass_spec_fp)
+            os.makedirs(seabass_dir, exist_ok=True)
+            with fieldprofile.step(profiler, 'qc', parallel=True) as record:
+                flags, qc_summary = qc_stage.qcFieldData(field, 'CruiseName', rules, workers, profiler=profiler)
+                field = pd.concat([field.drop(columns=[col for col in flags.columns if col in field.columns]), flags], axis=1)
+                record['rows_in'] = len(field)
+                record['rows_out'] = len(flags)
+            print(qc_stage.qcReport(qc_summary))
+            with fieldprofile.step(profiler, 'export seabass', parallel=True) as record:
+                summary = export_stage.exportSeaBASS(field, seabass_dir, spec, 'CruiseName', workers, profiler)
+                record['rows_in'] = len(field)
+                record['rows_out'] = int(summary['rows_written'].sum())
+            print(export_stage.seabassReport(summary, seabass_dir))
+    
+    if cache is not None:
+        print(cache.report())
+    if profiler is not None:
+        profiler.save()
+
+#########################################################################
+
+def runFieldPipeline(uw, d, cycleDict, cols, keep_intermediates=False, workers=1, cache=None, profiler=None, xbt=None):
+    
+    import pandas as pd
+    import numpy as np
+    import fieldparallel
+    
+    merge_stage = fieldparallel.loadStage('04b-merge-field-data.py')
+    
+    uw_crz_pos = fieldparallel.cruisePositions(uw, cols['uw_cruisename'])
+    d_crz_pos = fieldparallel.cruisePositions(d, cols['d_cruisename'])
+    
+    # Carry each cruise through all three stages, spreading the cruises over a process pool if there are several workers.
+    # Cruises found in the cache, if one is given, are not processed again.
+    crz_list = merge_stage.mergeCruiseOrder(uw_crz_pos.keys(), d_crz_pos.keys())
+    no_rows = np.array([], dtype=int)
+    partitions = [(uw_crz_pos.get(crz, no_rows), d_crz_pos.get(crz, no_rows)) for crz in crz_list]
+    
+    # XBT records are placed in the cruises of their stations, and carried with each cruise as a third table:
+    cruise_func, tables = runCruise, (uw, d)
+    if xbt is not None:
+        xbt = merge_stage.prepareXbt(xbt, d, cols['xbt_station'], cols['d_station'], cols['d_cruisename'])
+        xbt_crz_pos = fieldparallel.cruisePositions(xbt, cols['d_cruisename'])
+        partitions = [positions + (xbt_crz_pos.get(crz, no_rows),) for crz,positions in zip(crz_list, partitions)]
+        cruise_func, tables = runCruiseXbt, (uw, d, xbt)
+    crz_results = fieldparallel.mapCruises(cruise_func, tables, partitions, workers, cache=cache, labels=crz_list, profiler=profiler, cycleDict=cycleDict, cols=cols, keep_intermediates=keep_intermediates)
+    
+    field = merge_stage.finalizeFieldData(pd.concat([merged for merged,_,_ in crz_results]), cols['uw_id'], cols['d_id'], cols['uw_time'], cols['uw_longitude'], cols['d_longitude'], cols['uw_latitude'], cols['d_latitude'])
+    
+    # Intermediates are ordered by cruise as they would be by 03b and 03c:
+    if keep_intermediates:
+        crz_results = dict(zip(crz_list, crz_results))
+        shifted_uw_df = pd.concat([crz_results[crz][1] for crz in uw_crz_pos.keys()])
+        acid_shifted_df = pd.concat([crz_results[crz][2] for crz in uw_crz_pos.keys()])
+        return field, shifted_uw_df, acid_shifted_df
+    
+    return field, None, None
+
+def runCruise(uw_crz_df, d_crz_df, cycleDict, cols, keep_intermediates=False, xbt_crz_df=None):
+    
+    import fieldparallel
+    
+    shift_stage = fieldparallel.loadStage('03b-shift-bb-data.py')
+    average_stage = fieldparallel.loadStage('03c-calculate-bbprime-average.py')
+    merge_stage = fieldparallel.loadStage('04b-merge-field-data.py')
+    
+    shifted_crz_df = None
+    averaged_crz_df = uw_crz_df
+    if len(uw_crz_df) > 0:
+        shifted_crz_df = shift_stage.shiftBBData(uw_crz_df, cycleDict, cols['uw_cruisename'], cols['uw_time'], cols['numsamples'])
+        averaged_crz_df = average_stage.averageBBData(shifted_crz_df, cols['uw_cruisename'], cols['numsamples'], cols['bbtot'], cols['bbtot_std'], cols['bbacid'], cols['bbacid_std'], cols['bbprime'], cols['bbprime_std'])
+    
+    xbt_args = dict(xbt_crz_df=xbt_crz_df, d_station=cols['d_station'], xbt_station=cols['xbt_station'], xbt_depth=cols['xbt_depth']) if xbt_crz_df is not None else {}
+    merged_crz_df = merge_stage.mergeCruise(averaged_crz_df, d_crz_df, cols['uw_id'], cols['d_id'], cols['uw_cruisename'], cols['d_cruisename'], cols['uw_time'], cols['d_time'], cols['uw_longitude'], cols['d_longitude'], cols['uw_latitude'], cols['d_latitude'], cols['d_shallowest'], cols['d_depth'], cols['time_tolerance'], cols['amt_time_window'], cols['amt_radius'], **xbt_args)
+    
+    # Only hand back the intermediates if they are going to be saved:
+    if keep_intermediates:
+        return merged_crz_df, shifted_crz_df, averaged_crz_df
+    return merged_crz_df, None, None
+
+def exportCruiseQc(field_crz_df, rules, ofile_dir, spec, cruisename='CruiseName'):
+    
+    import pandas as pd
+    import fieldparallel
+    
+    qc_stage = fieldparallel.loadStage('06b-qc-field-data.py')
+    export_stage = fieldparallel.loadStage('07b-export-seabass.py')
+    
+    # Flag one cruise by the QC rules (replacing any earlier flag columns) and write its SeaBASS file. Returns the export counts of 07b and the QC counts of 06b.
+    flags, counts = qc_stage.qcCruise(field_crz_df, cruisename, rules)
+    columns, _ = qc_stage.flagColumns(rules)
+    field_crz_df = pd.concat([field_crz_df.drop(columns=[col for col in columns if col in field_crz_df.columns]), pd.DataFrame(flags, columns=columns, index=field_crz_df.index)], axis=1)
+    
+    return export_stage.exportCruise(field_crz_df, ofile_dir, spec, cruisename), counts
+
+def runCruiseXbt(uw_crz_df, d_crz_df, xbt_crz_df, **kwargs):
+    
+    # runCruise with the XBT records of the cruise as a third table, for fieldparallel.mapCruises and streamCruises:
+    return runCruise(uw_crz_df, d_crz_df, xbt_crz_df=xbt_crz_df, **kwargs)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,447 @@
+def main():
+    
+    import os
+    import time
+    import pickle
+    import argparse
+    import fieldio
+    import fieldschema
+    import fieldprofile
+    
+    parser = argparse.ArgumentParser(description='''\
+    This script runs the bb shift (03b), bb average (03c), and field merge (04b) stages incrementally, for processing underway data at sea as it is logged.
+    Each run reads only the underway rows that arrived since the last run, from a growing csv file or from new files in a directory, and appends only the rows that are final to the output files.
+    A small state per cruise is kept in the state file between runs: the last underway rows, which still wait for their next row (03b) or are needed by the next row (03c), and the underway rows and discrete samples within the matching window of the newest underway time (04b).
+    Merged rows are final once the newest underway time is more than twice the matching window past them: 2 x --timeTolerance for GNATS cruises, 2 x --amtTimeWindow for AMT cruises.
+    Underway rows are expected to arrive in time order within a cruise. Use --finalize at the end of a cruise to flush the rows still held back.''')
+    
+    parser.add_argument('--uwSource', nargs=1, type=str, required=True, help='''\
+    Growing underway csv file that new rows are appended to, or a directory into which new underway files (csv, parquet or feather) are placed. Files in a directory are read in name order, each once; they should be moved in complete.''')
+    
+    parser.add_argument('--discreteFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the formatted discrete file. It is read again whenever it changes, so samples can be added during the cruise.''')
+    
+    parser.add_argument('--bbcycleParametersFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the python dictionary pickle file containing acceptable bb cycling durations on a per cruise basis.''')
+    
+    parser.add_argument('--uwIdCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway ids.''')
+    
+    parser.add_argument('--discreteIdCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete ids.''')
+    
+    parser.add_argument('--uwCruiseNameCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway cruisenames.''')
+    
+    parser.add_argument('--discreteCruiseNameCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete cruisenames.''')
+    
+    parser.add_argument('--uwTimeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway timestamps.''')
+    
+    parser.add_argument('--discreteTimeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete timestamps.''')
+    
+    parser.add_argument('--uwLongitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway longitudes.''')
+    
+    parser.add_argument('--discreteLongitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete longitudes.''')
+    
+    parser.add_argument('--uwLatitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains underway latitudes.''')
+    
+    parser.add_argument('--discreteLatitudeCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete latitudes.''')
+    
+    parser.add_argument('--discreteShallowestCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete station shallowest sample info.''')
+    
+    parser.add_argument('--discreteDepthCol', nargs=1, type=str, required=True, help='''\
+    Name of column that contains discrete depths.''')
+    
+    parser.add_argument('--numSamplesCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the number of samples set for the bb cycling.''')
+    
+    parser.add_argument('--bbtotCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbtot data.''')
+    
+    parser.add_argument('--bbtotStdCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbtot error data.''')
+    
+    parser.add_argument('--bbacidCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbacid data.''')
+    
+    parser.add_argument('--bbacidStdCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbacid error data.''')
+    
+    parser.add_argument('--bbprimeCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbprime data.''')
+    
+    parser.add_argument('--bbprimeStdCol', nargs=1, type=str, required=True, help='''\
+    Name of column containing the bbprime error data.''')
+    
+    parser.add_argument('--timeTolerance', nargs=1, type=str, required=False, default=['5min'], help='''\
+    Maximum time difference allowed between a GNATS discrete sample and its nearest underway record, as a pandas timedelta string. Defaults to 5min.''')
+    
+    parser.add_argument('--amtTimeWindow', nargs=1, type=str, required=False, default=['6h'], help='''\
+    Maximum time difference allowed between an AMT surface sample and its underway match, as a pandas timedelta string. Defaults to 6h.''')
+    
+    parser.add_argument('--amtMatchRadius', nargs=1, type=float, required=False, default=[1.11], help='''\
+    Maximum great-circle distance in km allowed between an AMT surface sample and its underway match. Defaults to 1.11 km (0.01 degrees of latitude).''')
+    
+    parser.add_argument('--stateFile', nargs=1, type=str, required=True, help='''\
+    Full path and name of the pickle file holding the per-cruise state between runs. It is created on the first run.''')
+    
+    parser.add_argument('--xbtFile', nargs=1, type=str, required=False, default=[None], help='''\
+    Not supported in real time: XBT data is merged by station once a cruise is complete, with 04b or 05b.''')
+    
+    parser.add_argument('--ofileFieldData', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the csv file to append final merged field data to.''')
+    
+    parser.add_argument('--ofileShiftedData', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Full path, name, and extension of the csv file to append final bb-shifted underway data (the 03b output) to.''')
+    
+    parser.add_argument('--ofileAveragedBB', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Full path, name, and extension of the csv file to append final bb-averaged underway data (the 03c output) to.''')
+    
+    parser.add_argument('--follow', action='store_true', help='''\
+    Optional. Keep running, checking the underway source for new rows every --interval seconds, until interrupted.''')
+    
+    parser.add_argument('--interval', nargs=1, type=float, required=False, default=[60], help='''\
+    Optional. Seconds between checks for new rows with --follow. Defaults to 60.''')
+    
+    parser.add_argument('--finalize', action='store_true', help='''\
+    Optional. After reading the new rows, flush every row still held back, as at the end of the cruise(s). Cruises with discrete samples only are merged too.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each batch, with suggested PBS ncpus/mem values.''')
+    
+    
+    args = parser.parse_args()
+    dict_args = vars(args)
+    
+    ### Define Dictionary Variables: ########################################
+    
+    uw_source = dict_args['uwSource'][0]
+    d_fp = dict_args['discreteFile'][0]
+    cycle_fp = dict_args['bbcycleParametersFile'][0]
+    state_fp = dict_args['stateFile'][0]
+    ofile = dict_args['ofileFieldData'][0]
+    ofile_shifted = dict_args['ofileShiftedData'][0]
+    ofile_avg_bb = dict_args['ofileAveragedBB'][0]
+    follow = dict_args['follow']
+    interval = dict_args['interval'][0]
+    finalize = dict_args['finalize']
+    time_format = dict_args['timeFormat'][0]
+    profile_fp = dict_args['profile'][0]
+    
+    cols = {'uw_id':dict_args['uwIdCol'][0], 'd_id':dict_args['discreteIdCol'][0],
+            'uw_cruisename':dict_args['uwCruiseNameCol'][0], 'd_cruisename':dict_args['discreteCruiseNameCol'][0],
+            'uw_time':dict_args['uwTimeCol'][0], 'd_time':dict_args['discreteTimeCol'][0],
+            'uw_longitude':dict_args['uwLongitudeCol'][0], 'd_longitude':dict_args['discreteLongitudeCol'][0],
+            'uw_latitude':dict_args['uwLatitudeCol'][0], 'd_latitude':dict_args['discreteLatitudeCol'][0],
+            'd_shallowest':dict_args['discreteShallowestCol'][0], 'd_depth':dict_args['discreteDepthCol'][0],
+            'numsamples':dict_args['numSamplesCol'][0],
+            'bbtot':dict_args['bbtotCol'][0], 'bbtot_std':dict_args['bbtotStdCol'][0],
+            'bbacid':dict_args['bbacidCol'][0], 'bbacid_std':dict_args['bbacidStdCol'][0],
+            'bbprime':dict_args['bbprimeCol'][0], 'bbprime_std':dict_args['bbprimeStdCol'][0],
+            'time_tolerance':dict_args['timeTolerance'][0],
+            'amt_time_window':dict_args['amtTimeWindow'][0], 'amt_radius':dict_args['amtMatchRadius'][0]}
+    
+    if dict_args['xbtFile'][0] is not None:
+        parser.error('--xbtFile is not supported in real time; merge the XBT data with 04b-merge-field-data.py or 05b-run-field-pipeline.py once the cruise is complete')
+    for fp in [ofile, ofile_shifted, ofile_avg_bb]:
+        if fp is not None and fieldio.tableFormat(fp) != 'csv':
+            parser.error('The incremental outputs are appended to, so they must be csv files: {}'.format(fp))
+    
+    # IDs are read as nullable integers and timestamps parsed once. Cruise names stay plain strings, as batches with different cruises are concatenated.
+    uw_schema = fieldschema.tableSchema(id_cols=[cols['uw_id']], datetime_cols=[cols['uw_time']], time_format=time_format)
+    d_schema = fieldschema.tableSchema(id_cols=[cols['d_id']], datetime_cols=[cols['d_time']], time_format=time_format)
+    with open(cycle_fp, 'rb') as handle:
+        cycleDict = pickle.load(handle)
+    
+    state = loadState(state_fp)
+    profiler = fieldprofile.openProfiler(profile_fp, '05c-run-realtime')
+    
+    ### Process New Underway Rows as They Arrive: ###
+    
+    d = None
+    d_signature = None
+    try:
+        while True:
+            
+            # The discrete file is small, and only read again when it changed:
+            signature = (os.path.getmtime(d_fp), os.path.getsize(d_fp))
+            if signature != d_signature:
+                d = fieldio.readTable(d_fp, schema=d_schema)
+                d_signature = signature
+            
+            with fieldprofile.step(profiler, 'batch') as record:
+                uw_batch = readNewRows(state, uw_source, uw_schema)
+                record['rows_in'] = len(uw_batch) if uw_batch is not None else 0
+                if uw_batch is not None or finalize:
+                    shifted, averaged, field = processBatch(state, uw_batch, d, cycleDict, cols, finalize)
+                    
+                    # Outputs are appended before the state is saved, so a run that is cut short repeats its rows rather than losing them.
+                    for table,fp in [(shifted, ofile_shifted), (averaged, ofile_avg_bb), (field, ofile)]:
+                        if fp is not None and table is not None and len(table) > 0:
+                            appendCsv(table, fp)
+                    saveState(state, state_fp)
+                    record['rows_out'] = len(field) if field is not None else 0
+                    print('{}: {} new underway rows, {} final merged rows.'.format(time.strftime('%Y-%m-%d %H:%M:%S'), record['rows_in'], record['rows_out']))
+            
+            if not follow or finalize:
+                break
+            time.sleep(interval)
+    
+    except KeyboardInterrupt:
+        pass
+    
+    if profiler is not None:
+        profiler.save()
+
+#########################################################################
+
+### State: ###
+# uw_offset/uw_header: how far the growing underway csv file has been read, and its header line.
+# uw_files: the files of an underway directory that have been read.
+# uw_columns: an empty table with the columns and dtypes of the averaged underway data, for merging cruises that only have discrete samples.
+# cruises: the state of every cruise (see newCruiseState).
+
+def loadState(state_fp):
+    
+    import os
+    import pickle
+    
+    if not os.path.exists(state_fp):
+        return {'uw_offset':0, 'uw_header':None, 'uw_files':set(), 'uw_columns':None, 'cruises':{}}
+    with open(state_fp, 'rb') as handle:
+        return pickle.load(handle)
+
+def saveState(state, state_fp):
+    
+    import os
+    import pickle
+    
+    # Write to a temporary file first, so that an interrupted run never leaves a half-written state:
+    with open(state_fp + '.tmp', 'wb') as handle:
+        pickle.dump(state, handle, protocol=4)
+    os.replace(state_fp + '.tmp', state_fp)
+
+def newCruiseState():
+    
+    # pending:   underway rows not shifted yet. The last row with a time waits for the next row (03b).
+    # undated:   underway rows without a time. They go after all other rows of the cruise, as in 03b, and are only processed by --finalize.
+    # last_time: time of the last shifted row. Rows arriving with an earlier time can no longer be put in order.
+    # previous:  the last shifted row, whose bbacid the next row averages with (03c).
+    # window:    averaged rows within the matching window of the frontier, which later discrete samples and underway rows are matched against (04b).
+    # frontier:  all merged rows with earlier times have been written.
+    # written:   IDs of the discrete samples that have been written.
+    return {'pending':None, 'undated':None, 'last_time':None, 'previous':None, 'window':None, 'frontier':None, 'written':set()}
+
+def readNewRows(state, uw_source, uw_schema):
+    
+    import io
+    import os
+    import pandas as pd
+    import fieldio
+    import fieldschema
+    
+    # New underway rows since the last run, or None if there are none.
+    if os.path.isdir(uw_source):
+        new_files = sorted(name for name in os.listdir(uw_source) if name not in state['uw_files'] and os.path.splitext(name)[1].lower() in fieldio.TABLE_FORMATS)
+        if len(new_files) == 0:
+            return None
+        new_rows = pd.concat([fieldio.readTable(os.path.join(uw_source, name), schema=uw_schema) for name in new_files], ignore_index=True)
+        state['uw_files'].update(new_files)
+        return new_rows
+    
+    # Growing csv file: read from where the last run stopped, up to the last complete line.
+    if os.path.getsize(uw_source) < state['uw_offset']:
+        raise ValueError('{} is shorter than when it was last read. Start again with a new state file.'.format(uw_source))
+    with open(uw_source, 'rb') as handle:
+        handle.seek(state['uw_offset'])
+        data = handle.read()
+    data = data[:data.rfind(b'\n') + 1]
+    
+    if state['uw_header'] is None:
+        header_end = data.find(b'\n') + 1
+        if header_end == 0:
+            return None
+        state['uw_header'] = data[:header_end]
+        state['uw_offset'] += header_end
+        data = data[header_end:]
+    if len(data.strip()) == 0:
+        return None
+    
+    new_rows = pd.read_csv(io.BytesIO(state['uw_header'] + data))
+    state['uw_offset'] += len(data)
+    return fieldschema.applySchema(new_rows, uw_schema)
+
+def processBatch(state, uw_batch, d, cycleDict, cols, finalize=False):
+    
+    import fieldparallel
+    
+    # Carry the new underway rows of every cruise through the three stages, returning the rows that became final: (shifted, averaged, merged).
+    crz_batches = {}
+    if uw_batch is not None:
+        uw_batch = uw_batch.loc[uw_batch[cols['uw_cruisename']].notna()]
+        crz_batches = {crz:crz_df for crz,crz_df in uw_batch.groupby(cols['uw_cruisename'], sort=False)}
+    
+    crz_list = list(dict.fromkeys(list(state['cruises'].keys()) + list(crz_batches.keys())))
+    if finalize:
+        crz_list = crz_list + [crz for crz in d[cols['d_cruisename']].dropna().unique() if crz not in crz_list]
+    
+    shifted_dfs, averaged_dfs, field_dfs = [], [], []
+    for crz in crz_list:
+        crz_state = state['cruises'].setdefault(crz, newCruiseState())
+        d_crz_df = d.loc[d[cols['d_cruisename']] == crz]
+        shifted_crz_df, averaged_crz_df, merged_crz_df = advanceCruise(crz_state, crz_batches.get(crz), d_crz_df, cycleDict, cols, finalize, state)
+        shifted_dfs.append(shifted_crz_df)
+        averaged_dfs.append(averaged_crz_df)
+        field_dfs.append(merged_crz_df)
+    
+    # Finalized cruises start again from scratch if more of their rows arrive:
+    if finalize:
+        state['cruises'] = {}
+    
+    merge_stage = fieldparallel.loadStage('04b-merge-field-data.py')
+    field = concatRows(field_dfs)
+    if field is not None:
+        field = merge_stage.finalizeFieldData(field, cols['uw_id'], cols['d_id'], cols['uw_time'], cols['uw_longitude'], cols['d_longitude'], cols['uw_latitude'], cols['d_latitude'])
+    
+    return concatRows(shifted_dfs), concatRows(averaged_dfs), field
+
+def advanceCruise(crz_state, uw_crz_df, d_crz_df, cycleDict, cols, finalize, state):
+    
+    import warnings
+    import pandas as pd
+    import numpy as np
+    import fieldparallel
+    
+    shift_stage = fieldparallel.loadStage('03b-shift-bb-data.py')
+    average_stage = fieldparallel.loadStage('03c-calculate-bbprime-average.py')
+    merge_stage = fieldparallel.loadStage('04b-merge-field-data.py')
+    uw_time = cols['uw_time']
+    
+    ### 03b: Shift Every Row That Has a Next Row: ###
+    
+    if uw_crz_df is not None:
+        dated = uw_crz_df[uw_time].notna()
+        crz_state['undated'] = concatRows([crz_state['undated'], uw_crz_df.loc[~dated]])
+        uw_crz_df = uw_crz_df.loc[dated]
+        if crz_state['last_time'] is not None:
+            late = uw_crz_df[uw_time] < crz_state['last_time']
+            if late.any():
+                warnings.warn('{} underway rows of {} arrived after later rows were already processed, and are skipped. Rerun 03b-04b on the whole cruise to include them.'.format(late.sum(), uw_crz_df[cols['uw_cruisename']].iloc[0]))
+                uw_crz_df = uw_crz_df.loc[~late]
+        crz_state['pending'] = concatRows([crz_state['pending'], uw_crz_df])
+    
+    # The rows are shifted together with the held back row, in time order (ties keep their order of arrival, as in 03b):
+    pending = crz_state['pending']
+    if pending is not None:
+        pending = pending.sort_values(uw_time, kind='stable')
+    if finalize:
+        ready = concatRows([pending, crz_state['undated']])
+        crz_state['pending'] = None
+        crz_state['undated'] = None
+    elif pending is not None and len(pending) > 1:
+        ready = pending
+        crz_state['pending'] = pending.iloc[-1:]
+    else:
+        ready = None
+        crz_state['pending'] = pending
+    
+    shifted_crz_df = None
+    if ready is not None and len(ready) > 0:
+        shifted_crz_df = shift_stage.shiftBBData(ready, cycleDict, cols['uw_cruisename'], uw_time, cols['numsamples'])
+        # Without --finalize, the last row was only there to shift the row before it:
+        if not finalize:
+            shifted_crz_df = shifted_crz_df.iloc[:-1]
+        if len(shifted_crz_df) > 0:
+            crz_state['last_time'] = shifted_crz_df[uw_time].max()
+    
+    ### 03c: Average Every Shifted Row With the Row Before It: ###
+    
+    averaged_crz_df = None
+    if shifted_crz_df is not None and len(shifted_crz_df) > 0:
+        previous = crz_state['previous']
+        averaged_crz_df = average_stage.averageBBData(concatRows([previous, shifted_crz_df]), cols['uw_cruisename'], cols['numsamples'], cols['bbtot'], cols['bbtot_std'], cols['bbacid'], cols['bbacid_std'], cols['bbprime'], cols['bbprime_std'])
+        averaged_crz_df = averaged_crz_df.iloc[len(previous) if previous is not None else 0:]
+        crz_state['previous'] = shifted_crz_df.iloc[-1:]
+        if state['uw_columns'] is None:
+            state['uw_columns'] = averaged_crz_df.iloc[:0]
+    
+    ### 04b: Merge Everything Behind the Frontier: ###
+    # A discrete sample is matched against the averaged rows within the matching window of its time, and an averaged row is matched by the samples within the window of its time.
+    # Rows more than twice the window behind the newest averaged row can therefore no longer change. They are merged from a window of the recent rows, and written.
+    
+    window = concatRows([crz_state['window'], averaged_crz_df])
+    if window is None:
+        if not finalize or len(d_crz_df) == 0 or state['uw_columns'] is None:
+            return shifted_crz_df, averaged_crz_df, None
+        window = state['uw_columns']
+    
+    crz = window[cols['uw_cruisename']].iloc[0] if len(window) > 0 else d_crz_df[cols['d_cruisename']].iloc[0]
+    match_window = pd.Timedelta(cols['time_tolerance'] if crz[0]=='s' else cols['amt_time_window'])
+    frontier = crz_state['frontier']
+    newest = window[uw_time].max()
+    new_frontier = None if finalize else newest - 2*match_window
+    if not finalize and (pd.isnull(newest) or (frontier is not None and new_frontier <= frontier)):
+        crz_state['window'] = window
+        return shifted_crz_df, averaged_crz_df, None
+    
+    # Discrete samples near the frontier (including written ones, which may still claim an underway row), and samples not written yet.
+    # Samples that arrive with a time behind the frontier can only be matched against the rows still in the window.
+    d_ids = d_crz_df[cols['d_id']]
+    written = d_ids.isin(crz_state['written']).to_numpy()
+    d_times = d_crz_df[cols['d_time']]
+    if frontier is None:
+        d_window = d_crz_df.loc[~written]
+        late_ids = set()
+    else:
+        late = ~written & (d_times < frontier).to_numpy()
+        if late.any():
+            warnings.warn('{} discrete samples of {} arrived after the underway rows around their time were written, and are matched against the recent underway rows only. Rerun 04b on the whole cruise to match them fully.'.format(late.sum(), crz))
+        d_window = d_crz_df.loc[~written | (d_times >= frontier - 2*match_window).to_numpy()]
+        late_ids = set(d_ids[late].dropna())
+    
+    merged_crz_df = merge_stage.mergeCruise(window, d_window, cols['uw_id'], cols['d_id'], cols['uw_cruisename'], cols['d_cruisename'], uw_time, cols['d_time'], cols['uw_longitude'], cols['d_longitude'], cols['uw_latitude'], cols['d_latitude'], cols['d_shallowest'], cols['d_depth'], cols['time_tolerance'], cols['amt_time_window'], cols['amt_radius'])
+    
+    # Write the merged rows between the old and the new frontier (with --finalize, everything after the old frontier), and the late samples:
+    keys = merged_crz_df['yyyy-mm-ddThh:mm:ss']
+    final = np.ones(len(merged_crz_df), dtype=bool) if frontier is None else ~(keys < frontier).to_numpy()
+    if new_frontier is not None:
+        final &= (keys < new_frontier).to_numpy()
+    final |= merged_crz_df[cols['d_id']].isin(late_ids).to_numpy()
+    merged_crz_df = merged_crz_df.loc[final]
+    
+    crz_state['written'].update(merged_crz_df[cols['d_id']].dropna().tolist())
+    crz_state['frontier'] = new_frontier
+    if new_frontier is not None:
+        crz_state['window'] = window.loc[~(window[uw_time] < new_frontier - 3*match_window)]
+    
+    return shifted_crz_df, averaged_crz_df, merged_crz_df
+
+def concatRows(tables):
+    
+    import pandas as pd
+    
+    tables = [table for table in tables if table is not None]
+    if len(tables) == 0:
+        return None
+    return pd.concat(tables) if len(tables) > 1 else tables[0]
+
+def appendCsv(table, fp):
+    
+    import os
+    
+    # The header is only written when the file is started:
+    new_file = not os.path.exists(fp) or os.path.getsize(fp) == 0
+    table.to_csv(fp, mode='w' if new_file else 'a', header=new_file, index=False)
+
+if __name__ == "__main__": main()
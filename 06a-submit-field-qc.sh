@@ -0,0 +1,19 @@
+#!/bin/bash
+
+#PBS -N field-qc
+#PBS -q route
+
+#PBS -l ncpus=16,mem=64gb
+#PBS -l walltime=1:00:00
+#PBS -o /mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow/logs
+#PBS -e /mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow/logs
+
+# Load modules and environment
+module use /mod/bigelow
+module load anaconda3
+source activate ~/sunnysenv
+
+scriptDir=/mnt/storage/labs/mitchell/spinkham/gitHubRepos/cms_dev/field-workflow
+dataDir=/mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow
+
+python $scriptDir/06b-qc-field-data.py --fieldFile $dataDir/04-merged-field-data.csv --qcRulesFile $scriptDir/06-qc-rules.json --ofileQcData $dataDir/06-qc-field-data.csv --ofileQcSummary $dataDir/06-qc-summary.csv --workers 16 --profile $dataDir/logs/06b-qc-field-data-profile.json
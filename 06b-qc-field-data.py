@@ -0,0 +1,325 @@
+def main():
+    
+    import pandas as pd
+    import argparse
+    import fieldio
+    import fieldschema
+    import fieldcache
+    import fieldprofile
+    
+    parser = argparse.ArgumentParser(description='''\
+    This script flags the merged field data by a set of QC rules: range, spike, gradient, stuck-value and flag checks per variable. Flags are bit-packed into one flag column per variable.''')
+    
+    parser.add_argument('--fieldFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the merged field data file (04-merged-field-data).''')
+    
+    parser.add_argument('--qcRulesFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the json file of QC rules, e.g. 06-qc-rules.json.''')
+    
+    parser.add_argument('--ofileQcData', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of where to save the flagged field data: the merged field data with a <variable>_qc flag column for every variable checked. Bit k of a flag column is set where the k-th rule of the rules file flagged the row. Must be csv, parquet, or feather, or a directory path ending in / for a dataset partitioned by cruise.''')
+    
+    parser.add_argument('--ofileQcSummary', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File to save the number of rows checked and flagged by every rule in every cruise to, with the bit of each rule.''')
+    
+    parser.add_argument('--cruiseNameCol', nargs=1, type=str, required=False, default=['CruiseName'], help='''\
+    Optional. Name of the cruise name column. Defaults to CruiseName.''')
+    
+    parser.add_argument('--fileFormat', nargs=1, type=str, required=False, default=[None], choices=['csv', 'parquet', 'feather'], help='''\
+    Optional. Format of the input and output files. If not given, the format is inferred from each file extension.''')
+    
+    parser.add_argument('--workers', nargs=1, type=int, required=False, default=[1], help='''\
+    Optional. Number of worker processes. Cruises are checked independently, so with more than 1 worker they are spread over a process pool. Defaults to 1.''')
+    
+    parser.add_argument('--cacheDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory of the per-cruise result cache. Cruises whose rows and rules have not changed since a previous run are read from the cache instead of being checked again.''')
+    
+    parser.add_argument('--cacheMaxSize', nargs=1, type=float, required=False, default=[None], help='''\
+    Optional. Maximum size of the cache in GB. The least recently used results are evicted beyond this size.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each step and each cruise, with suggested PBS ncpus/mem values.''')
+    
+    parser.add_argument('--cruises', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only check these cruises, given as cruise names or shell-style patterns (e.g. AMT2* s01??). Only their rows are read (only their partitions, from a dataset) and only their partitions of the output dataset are replaced. The output must be a dataset.''')
+    
+    
+    args = parser.parse_args()
+    dict_args = vars(args)
+    
+    ### Define Dictionary Variables: ########################################
+    
+    field_fp = dict_args['fieldFile'][0]
+    rules_fp = dict_args['qcRulesFile'][0]
+    ofile_qc = dict_args['ofileQcData'][0]
+    ofile_summary = dict_args['ofileQcSummary'][0]
+    cruisename = dict_args['cruiseNameCol'][0]
+    file_format = dict_args['fileFormat'][0]
+    workers = dict_args['workers'][0]
+    cache_dir = dict_args['cacheDir'][0]
+    cache_max_gb = dict_args['cacheMaxSize'][0]
+    time_format = dict_args['timeFormat'][0]
+    profile_fp = dict_args['profile'][0]
+    cruises = dict_args['cruises']
+    
+    # Outputs of the other cruises can only be left as they are in a dataset:
+    if cruises is not None and not fieldio.isDataset(ofile_qc):
+        parser.error('--cruises needs a dataset output (a directory path ending in /), so that the other cruises are kept')
+    
+    ### Read in Rules and Data ###
+    
+    rules = loadQcRules(rules_fp)
+    
+    # The timestamps the time series checks are ordered by are parsed as they are read:
+    time_cols = sorted(set(rule['time'] for rule in rules if rule['time'] is not None))
+    schema = fieldschema.tableSchema(cruisename_cols=[cruisename], datetime_cols=time_cols, time_format=time_format)
+    profiler = fieldprofile.openProfiler(profile_fp, '06b-qc-field-data', workers)
+    with fieldprofile.step(profiler, 'read') as record:
+        field = fieldio.readTable(field_fp, fmt=file_format, schema=schema, cruises=cruises, cruisename=cruisename)
+        record['rows_out'] = len(field)
+    
+    ### Flag the Field Data: ###
+    # All rules are evaluated cruise by cruise. With several workers, the cruises are spread over a process pool; with a cache, only cruises whose rows or rules changed since the last run are checked again.
+    
+    cache = fieldcache.openCache(cache_dir, '06b-qc-field-data', cache_max_gb, modules=[fieldio])
+    with fieldprofile.step(profiler, 'qc', parallel=True) as record:
+        flags, summary = qcFieldData(field, cruisename, rules, workers, cache, profiler)
+        record['rows_in'] = len(field)
+        record['rows_out'] = len(flags)
+    
+    # Flag columns of an earlier QC run are replaced:
+    field = pd.concat([field.drop(columns=[col for col in flags.columns if col in field.columns]), flags], axis=1)
+    
+    ### Save out the Flagged Field Data: ###
+    with fieldprofile.step(profiler, 'write') as record:
+        fieldio.writeTable(field, ofile_qc, fmt=file_format, cruisename=cruisename, cruises=cruises)
+        if ofile_summary is not None:
+            fieldio.writeTable(summary, ofile_summary, fmt=file_format)
+        record['rows_in'] = len(field)
+    
+    print(qcReport(summary))
+    if cache is not None:
+        print(cache.report())
+    if profiler is not None:
+        profiler.save()
+
+#########################################################################
+
+# The checks a rule may run, and the parameters each needs:
+#   range    --> flag values below min or above max (either may be left out)
+#   spike    --> flag values more than threshold from the median of the window of rows centred on them
+#   gradient --> flag values changing faster than max_rate per second from the value window rows before (pairs more than max_gap seconds apart are not compared)
+#   stuck    --> flag runs of at least count consecutive equal values
+#   flag     --> flag rows whose column holds one of values (by default any nonzero value), e.g. cycle_duration_flag
+QC_CHECKS = {'range':[], 'spike':['window', 'threshold'], 'gradient':['max_rate'], 'stuck':['count'], 'flag':[]}
+
+def loadQcRules(fp):
+    
+    import json
+    
+    # A rules file holds a list of rules, and the default time column that the time series checks (spike, gradient, stuck) order each cruise by:
+    #   {"time": "UWTime", "rules": [{"name": "bbprime_range", "check": "range", "column": "bbprimeAvg", "min": -0.0005, "max": 0.05}, ...]}
+    # Every rule has a name, a check and the column it tests. Optional keys:
+    #   variables --> the variables whose flag column (<variable>_qc) the rule sets. Defaults to the column itself.
+    #   time      --> the time column of this rule, instead of the default.
+    #   cruises   --> cruise names or shell-style patterns (e.g. ["AMT*"]) of the cruises the rule applies to. Defaults to all cruises.
+    # Rule k of the file sets bit k (1 << k) of the flag columns, so a file holds at most 64 rules.
+    with open(fp) as handle:
+        spec = json.load(handle)
+    
+    rules = []
+    for bit,rule in enumerate(spec['rules']):
+        name = rule.get('name', 'rule {}'.format(bit))
+        if rule.get('check') not in QC_CHECKS:
+            raise ValueError('QC rule {}: unknown check {}. Must be one of: {}.'.format(name, rule.get('check'), ', '.join(QC_CHECKS)))
+        missing = [key for key in ['column'] + QC_CHECKS[rule['check']] if key not in rule]
+        if rule['check'] == 'range' and 'min' not in rule and 'max' not in rule:
+            missing.append('min or max')
+        if len(missing) > 0:
+            raise ValueError('QC rule {}: missing {}.'.format(name, ', '.join(missing)))
+    
+        rule = dict(rule, name=name, bit=bit)
+        rule['variables'] = list(rule.get('variables', [rule['column']]))
+        rule['time'] = rule.get('time', spec.get('time')) if rule['check'] in ['spike', 'gradient', 'stuck'] else None
+        if rule['check'] in ['spike', 'gradient', 'stuck'] and rule['time'] is None:
+            raise ValueError('QC rule {}: a {} check needs a time column, in the rule or for the whole file.'.format(name, rule['check']))
+        rules.append(rule)
+    
+    if len(rules) > 64:
+        raise ValueError('{} holds {} QC rules; at most 64 fit in the flag columns.'.format(fp, len(rules)))
+    
+    return rules
+
+def flagColumns(rules):
+    
+    import numpy as np
+    
+    # Flag column of every variable checked, in order of first appearance in the rules, and the smallest unsigned integer type holding a bit for every rule:
+    columns = list(dict.fromkeys(variable + '_qc' for rule in rules for variable in rule['variables']))
+    dtype = np.dtype(next(dtype for dtype in ['uint8', 'uint16', 'uint32', 'uint64'] if np.dtype(dtype).itemsize*8 >= len(rules)))
+    
+    return columns, dtype
+
+def ruleColumns(rules):
+    
+    # Columns the rules test, and the time columns they order them by:
+    return [col for col in dict.fromkeys(col for rule in rules for col in [rule['column'], rule['time']]) if col is not None]
+
+def qcFieldData(field, cruisename, rules, workers=1, cache=None, profiler=None):
+    
+    import pandas as pd
+    import numpy as np
+    import fieldparallel
+    
+    # Check every cruise, spreading the cruises over a process pool if there are several workers. Only the columns the rules use are handed to the cruises.
+    # Returns the flag columns, in the row order of field, and the number of rows checked and flagged by every rule in every cruise.
+    used = [cruisename] + [col for col in ruleColumns(rules) if col in field.columns and col != cruisename]
+    table = field[used]
+    crz_pos = fieldparallel.cruisePositions(table, cruisename)
+    results = fieldparallel.mapCruises(qcCruise, (table,), [(pos,) for pos in crz_pos.values()], workers, cache=cache, labels=list(crz_pos.keys()), profiler=profiler, cruisename=cruisename, rules=rules)
+    
+    # Rows without a cruise name are not checked, and are left unflagged:
+    columns, dtype = flagColumns(rules)
+    flags = np.zeros((len(field), len(columns)), dtype=dtype)
+    for pos,(crz_flags, _) in zip(crz_pos.values(), results):
+        flags[pos] = crz_flags
+    
+    return pd.DataFrame(flags, columns=columns, index=field.index), qcSummary(crz_pos.keys(), rules, [crz_counts for _,crz_counts in results])
+
+def qcSummary(crz_list, rules, crz_counts):
+    
+    import pandas as pd
+    import numpy as np
+    
+    # Rows checked and flagged by every rule in every cruise, from the counts of qcCruise:
+    counts = np.concatenate(crz_counts) if len(crz_counts) > 0 else np.zeros((0, 2), dtype=int)
+    return pd.DataFrame({'CruiseName':np.repeat([str(crz) for crz in crz_list], len(rules)),
+                         'rule':[rule['name'] for rule in rules]*len(crz_counts), 'check':[rule['check'] for rule in rules]*len(crz_counts),
+                         'column':[rule['column'] for rule in rules]*len(crz_counts), 'bit':[rule['bit'] for rule in rules]*len(crz_counts),
+                         'rows_checked':counts[:,0], 'rows_flagged':counts[:,1]})
+
+def qcCruise(field_crz_df, cruisename, rules):
+    
+    import numpy as np
+    import fieldio
+    
+    # Evaluate every rule on the arrays of the cruise, and set its bit in the flag columns of its variables.
+    # Returns the flag columns as one array (rows x flag columns), and the number of rows checked and flagged by every rule (rules x 2).
+    crz = field_crz_df[cruisename].iloc[0]
+    columns, dtype = flagColumns(rules)
+    flags = np.zeros((len(field_crz_df), len(columns)), dtype=dtype)
+    counts = np.zeros((len(rules), 2), dtype=int)
+    
+    # The time series of a column is prepared once, and shared by all rules on that column and time:
+    series = {}
+    for i,rule in enumerate(rules):
+        if rule['column'] not in field_crz_df.columns:
+            continue
+        if rule.get('cruises') is not None and len(fieldio.selectCruises([crz], rule['cruises'])) == 0:
+            continue
+        
+        if rule['time'] is None:
+            values = field_crz_df[rule['column']]
+            has_value = values.notna().to_numpy()
+            bad = CHECK_FUNCTIONS[rule['check']](values.to_numpy(dtype=float, na_value=np.nan) if rule['check'] == 'range' else values.to_numpy(), rule) & has_value
+        else:
+            key = (rule['column'], rule['time'])
+            if key not in series:
+                series[key] = timeSeries(field_crz_df[rule['column']], field_crz_df[rule['time']])
+            values, seconds, rows, has_value = series[key]
+            # Checked on the series, then spread back to every row of the cruise holding a series value:
+            bad = np.zeros(len(field_crz_df), dtype=bool)
+            bad[has_value] = CHECK_FUNCTIONS[rule['check']](values, seconds, rule)[rows]
+        
+        bits = bad.astype(dtype) << dtype.type(rule['bit'])
+        for variable in rule['variables']:
+            flags[:, columns.index(variable + '_qc')] |= bits
+        counts[i] = [has_value.sum(), bad.sum()]
+    
+    return flags, counts
+
+def qcReport(summary):
+    
+    # Rows flagged by every rule over all cruises checked:
+    totals = summary.groupby(['bit', 'rule'], sort=True)[['rows_checked', 'rows_flagged']].sum()
+    lines = ['QC flags (bit, rule: rows flagged of rows checked):']
+    lines += ['  {}, {}: {} of {}'.format(bit, rule, row['rows_flagged'], row['rows_checked']) for (bit, rule),row in totals.iterrows()]
+    return '\n'.join(lines)
+
+def timeSeries(values, times):
+    
+    import numpy as np
+    import pandas as pd
+    
+    # The time series of a column within one cruise: its values in time order, once per timestamp.
+    # The merged field data repeat an underway record for every discrete sample matched to it, and interleave rows without underway data, so rows without a value or time are left out and repeated timestamps are taken once.
+    # Returns the series values, their times in seconds, the series position of every row with a value, and which rows have a value.
+    values = values.to_numpy(dtype=float, na_value=np.nan)
+    times = times.to_numpy() if pd.api.types.is_datetime64_any_dtype(times) else pd.to_datetime(times).to_numpy()
+    has_value = ~np.isnan(values) & ~np.isnat(times)
+    unique_times, first, rows = np.unique(times[has_value], return_index=True, return_inverse=True)
+    seconds = (unique_times - unique_times[:1])/np.timedelta64(1, 's')
+    
+    return values[has_value][first], seconds, rows.reshape(-1), has_value
+
+def rangeCheck(values, rule):
+    
+    import numpy as np
+    
+    bad = np.zeros(len(values), dtype=bool)
+    if rule.get('min') is not None:
+        bad |= values < rule['min']
+    if rule.get('max') is not None:
+        bad |= values > rule['max']
+    return bad
+
+def flagCheck(values, rule):
+    
+    import numpy as np
+    import pandas as pd
+    
+    # Rows holding one of the listed flag values, or by default any nonzero flag:
+    if rule.get('values') is not None:
+        return np.asarray(pd.Series(values).isin(rule['values']))
+    return np.asarray(pd.to_numeric(pd.Series(values), errors='coerce').fillna(0) != 0)
+
+def spikeCheck(values, seconds, rule):
+    
+    import numpy as np
+    import pandas as pd
+    
+    # Distance of every value from the median of the window of rows centred on it (shorter at the ends of the cruise):
+    median = pd.Series(values).rolling(int(rule['window']), center=True, min_periods=1).median().to_numpy()
+    return np.abs(values - median) > rule['threshold']
+
+def gradientCheck(values, seconds, rule):
+    
+    import numpy as np
+    
+    # Rate of change from the value window rows before, in units per second:
+    lag = int(rule.get('window', 1))
+    bad = np.zeros(len(values), dtype=bool)
+    if len(values) <= lag:
+        return bad
+    dt = seconds[lag:] - seconds[:-lag]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.abs(values[lag:] - values[:-lag])/dt
+    compared = dt <= rule['max_gap'] if rule.get('max_gap') is not None else np.ones(len(dt), dtype=bool)
+    bad[lag:] = compared & (rate > rule['max_rate'])
+    return bad
+
+def stuckCheck(values, seconds, rule):
+    
+    import numpy as np
+    
+    # Runs of equal consecutive values, and the length of the run of every value:
+    run_ids = np.cumsum(np.append(True, values[1:] != values[:-1])) - 1
+    run_lengths = np.bincount(run_ids) if len(values) > 0 else np.array([], dtype=int)
+    return run_lengths[run_ids] >= rule['count']
+
+CHECK_FUNCTIONS = {'range':rangeCheck, 'spike':spikeCheck, 'gradient':gradientCheck, 'stuck':stuckCheck, 'flag':flagCheck}
+
+if __name__ == "__main__": main()
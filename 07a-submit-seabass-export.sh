@@ -0,0 +1,19 @@
+#!/bin/bash
+
+#PBS -N seabass-export
+#PBS -q route
+
+#PBS -l ncpus=16,mem=32gb
+#PBS -l walltime=1:00:00
+#PBS -o /mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow/logs
+#PBS -e /mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow/logs
+
+# Load modules and environment
+module use /mod/bigelow
+module load anaconda3
+source activate ~/sunnysenv
+
+scriptDir=/mnt/storage/labs/mitchell/spinkham/gitHubRepos/cms_dev/field-workflow
+dataDir=/mnt/storage/labs/mitchell/projects/nasacms2018/analysis/data/gnatsat_workflow
+
+python $scriptDir/07b-export-seabass.py --fieldFile $dataDir/06-qc-field-data.csv --seabassSpecFile $scriptDir/07-seabass-export.json --ofileDir $dataDir/07-seabass/ --ofileSummary $dataDir/07-seabass-summary.csv --workers 16 --profile $dataDir/logs/07b-export-seabass-profile.json
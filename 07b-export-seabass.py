@@ -0,0 +1,387 @@
+def main():
+    
+    import os
+    import tempfile
+    import argparse
+    import fieldio
+    import fieldprofile
+    
+    parser = argparse.ArgumentParser(description='''\
+    This script exports the merged (and QC flagged) field data to SeaBASS files, one file per cruise, with headers, units and fill values. Flagged rows are dropped.''')
+    
+    parser.add_argument('--fieldFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the merged field data file (04-merged-field-data), or of the flagged field data file (06-qc-field-data).''')
+    
+    parser.add_argument('--seabassSpecFile', nargs=1, type=str, required=True, help='''\
+    Full path, name, and extension of the json file describing the SeaBASS files: header metadata, the columns to export with their SeaBASS field names, units and decimals, and the handling of flagged rows, e.g. 07-seabass-export.json.''')
+    
+    parser.add_argument('--ofileDir', nargs=1, type=str, required=True, help='''\
+    Directory to save the SeaBASS files to. Files of cruises that are exported again are replaced; other files in the directory are left as they are.''')
+    
+    parser.add_argument('--ofileSummary', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File to save the number of rows read, dropped as flagged, dropped as empty, and written for every cruise to, with the name of its SeaBASS file.''')
+    
+    parser.add_argument('--cruiseNameCol', nargs=1, type=str, required=False, default=['CruiseName'], help='''\
+    Optional. Name of the cruise name column. Defaults to CruiseName.''')
+    
+    parser.add_argument('--fileFormat', nargs=1, type=str, required=False, default=[None], choices=['csv', 'parquet', 'feather'], help='''\
+    Optional. Format of the input file. If not given, the format is inferred from the file extension.''')
+    
+    parser.add_argument('--workers', nargs=1, type=int, required=False, default=[1], help='''\
+    Optional. Number of worker processes. Every cruise is written to its own file, so with more than 1 worker the cruises are formatted and written by a process pool. Defaults to 1.''')
+    
+    parser.add_argument('--chunksize', nargs=1, type=int, required=False, default=[None], help='''\
+    Optional. Streaming mode for field data files larger than memory: read the file this many rows at a time, spill the rows to disk by cruise, and export one cruise at a time.''')
+    
+    parser.add_argument('--spillDir', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. Directory for the temporary per-cruise files of the streaming mode. Defaults to the system temporary directory.''')
+    
+    parser.add_argument('--timeFormat', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. strftime format of the timestamps in text (csv) inputs, e.g. %%Y-%%m-%%d %%H:%%M:%%S. An explicit format makes parsing faster. If not given, the format is inferred.''')
+    
+    parser.add_argument('--profile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path (.json or .csv) to save profiling metrics to: wall time, CPU time, peak memory, rows in/out and bytes read/written, for each step and each cruise, with suggested PBS ncpus/mem values.''')
+    
+    parser.add_argument('--cruises', nargs='*', type=str, required=False, default=None, help='''\
+    Optional. Only export these cruises, given as cruise names or shell-style patterns (e.g. AMT2* s01??). Only their rows are read (only their partitions, from a dataset) and only their files are written.''')
+    
+    
+    args = parser.parse_args()
+    dict_args = vars(args)
+    
+    ### Define Dictionary Variables: ########################################
+    
+    field_fp = dict_args['fieldFile'][0]
+    spec_fp = dict_args['seabassSpecFile'][0]
+    ofile_dir = dict_args['ofileDir'][0]
+    ofile_summary = dict_args['ofileSummary'][0]
+    cruisename = dict_args['cruiseNameCol'][0]
+    file_format = dict_args['fileFormat'][0]
+    workers = dict_args['workers'][0]
+    chunksize = dict_args['chunksize'][0]
+    spill_dir = dict_args['spillDir'][0]
+    time_format = dict_args['timeFormat'][0]
+    profile_fp = dict_args['profile'][0]
+    cruises = dict_args['cruises']
+    
+    spec = loadSeaBASSSpec(spec_fp)
+    os.makedirs(ofile_dir, exist_ok=True)
+    profiler = fieldprofile.openProfiler(profile_fp, '07b-export-seabass', workers)
+    
+    # Only the columns the files need are read:
+    columns = exportColumns(spec, cruisename, fieldio.tableColumns(field_fp, file_format))
+    schema = seabassSchema(spec, cruisename, time_format)
+    
+    if chunksize is not None:
+        # Streaming mode: the field data are read in chunks and spilled to disk by cruise. Cruises are then read back and exported, at most one per worker at a time.
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+            warnAbsent(spec, columns)
+            with fieldprofile.step(profiler, 'spill'):
+                spill_fps, dtypes = fieldio.spillByCruise(field_fp, cruisename, tmp_dir, chunksize, columns=columns, fmt=file_format, schema=schema, cruises=cruises)
+            with fieldprofile.step(profiler, 'export', parallel=True) as record:
+                summary = exportSeaBASSStream(spill_fps, dtypes, ofile_dir, spec, cruisename, workers, profiler)
+                record['rows_in'] = int(summary['rows_read'].sum())
+                record['rows_out'] = int(summary['rows_written'].sum())
+    
+    else:
+        with fieldprofile.step(profiler, 'read') as record:
+            field = fieldio.readTable(field_fp, columns=columns, fmt=file_format, schema=schema, cruises=cruises, cruisename=cruisename)
+            record['rows_out'] = len(field)
+        with fieldprofile.step(profiler, 'export', parallel=True) as record:
+            summary = exportSeaBASS(field, ofile_dir, spec, cruisename, workers, profiler)
+            record['rows_in'] = len(field)
+            record['rows_out'] = int(summary['rows_written'].sum())
+    
+    if ofile_summary is not None:
+        fieldio.writeTable(summary, ofile_summary, fmt=file_format)
+    
+    print(seabassReport(summary, ofile_dir))
+    if profiler is not None:
+        profiler.save()
+
+#########################################################################
+
+# Header lines of a SeaBASS file, in the order SeaBASS expects them. Values not given by the spec file are computed from the rows of each cruise:
+#   cruise, data_file_name                  --> the cruise name, and the file name made from the spec's file_name template
+#   start/end_date, start/end_time          --> first and last timestamp written (yyyymmdd, hh:mm:ss[GMT])
+#   north/south_latitude, east/west_longitude --> bounds of the positions written ([DEG])
+#   missing, delimiter, fields, units       --> the fill value, comma, and the exported fields
+SEABASS_HEADER = ['investigators', 'affiliations', 'contact', 'experiment', 'cruise', 'station', 'data_file_name', 'documents', 'calibration_files', 'data_type', 'data_status',
+                  'start_date', 'end_date', 'start_time', 'end_time', 'north_latitude', 'south_latitude', 'east_longitude', 'west_longitude',
+                  'water_depth', 'measurement_depth', 'missing', 'delimiter', 'fields', 'units']
+
+# Byte left in the formatted rows where a field is narrower than its column. These bytes are removed when the rows are joined.
+PAD = 0
+
+def loadSeaBASSSpec(fp):
+    
+    import json
+    import warnings
+    
+    # A spec file describes the SeaBASS files of every cruise:
+    #   {"time": "yyyy-mm-ddThh:mm:ss", "latitude": "Latitude", "longitude": "Longitude", "file_name": "GNATS_{cruise}.sb", "header": {"investigators": ...},
+    #    "fields": [{"column": "bbtot532", "field": "bb532", "units": "1/m", "decimals": 6}, ...]}
+    # Every row of a file starts with date and time fields, taken from the time column. Fields are rounded to their decimals (by default 6, or 0 for integer columns).
+    # Optional keys:
+    #   missing      --> fill value of missing values. Defaults to -999.
+    #   flagged      --> drop (default): rows with a nonzero <column>_qc flag in any exported column are dropped.
+    #                    missing: only the flagged values are written as missing, and rows left without data are dropped.
+    #   flag_columns --> other flag columns (e.g. cycle_duration_flag); rows where any of them is nonzero are dropped, whatever flagged is.
+    #   comments     --> lines written to the header as ! comments.
+    #   qc_comments  --> comments written only to the files of QC flagged data (data with <column>_qc flags), e.g. that flagged rows were removed.
+    #   unflagged_status --> data_status of the files of data without QC flags, which cannot be final. Defaults to preliminary.
+    with open(fp) as handle:
+        spec = json.load(handle)
+    
+    missing = [key for key in ['time', 'latitude', 'longitude', 'fields'] if key not in spec]
+    if len(missing) > 0:
+        raise ValueError('{}: missing {}.'.format(fp, ', '.join(missing)))
+    for i,field in enumerate(spec['fields']):
+        if 'column' not in field or 'field' not in field or 'units' not in field:
+            raise ValueError('{}: field {} needs a column, a SeaBASS field name and units.'.format(fp, i))
+    if spec.get('flagged', 'drop') not in ['drop', 'missing']:
+        raise ValueError('{}: flagged must be drop or missing, not {}.'.format(fp, spec['flagged']))
+    
+    spec = dict(spec, missing=spec.get('missing', -999), flagged=spec.get('flagged', 'drop'), flag_columns=list(spec.get('flag_columns', [])),
+                file_name=spec.get('file_name', '{cruise}.sb'), header=dict(spec.get('header', {})), comments=list(spec.get('comments', [])),
+                qc_comments=list(spec.get('qc_comments', [])), unflagged_status=spec.get('unflagged_status', 'preliminary'))
+    
+    # SeaBASS rejects files with empty header values, so they are reported before any file is written:
+    empty = [key for key,value in spec['header'].items() if str(value).strip() == '']
+    if len(empty) > 0:
+        warnings.warn('{}: empty header values for {}; fill them in before submitting the files to SeaBASS.'.format(fp, ', '.join(empty)))
+    
+    return spec
+
+def exportColumns(spec, cruisename, available):
+    
+    # Columns of the field data the files need: cruise name, time, the exported columns and the flags of each. Exported columns missing from the field data are left out of the files (see warnAbsent).
+    absent = [col for col in [cruisename, spec['time'], spec['latitude'], spec['longitude']] + spec['flag_columns'] if col not in available]
+    if len(absent) > 0:
+        raise ValueError('Columns {} are not in the field data.'.format(', '.join(absent)))
+    
+    wanted = [cruisename, spec['time']] + [field['column'] for field in spec['fields']] + [field['column'] + '_qc' for field in spec['fields']] + spec['flag_columns']
+    return [col for col in dict.fromkeys(wanted) if col in available]
+
+def warnAbsent(spec, available):
+    
+    import warnings
+    
+    absent = [field['column'] for field in spec['fields'] if field['column'] not in available]
+    if len(absent) > 0:
+        warnings.warn('Columns {} are not in the field data, and are left out of the SeaBASS files.'.format(', '.join(absent)))
+
+def seabassSchema(spec, cruisename, time_format=None):
+    
+    import fieldschema
+    
+    return fieldschema.tableSchema(cruisename_cols=[cruisename], datetime_cols=[spec['time']], time_format=time_format)
+
+def exportSeaBASS(field, ofile_dir, spec, cruisename='CruiseName', workers=1, profiler=None):
+    
+    import fieldparallel
+    
+    # Export every cruise of the field data held in memory (e.g. the merged field data of 05b), spreading the cruises over a process pool if there are several workers.
+    # Each worker formats and writes its own cruise's file, so only the row counts come back. Written files are not cached, since writing them is the point of the stage.
+    warnAbsent(spec, field.columns)
+    table = field[exportColumns(spec, cruisename, field.columns)]
+    crz_pos = fieldparallel.cruisePositions(table, cruisename)
+    results = fieldparallel.mapCruises(exportCruise, (table,), [(pos,) for pos in crz_pos.values()], workers, labels=list(crz_pos.keys()), profiler=profiler, ofile_dir=ofile_dir, spec=spec, cruisename=cruisename)
+    
+    return exportSummary(crz_pos.keys(), results)
+
+def exportSeaBASSStream(spill_fps, dtypes, ofile_dir, spec, cruisename='CruiseName', workers=1, profiler=None):
+    
+    import fieldparallel
+    
+    # Streaming counterpart of exportSeaBASS, on field data spilled by cruise (fieldio.spillByCruise):
+    results = [result for _,result in fieldparallel.streamCruises(exportCruise, spill_fps, dtypes, workers, profiler=profiler, ofile_dir=ofile_dir, spec=spec, cruisename=cruisename)]
+    
+    return exportSummary(spill_fps.keys(), results)
+
+def exportSummary(crz_list, results):
+    
+    import pandas as pd
+    
+    return pd.DataFrame([[str(crz)] + list(result) for crz,result in zip(crz_list, results)],
+                        columns=['CruiseName', 'rows_written', 'rows_read', 'rows_flagged', 'rows_empty', 'file'])
+
+def seabassReport(summary, ofile_dir):
+    
+    files = int((summary['rows_written'] > 0).sum())
+    return 'SeaBASS export: {} rows written to {} files in {} ({} rows read, {} dropped as flagged, {} dropped without a time or data).'.format(
+        summary['rows_written'].sum(), files, ofile_dir, summary['rows_read'].sum(), summary['rows_flagged'].sum(), summary['rows_empty'].sum())
+
+def exportCruise(field_crz_df, ofile_dir, spec, cruisename='CruiseName'):
+    
+    import os
+    import numpy as np
+    import pandas as pd
+    
+    # Write the SeaBASS file of one cruise. Returns the number of rows written, read, dropped as flagged and dropped as empty, and the file name ('' if nothing was written).
+    crz = str(field_crz_df[cruisename].iloc[0])
+    fields = [field for field in spec['fields'] if field['column'] in field_crz_df.columns]
+    times = field_crz_df[spec['time']]
+    times = (times if pd.api.types.is_datetime64_any_dtype(times) else pd.to_datetime(times)).to_numpy().astype('datetime64[s]')
+    values = [field_crz_df[field['column']].to_numpy(dtype=float, na_value=np.nan) for field in fields]
+    
+    # Flagged rows or values:
+    dropped = np.zeros(len(field_crz_df), dtype=bool)
+    for col in spec['flag_columns']:
+        dropped |= field_crz_df[col].fillna(0).to_numpy() != 0
+    for i,field in enumerate(fields):
+        flag_col = field['column'] + '_qc'
+        if flag_col not in field_crz_df.columns:
+            continue
+        flagged = field_crz_df[flag_col].fillna(0).to_numpy() != 0
+        if spec['flagged'] == 'drop':
+            dropped |= flagged
+        else:
+            values[i] = np.where(flagged, np.nan, values[i])
+    n_flagged = int(dropped.sum())
+    
+    # Rows without a time, or without any value other than their position, are not written:
+    position_cols = [spec['latitude'], spec['longitude']]
+    has_data = np.zeros(len(field_crz_df), dtype=bool)
+    for field,field_values in zip(fields, values):
+        if field['column'] not in position_cols:
+            has_data |= ~np.isnan(field_values)
+    empty = ~dropped & (np.isnat(times) | ~has_data)
+    keep = np.flatnonzero(~dropped & ~empty)
+    
+    file_name = spec['file_name'].format(cruise=crz)
+    fp = os.path.join(ofile_dir, file_name)
+    if len(keep) == 0:
+        # A cruise left without rows gets no file, and an earlier file of it is removed:
+        if os.path.exists(fp):
+            os.remove(fp)
+        return 0, len(field_crz_df), n_flagged, int(empty.sum()), ''
+    
+    order = keep[np.argsort(times[keep], kind='stable')]
+    times = times[order]
+    values = [field_values[order] for field_values in values]
+    
+    # All rows are formatted at once, as a block of bytes per field:
+    decimals = [field.get('decimals', 0 if pd.api.types.is_integer_dtype(field_crz_df[field['column']]) else 6) for field in fields]
+    blocks = [formatDates(times), formatTimes(times)] + [formatNumbers(field_values, n, spec['missing']) for field_values,n in zip(values, decimals)]
+    
+    positions = {field['column']:(field_values, n) for field,field_values,n in zip(fields, values, decimals)}
+    qc_flagged = any(field['column'] + '_qc' in field_crz_df.columns for field in fields)
+    header = seabassHeader(crz, file_name, spec, fields, times, positions.get(spec['latitude']), positions.get(spec['longitude']), qc_flagged)
+    
+    # Written to a temporary file first, so that an interrupted export never leaves a partial file behind:
+    with open(fp + '.tmp', 'wb') as handle:
+        handle.write(header.encode())
+        handle.write(joinRows(blocks))
+    os.replace(fp + '.tmp', fp)
+    
+    return len(order), len(field_crz_df), n_flagged, int(empty.sum()), file_name
+
+def seabassHeader(crz, file_name, spec, fields, times, latitude=None, longitude=None, qc_flagged=True):
+    
+    import numpy as np
+    
+    # latitude/longitude: the positions written and their decimals, if they are exported.
+    # qc_flagged: whether the data carry QC flags. Files of data that was never QC flagged get the unflagged data status, and no QC comments.
+    values = {key:str(value) for key,value in spec['header'].items()}
+    if not qc_flagged:
+        values['data_status'] = spec['unflagged_status']
+    values.update({'cruise':crz, 'data_file_name':file_name, 'missing':missingText(spec['missing']), 'delimiter':'comma',
+                   'fields':','.join(['date', 'time'] + [field['field'] for field in fields]), 'units':','.join(['yyyymmdd', 'hh:mm:ss'] + [field['units'] for field in fields])})
+    
+    start, end = np.datetime_as_string(times[[0, -1]], unit='s')
+    values.update({'start_date':start[:10].replace('-', ''), 'end_date':end[:10].replace('-', ''), 'start_time':start[11:] + '[GMT]', 'end_time':end[11:] + '[GMT]'})
+    
+    for (north, south),position in [(('north_latitude', 'south_latitude'), latitude), (('east_longitude', 'west_longitude'), longitude)]:
+        if position is None or np.isnan(position[0]).all():
+            continue
+        position_values, decimals = position
+        values[north] = '{:.{}f}[DEG]'.format(np.nanmax(position_values), decimals)
+        values[south] = '{:.{}f}[DEG]'.format(np.nanmin(position_values), decimals)
+    
+    lines = ['/begin_header'] + ['/{}={}'.format(key, values[key]) for key in SEABASS_HEADER if key in values]
+    lines += ['! ' + comment for comment in spec['comments'] + (spec['qc_comments'] if qc_flagged else [])] + ['/end_header']
+    return '\n'.join(lines) + '\n'
+
+def missingText(missing):
+    
+    return str(int(missing)) if float(missing).is_integer() else str(missing)
+
+def digitMatrix(values, width):
+    
+    import numpy as np
+    
+    # ASCII digits of non-negative integers, zero-padded to width: one row of width bytes per value.
+    digits = np.empty((len(values), width), dtype=np.uint8)
+    values = np.array(values, dtype=np.int64)
+    for k in range(width - 1, -1, -1):
+        digits[:, k] = ord('0') + values % 10
+        values //= 10
+    return digits
+
+def formatNumbers(values, decimals, missing=-999):
+    
+    import numpy as np
+    
+    # Numbers as fixed-point text with the given decimals, one row of bytes per value, right-aligned and left-padded with PAD. Missing values are written as missing.
+    # The digits of all values are computed at once from the values scaled to integers, instead of formatting each value as a string.
+    missing_text = np.frombuffer(missingText(missing).encode(), dtype=np.uint8)
+    nan = np.isnan(values)
+    scaled = np.rint(np.abs(np.where(nan, 0, values))*10.0**decimals)
+    if len(scaled) > 0 and scaled.max() >= 1e18:
+        raise ValueError('Values up to {} do not fit in fixed-point text with {} decimals.'.format(np.nanmax(np.abs(values)), decimals))
+    scaled = scaled.astype(np.int64)
+    
+    # Number of digits of every value, with at least one digit before the decimal point:
+    n_digits = np.maximum(1 + np.searchsorted(10**np.arange(1, 19, dtype=np.int64), scaled, side='right'), decimals + 1)
+    width = max(int(n_digits.max()) if len(values) > 0 else 1, decimals + 1)
+    digits = digitMatrix(scaled, width)
+    digits[np.arange(width) < (width - n_digits)[:, None]] = PAD
+    
+    sign = np.where((values < 0) & (scaled > 0), ord('-'), PAD).astype(np.uint8)[:, None]
+    parts = [sign, digits[:, :width - decimals]]
+    if decimals > 0:
+        parts += [np.full((len(values), 1), ord('.'), dtype=np.uint8), digits[:, width - decimals:]]
+    text = np.hstack(parts)
+    
+    # Missing values, right-aligned in a column at least as wide as the fill value:
+    if text.shape[1] < len(missing_text):
+        text = np.hstack([np.full((len(values), len(missing_text) - text.shape[1]), PAD, dtype=np.uint8), text])
+    text[nan] = PAD
+    text[np.ix_(nan, np.arange(text.shape[1] - len(missing_text), text.shape[1]))] = missing_text
+    
+    return text
+
+def formatDates(times):
+    
+    import numpy as np
+    
+    # yyyymmdd of datetime64 values:
+    years = times.astype('datetime64[Y]')
+    months = times.astype('datetime64[M]')
+    dates = (years.astype(np.int64) + 1970)*10000 + ((months - years).astype(np.int64) + 1)*100 + (times.astype('datetime64[D]') - months).astype(np.int64) + 1
+    return digitMatrix(dates, 8)
+
+def formatTimes(times):
+    
+    import numpy as np
+    
+    # hh:mm:ss of datetime64 values:
+    seconds = (times - times.astype('datetime64[D]')).astype('timedelta64[s]').astype(np.int64)
+    colon = np.full((len(times), 1), ord(':'), dtype=np.uint8)
+    return np.hstack([digitMatrix(seconds//3600, 2), colon, digitMatrix(seconds//60 % 60, 2), colon, digitMatrix(seconds % 60, 2)])
+
+def joinRows(blocks):
+    
+    import numpy as np
+    
+    # Join the formatted fields of every row with commas, end every row with a newline, and drop the padding:
+    n_rows = len(blocks[0])
+    comma = np.full((n_rows, 1), ord(','), dtype=np.uint8)
+    newline = np.full((n_rows, 1), ord('\n'), dtype=np.uint8)
+    parts = [part for block in blocks for part in [block, comma]][:-1] + [newline]
+    text = np.hstack(parts).ravel()
+    
+    return text[text != PAD].tobytes()
+
+if __name__ == "__main__": main()
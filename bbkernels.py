@@ -0,0 +1,125 @@
+### Array kernels for the bb calculations of 02b, 03b and 03c. ###
+# The kernels work on NumPy arrays holding any number of cruises at once. Cruises are given by their group boundaries: the start position of each cruise in the arrays (groupStarts), whose rows must be contiguous.
+# No kernel reads across a boundary: the row after the last row of a cruise, or before its first row, is missing (NaN).
+# Every kernel returns a new array by default, in the dtype numpy arithmetic gives the inputs (so float32 inputs stay float32).
+#   dtype=np.float32 --> the inputs are cast and the kernel is computed in single precision
+#   out=array        --> the result is written into an existing array and returned, e.g. out=values to work in place
+
+def groupStarts(codes):
+    
+    import numpy as np
+    
+    # Start position of every group, from the group code of every row (e.g. cruise codes of rows grouped by cruise):
+    codes = np.asarray(codes)
+    if len(codes) == 0:
+        return np.array([], dtype=np.intp)
+    return np.flatnonzero(np.append(True, codes[1:] != codes[:-1]))
+
+def firstRows(starts, n_rows):
+    
+    import numpy as np
+    
+    first = np.zeros(n_rows, dtype=bool)
+    first[starts] = True
+    return first
+
+def lastRows(starts, n_rows):
+    
+    import numpy as np
+    
+    last = np.zeros(n_rows, dtype=bool)
+    last[np.append(starts[1:] - 1, n_rows - 1)[:len(starts)]] = True
+    return last
+
+def nextRow(values, starts, out=None, dtype=None):
+    
+    import numpy as np
+    
+    # Value of the next row of the same group. The last row of every group gets NaN. Used to shift the bb data up one timestamp (03b).
+    values = asArray(values, dtype)
+    result = out if out is not None else np.empty(len(values), dtype=np.result_type(values.dtype, np.nan))
+    result[:-1] = values[1:]
+    result[lastRows(starts, len(values))] = np.nan
+    return result
+
+def previousRow(values, starts, out=None, dtype=None):
+    
+    import numpy as np
+    
+    # Value of the previous row of the same group. The first row of every group gets NaN. Used for bbacid[i-1] (03c).
+    values = asArray(values, dtype)
+    result = out if out is not None else np.empty(len(values), dtype=np.result_type(values.dtype, np.nan))
+    result[1:] = values[:-1]
+    result[firstRows(starts, len(values))] = np.nan
+    return result
+
+def cycleDuration(times, starts, out=None, dtype=None):
+    
+    import numpy as np
+    
+    # Seconds from each timestamp to the next one of the same group. The last row of every group, and rows next to a missing time, get NaN.
+    times = np.asarray(times)
+    result = out if out is not None else np.empty(len(times), dtype=dtype or np.float64)
+    result[:-1] = (times[1:] - times[:-1])/np.timedelta64(1, 's')
+    result[lastRows(starts, len(times))] = np.nan
+    return result
+
+def acidAverage(acid, starts, previous=None, out=None, dtype=None):
+    
+    import numpy as np
+    
+    # Average of each bbacid reading and the previous reading of the same group: (acid[i] + acid[i-1])/2. NaN for the first row of every group.
+    # previous: bbacid[i-1], if already computed with previousRow.
+    acid = asArray(acid, dtype)
+    previous = asArray(previous, dtype) if previous is not None else previousRow(acid, starts)
+    result = np.add(acid, previous, out=out)
+    return np.divide(result, 2, out=result)
+
+def acidAverageError(err, starts, previous=None, out=None, dtype=None):
+    
+    import numpy as np
+    
+    # Propagated standard error of acidAverage: sqrt(err[i]^2 + err[i-1]^2)/2. NaN for the first row of every group.
+    # previous: err[i-1], if already computed with previousRow.
+    err = asArray(err, dtype)
+    previous = asArray(previous, dtype) if previous is not None else previousRow(err, starts)
+    result = quadratureSum(err, previous, out=out)
+    return np.divide(result, 2, out=result)
+
+def quadratureSum(err1, err2, out=None, dtype=None):
+    
+    import numpy as np
+    
+    # Propagated standard error of a sum or difference of two independent values, e.g. bbprime = bbtot - bbacidAvg: sqrt(err1^2 + err2^2).
+    err1 = asArray(err1, dtype)
+    err2 = asArray(err2, dtype)
+    result = np.add(err1**2, err2**2, out=out)
+    return np.sqrt(result, out=result)
+
+def standardError(std, nsamples, out=None, dtype=None):
+    
+    import numpy as np
+    
+    # Standard error of a mean from the standard deviation of its nsamples readings: std/sqrt(nsamples).
+    std = asArray(std, dtype)
+    nsamples = asArray(nsamples, dtype)
+    return np.divide(std, np.sqrt(nsamples), out=out)
+
+def asArray(values, dtype=None):
+    
+    import numpy as np
+    
+    # NumPy array of a Series or array, without a copy unless it has to be cast. Nullable columns (e.g. Int64) give floats, with NaN for missing values.
+    if not isinstance(getattr(values, 'dtype', np.dtype(float)), np.dtype):
+        values = values.to_numpy(dtype=float, na_value=np.nan)
+    values = np.asarray(values)
+    return values if dtype is None else values.astype(dtype, copy=False)
+
+def columnRows(column, positions):
+    
+    import numpy as np
+    
+    # Rows of a table column at the given positions, in the column's own dtype (e.g. categorical cruise names stay categorical). Used to gather each column once when a table is rebuilt from arrays.
+    if isinstance(column.dtype, np.dtype):
+        return column.to_numpy()[positions]
+    return column.array.take(positions)
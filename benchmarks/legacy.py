@@ -0,0 +1,279 @@
+### Reference implementations of 03b, 03c and 04b, as they were before the per-cruise loops were vectorized. ###
+# These are kept only so that the benchmarks can time the old code paths and check that the fast paths still give the same output.
+# The logic is unchanged, apart from the pandas 3 fix for assigning timestamps with .loc[:, col] in 04b,
+# and the AMT surface match, which loops over the samples with the time window and distance radius that 04b now uses instead of the nearest-time-then-0.01-degree rule.
+
+def legacyShiftBBData(uw, cycleDict, cruisename, datetime, numsamples):
+    
+    import pandas as pd
+    import numpy as np
+    
+    uw = uw.copy()
+    
+    ### Insert a Cycle Duration Column. ###
+    crz_list = uw[cruisename].unique()
+    uw[datetime] = pd.to_datetime(uw[datetime])
+    insert_idx = uw.columns.get_loc(numsamples) + 1
+    
+    crz_dfs = []
+    for crz in crz_list:
+        crz_df = uw.loc[uw[cruisename]==crz]
+        crz_df = crz_df.sort_values(datetime)
+        
+        cycle = []
+        for i in range(len(crz_df) - 1):
+            cycle.append((crz_df[datetime].iloc[i+1] - crz_df[datetime].iloc[i]).total_seconds())
+        cycle.append(pd.NaT)
+        
+        crz_df.insert(insert_idx, 'cycle_duration[s]', cycle)
+        crz_dfs.append(crz_df)
+    
+    cycle_df = pd.concat(crz_dfs)
+    
+    ### Separate GNATS/EN616 From AMT System Cruises: ###
+    gnats_df = cycle_df.loc[(cycle_df[cruisename].str[0]=='s')|(cycle_df[cruisename]=='en616')]
+    amt_df = cycle_df.loc[(cycle_df[cruisename].str[0]!='s')&(cycle_df[cruisename]!='en616')]
+    
+    ### Create a Cycle Duration Flag Column ###
+    cycle_flag_idx = cycle_df.columns.get_loc('cycle_duration[s]') + 1
+    
+    if len(gnats_df) > 0:
+        gmin_cycle = cycleDict['gnats'][0]
+        gmax_cycle = cycleDict['gnats'][1]
+        
+        if 'cycle_duration_flag' not in gnats_df.columns:
+            gnats_df.insert(cycle_flag_idx, 'cycle_duration_flag', 0)
+        gnats_df.loc[gnats_df['cycle_duration[s]'] < gmin_cycle, 'cycle_duration_flag'] = 1
+        gnats_df.loc[gnats_df['cycle_duration[s]'] > gmax_cycle, 'cycle_duration_flag'] = 2
+        gnats_df.loc[gnats_df['cycle_duration[s]'].isnull()==True, 'cycle_duration_flag'] = 3
+    
+    flagged_gnats_df = gnats_df.copy()
+    
+    if len(amt_df) > 0:
+        
+        amt_nsample_dfs = []
+        amt_nsamples = [20, 30, 40, 45, 50, 60, 65, 70, 75, 80, 85, 90, 100]
+        for ns,key in zip(amt_nsamples, cycleDict.keys()):
+            nsample_df = amt_df.loc[amt_df[numsamples]==ns]
+            nsmin_cycle = cycleDict[key][0]
+            nsmax_cycle = cycleDict[key][1]
+            
+            if 'cycle_duration_flag' not in nsample_df.columns:
+                nsample_df.insert(cycle_flag_idx, 'cycle_duration_flag', 0)
+                nsample_df.loc[nsample_df['cycle_duration[s]'] < nsmin_cycle, 'cycle_duration_flag'] = 1
+                nsample_df.loc[nsample_df['cycle_duration[s]'] > nsmax_cycle, 'cycle_duration_flag'] = 2
+                nsample_df.loc[nsample_df['cycle_duration[s]'].isnull()==True, 'cycle_duration_flag'] = 3
+            
+            amt_nsample_dfs.append(nsample_df)
+        
+        for ns in [10, 25, 120]:
+            nsample_df = amt_df.loc[amt_df[numsamples]==ns]
+            nsample_df.loc[:, 'cycle_duration_flag'] = 4
+            amt_nsample_dfs.append(nsample_df)
+        
+        flagged_amt_df = pd.concat(amt_nsample_dfs)
+    else:
+        flagged_amt_df = amt_df.copy()
+    
+    ### Shift the bb data up one timestamp ###
+    flagged_uw_df = pd.concat([flagged_gnats_df, flagged_amt_df])
+    bbcols = [col for col in flagged_uw_df.columns if ('bb' in col)&('470' not in col)&('676' not in col)]
+    
+    shifted_bb_dfs = []
+    for crz in crz_list:
+        crz_df = flagged_uw_df.loc[flagged_uw_df[cruisename]==crz]
+        crz_df = crz_df.sort_values(datetime)
+        crz_df[bbcols] = crz_df[bbcols].shift(periods=-1)
+        shifted_bb_dfs.append(crz_df)
+    
+    shifted_uw_df = pd.concat(shifted_bb_dfs)
+    shifted_uw_df.loc[shifted_uw_df['cycle_duration_flag']!=0, bbcols] = np.nan
+    
+    return shifted_uw_df
+
+def legacyAverageBBData(uw, cruisename, numsamples, bbtot, bbtot_std, bbacid, bbacid_std, bbprime, bbprime_std):
+    
+    import pandas as pd
+    import numpy as np
+    
+    uw = uw.copy()
+    crz_list = uw[cruisename].unique()
+    
+    if 'bbtot532StErr' not in uw.columns:
+        idx = uw.columns.get_loc(bbtot) + 1
+        uw.insert(idx, 'bbtot532StErr', uw[bbtot_std]/np.sqrt(uw[numsamples]))
+    if 'bbacidStErr' not in uw.columns:
+        idx = uw.columns.get_loc(bbacid) + 1
+        uw.insert(idx, 'bbacidStErr', uw[bbacid_std]/np.sqrt(uw[numsamples]))
+    if 'bbprimeStErr' not in uw.columns:
+        idx = uw.columns.get_loc(bbprime) + 1
+        uw.insert(idx, 'bbprimeStErr', uw[bbprime_std]/np.sqrt(uw[numsamples]))
+    
+    ### Designate bbacid[i] and bbacid[i-1]: ###
+    bbcols = [col for col in uw.columns if 'bb' in col]
+    insert_idx = uw.columns.get_loc(bbcols[-1]) + 1
+    
+    uw.rename(columns={bbacid:'bbacid[i]', 'bbacidStErr':'bbacidStErr[i]'}, inplace=True)
+    previous_acid_cols = ['bbacid[i-1]', 'bbacidStErr[i-1]']
+    
+    shifted_acid_dfs = []
+    for crz in crz_list:
+        crz_df = uw.loc[uw[cruisename]==crz]
+        crz_df.insert(insert_idx, 'bbacid[i-1]', crz_df['bbacid[i]'])
+        crz_df.insert(insert_idx + 1, 'bbacidStErr[i-1]', crz_df['bbacidStErr[i]'])
+        crz_df[previous_acid_cols] = crz_df[previous_acid_cols].shift(periods=1)
+        shifted_acid_dfs.append(crz_df)
+    
+    acid_shifted_df = pd.concat(shifted_acid_dfs)
+    
+    ### Propagate error on bbacid average and bbprime average ###
+    if 'bbacidAvg' not in acid_shifted_df.columns:
+        
+        insert_idx = acid_shifted_df.columns.get_loc('bbacidStErr[i-1]') + 1
+        
+        bba_avg = acid_shifted_df[['bbacid[i]', 'bbacid[i-1]']].mean(axis=1, skipna=False)
+        bba_avg_err = np.sqrt(acid_shifted_df['bbacidStErr[i]']**2 + acid_shifted_df['bbacidStErr[i-1]']**2)/2
+        
+        acid_shifted_df.insert(insert_idx, 'bbacidAvg', bba_avg)
+        acid_shifted_df.insert(insert_idx + 1, 'bbacidAvgStErr', bba_avg_err)
+    
+    if 'bbprimeAvg' not in acid_shifted_df.columns:
+        
+        insert_idx = acid_shifted_df.columns.get_loc('bbprimeStErr') + 1
+        
+        bbp_avg = acid_shifted_df[bbtot] - acid_shifted_df['bbacidAvg']
+        bbp_avg_err = np.sqrt(acid_shifted_df['bbtot532StErr']**2 + acid_shifted_df['bbacidAvgStErr']**2)
+        
+        acid_shifted_df.insert(insert_idx, 'bbprimeAvg', bbp_avg)
+        acid_shifted_df.insert(insert_idx + 1, 'bbprimeAvgStErr', bbp_avg_err)
+    
+    return acid_shifted_df
+
+def legacyMergeFieldData(uw, d, uw_id, d_id, uw_cruisename, d_cruisename, uw_time, d_time, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, amt_time_window='6h', amt_radius=1.11):
+    
+    import pandas as pd
+    import numpy as np
+    
+    uw = uw.copy()
+    d = d.copy()
+    uw[uw_time] = pd.to_datetime(uw[uw_time])
+    d[d_time] = pd.to_datetime(d[d_time])
+    
+    uw_cruises = [crz for crz in uw[uw_cruisename].unique()]
+    d_cruises = [crz for crz in d[d_cruisename].unique()]
+    crz_list = np.unique(uw_cruises + d_cruises)
+    
+    gnats_crz = [crz for crz in crz_list if crz[0]=='s']
+    amt_crz = [crz for crz in crz_list if crz not in gnats_crz]
+    
+    merged_cruise_dfs = []
+    for crz in gnats_crz:
+        uw_crz_df = uw.loc[uw[uw_cruisename]==crz]
+        d_crz_df = d.loc[d[d_cruisename]==crz]
+        merged_cruise_dfs.append(legacyMergeGnats(uw_crz_df, d_crz_df, uw_time, d_time, uw_cruisename, d_cruisename))
+    
+    for crz in amt_crz:
+        merged_cruise_dfs.append(legacyMergeAMT(uw.loc[uw[uw_cruisename]==crz], d.loc[d[d_cruisename]==crz], uw_id, d_id, uw_time, d_time, uw_cruisename, d_cruisename, uw_longitude, d_longitude, uw_latitude, d_latitude, d_shallowest, d_depth, amt_time_window, amt_radius))
+    
+    field = pd.concat(merged_cruise_dfs)
+    field.sort_values(by=['yyyy-mm-ddThh:mm:ss', uw_time], inplace=True, ignore_index=True)
+    
+    field[d_latitude] = field[d_latitude].fillna(field[uw_latitude])
+    field[d_longitude] = field[d_longitude].fillna(field[uw_longitude])
+    
+    data_ids = [crz + '_' + str(uwid).split(sep='.')[0] if np.isnan(uwid)==False else crz + '_' + str(did).split(sep='.')[0] for crz,uwid,did in zip(field['CruiseName'],field[uw_id],field[d_id])]
+    field.insert(0,'ID',data_ids)
+    
+    return field
+
+def legacyMergeGnats(uw_crz_df, d_crz_df, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col):
+    
+    import pandas as pd
+    
+    crz = uw_crz_df[uw_cruisename_col].unique()[0]
+    
+    uw_crz_df = uw_crz_df.drop(columns = uw_cruisename_col)
+    d_crz_df = d_crz_df.drop(columns = d_cruisename_col)
+    
+    uw_crz_df[uw_time_col] = pd.to_datetime(uw_crz_df[uw_time_col])
+    d_crz_df[d_time_col] = pd.to_datetime(d_crz_df[d_time_col])
+    
+    uw_crz_df['yyyy-mm-ddThh:mm:ss'] = uw_crz_df[uw_time_col]
+    d_crz_df.insert(1, 'yyyy-mm-ddThh:mm:ss', d_crz_df[d_time_col])
+    
+    uw_nearest_idx = []
+    d_nearest_idx = []
+    
+    # One scan of the whole cruise's underway times for every discrete sample:
+    for idx in d_crz_df.index:
+        
+        delta_dts = abs(uw_crz_df[uw_time_col] - d_crz_df[d_time_col].loc[idx])
+        
+        if len(delta_dts.loc[delta_dts <= pd.Timedelta('5min')]) > 0:
+            uw_idx = delta_dts.loc[delta_dts <= pd.Timedelta('5min')].idxmin()
+            uw_nearest_idx.append(uw_idx)
+            d_nearest_idx.append(idx)
+    
+    uw_nearest = uw_crz_df.loc[uw_crz_df.index.isin(uw_nearest_idx)]
+    d_nearest = d_crz_df.loc[d_crz_df.index.isin(d_nearest_idx)]
+    
+    uw_unmatched = uw_crz_df.loc[~uw_crz_df.index.isin(uw_nearest_idx)]
+    d_unmatched = d_crz_df.loc[~d_crz_df.index.isin(d_nearest_idx)]
+    
+    nearest_merge = pd.merge_asof(d_nearest, uw_nearest, on='yyyy-mm-ddThh:mm:ss', direction='nearest', allow_exact_matches=True)
+    unmatched_merge = pd.merge(d_unmatched, uw_unmatched, how='outer', on='yyyy-mm-ddThh:mm:ss')
+    
+    gnats_field = pd.concat([nearest_merge, unmatched_merge])
+    gnats_field.sort_values(['yyyy-mm-ddThh:mm:ss'], inplace=True, ignore_index=True)
+    
+    gnats_field.insert(0, 'CruiseName', crz)
+    
+    return gnats_field
+
+def legacyMergeAMT(uw_crz_df, d_crz_df, uw_id_col, d_id_col, uw_time_col, d_time_col, uw_cruisename_col, d_cruisename_col, uw_longitude_col, d_longitude_col, uw_latitude_col, d_latitude_col, d_shallowest_col, d_depth_col, time_window='6h', radius=1.11):
+    
+    import pandas as pd
+    import numpy as np
+    
+    crz = uw_crz_df[uw_cruisename_col].unique()[0]
+    
+    uw_crz_df = uw_crz_df.drop(columns = uw_cruisename_col)
+    d_crz_df = d_crz_df.drop(columns = d_cruisename_col)
+    
+    uw_crz_df[uw_time_col] = pd.to_datetime(uw_crz_df[uw_time_col])
+    d_crz_df[d_time_col] = pd.to_datetime(d_crz_df[d_time_col])
+    
+    uw_crz_df['yyyy-mm-ddThh:mm:ss'] = uw_crz_df[uw_time_col]
+    d_crz_df.insert(1, 'yyyy-mm-ddThh:mm:ss', d_crz_df[d_time_col])
+    
+    surf = d_crz_df.loc[(d_crz_df[d_shallowest_col]==1)&(d_crz_df[d_depth_col]<=10)]
+    depth = d_crz_df.loc[~d_crz_df.index.isin(surf.index)]
+    
+    # One scan of the whole cruise's underway records for every surface sample:
+    surf_rows = []
+    uw_rows = []
+    for idx in surf.index:
+        
+        delta_dts = abs(uw_crz_df[uw_time_col] - surf[d_time_col].loc[idx])
+        lat1, lon1 = np.radians(surf[d_latitude_col].loc[idx]), np.radians(surf[d_longitude_col].loc[idx])
+        lat2, lon2 = np.radians(uw_crz_df[uw_latitude_col]), np.radians(uw_crz_df[uw_longitude_col])
+        distances = 2*6371.0088*np.arcsin(np.sqrt(np.minimum(np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2, 1)))
+        
+        candidates = pd.DataFrame({'dt':delta_dts, 'distance':distances}).loc[(delta_dts <= pd.Timedelta(time_window)) & (distances <= radius)]
+        if len(candidates) > 0:
+            surf_rows.append(idx)
+            uw_rows.append(candidates.sort_values(['dt', 'distance'], kind='stable').index[0])
+    
+    surf_merge = pd.merge(surf.loc[surf_rows].reset_index(drop=True), uw_crz_df.loc[uw_rows].drop(columns='yyyy-mm-ddThh:mm:ss').reset_index(drop=True), left_index=True, right_index=True)
+    
+    uw_unmatched = uw_crz_df.loc[~uw_crz_df[uw_id_col].isin(surf_merge[uw_id_col])]
+    d_unmatched = d_crz_df.loc[~d_crz_df[d_id_col].isin(surf_merge[d_id_col])]
+    
+    unmatched_merge = pd.merge(d_unmatched, uw_unmatched, how='outer', on='yyyy-mm-ddThh:mm:ss')
+    
+    amt_field = pd.concat([surf_merge, unmatched_merge])
+    amt_field.sort_values('yyyy-mm-ddThh:mm:ss', inplace=True, ignore_index=True)
+    
+    amt_field.insert(0, 'CruiseName', crz)
+    
+    return amt_field
@@ -0,0 +1,67 @@
+def main():
+    
+    import argparse
+    import os
+    import sys
+    import pickle
+    
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    
+    import fieldio
+    import synthetic
+    
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='''\
+    Writes synthetic GNATS/AMT underway data, discrete data and bb cycle parameters, for running 03b, 03c, 04b or 05b on inputs of any size.
+    The column names match the PBS submission scripts (UWid, CruiseName, UWTime, StationDataID, StationTime, ...).
+    
+    OUTPUT: The underway file, the discrete file, the bb cycle parameters pickle, and optionally an XBT file.
+    ''')
+    
+    parser.add_argument('--nRows', nargs=1, type=float, required=True, help='''\
+    Number of underway rows.''')
+    
+    parser.add_argument('--rowsPerCruise', nargs=1, type=int, required=False, default=[50000], help='''\
+    Underway rows per synthetic cruise.''')
+    
+    parser.add_argument('--stationsPerDay', nargs=1, type=float, required=False, default=[4], help='''\
+    Average number of discrete stations per day of underway data.''')
+    
+    parser.add_argument('--seed', nargs=1, type=int, required=False, default=[0], help='''\
+    Random seed.''')
+    
+    parser.add_argument('--ofileUnderway', nargs=1, type=str, required=True, help='''\
+    File path to save the underway data to (.csv, .parquet or .feather).''')
+    
+    parser.add_argument('--ofileDiscrete', nargs=1, type=str, required=True, help='''\
+    File path to save the discrete data to (.csv, .parquet or .feather).''')
+    
+    parser.add_argument('--ofileCycleParameters', nargs=1, type=str, required=True, help='''\
+    File path to save the bb cycle parameters pickle to.''')
+    
+    parser.add_argument('--ofileXbt', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path to save XBT casts at the discrete stations to (.csv, .parquet or .feather), for --xbtFile of 04b or 05b.''')
+    
+    args = parser.parse_args()
+    dict_args = vars(args)
+    
+    n_rows = int(dict_args['nRows'][0])
+    rows_per_cruise = dict_args['rowsPerCruise'][0]
+    stations_per_day = dict_args['stationsPerDay'][0]
+    seed = dict_args['seed'][0]
+    ofile_uw = dict_args['ofileUnderway'][0]
+    ofile_d = dict_args['ofileDiscrete'][0]
+    ofile_cycle = dict_args['ofileCycleParameters'][0]
+    ofile_xbt = dict_args['ofileXbt'][0]
+    
+    uw = synthetic.syntheticUnderway(n_rows, rows_per_cruise, seed=seed)
+    d = synthetic.syntheticDiscrete(uw, stations_per_day=stations_per_day, seed=seed)
+    
+    fieldio.writeTable(uw, ofile_uw)
+    fieldio.writeTable(d, ofile_d)
+    with open(ofile_cycle, 'wb') as handle:
+        pickle.dump(synthetic.syntheticCycleParameters(), handle)
+    if ofile_xbt is not None:
+        fieldio.writeTable(synthetic.syntheticXbt(d, seed=seed), ofile_xbt)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,383 @@
+def main():
+    
+    import argparse
+    import os
+    import sys
+    
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    
+    import pandas as pd
+    import fieldio
+    import synthetic
+    
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='''\
+    Times and memory-profiles 03b, 03c, 04b and the single-process pipeline (05b) on synthetic GNATS/AMT data of increasing size.
+    Before timing, the fast paths are checked against the legacy per-cruise loop implementations (benchmarks/legacy.py) for equivalent output.
+    Each measurement runs in its own forked process; peak memory is the growth in resident memory of that process during the stage (worker processes are not included).
+    
+    OUTPUT: A table of stage, implementation, size, workers, seconds, rows per second and peak memory, printed and optionally saved to --ofile.
+    ''')
+    
+    parser.add_argument('--sizes', nargs='+', type=float, required=False, default=[1e4, 1e5, 1e6, 1e7], help='''\
+    Numbers of underway rows to benchmark. Sizes below --rowsPerCruise give a single cruise.''')
+    
+    parser.add_argument('--rowsPerCruise', nargs=1, type=int, required=False, default=[50000], help='''\
+    Underway rows per synthetic cruise.''')
+    
+    parser.add_argument('--stages', nargs='+', type=str, required=False, default=['03b', '03c', '04b', '05b'], help='''\
+    Stages to benchmark: any of 03b, 03c, 04b, 05b.''')
+    
+    parser.add_argument('--workers', nargs='+', type=int, required=False, default=[1], help='''\
+    Worker counts to benchmark each stage with, e.g. --workers 1 8 32.''')
+    
+    parser.add_argument('--legacyMaxRows', nargs=1, type=float, required=False, default=[1e5], help='''\
+    Also time the legacy implementations, up to this many underway rows. The legacy GNATS merge scales with underway rows times discrete samples.''')
+    
+    parser.add_argument('--checkRows', nargs=1, type=float, required=False, default=[2e4], help='''\
+    Number of underway rows for the equivalence checks. Set to 0 to skip the checks.''')
+    
+    parser.add_argument('--seed', nargs=1, type=int, required=False, default=[0], help='''\
+    Random seed of the synthetic data.''')
+    
+    parser.add_argument('--ofile', nargs=1, type=str, required=False, default=[None], help='''\
+    Optional. File path to save the results table to (.csv, .parquet or .feather).''')
+    
+    args = parser.parse_args()
+    dict_args = vars(args)
+    
+    sizes = [int(size) for size in dict_args['sizes']]
+    rows_per_cruise = dict_args['rowsPerCruise'][0]
+    stages = dict_args['stages']
+    workers_list = dict_args['workers']
+    legacy_max_rows = int(dict_args['legacyMaxRows'][0])
+    check_rows = int(dict_args['checkRows'][0])
+    seed = dict_args['seed'][0]
+    ofile = dict_args['ofile'][0]
+    
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('Unknown stage: {}. Must be one of: {}.'.format(stage, ', '.join(STAGES)))
+    
+    cycleDict = synthetic.syntheticCycleParameters()
+    
+    ### Equivalence Checks: ###
+    
+    if check_rows > 0:
+        print('Checking fast paths against the legacy implementations on {} underway rows:'.format(check_rows))
+        failed = 0
+        for check,message in checkEquivalence(check_rows, min(rows_per_cruise, max(check_rows//4, 1)), cycleDict, seed):
+            print('    {:<40} {}'.format(check, message))
+            failed += message != 'ok'
+        if failed > 0:
+            print('{} checks failed; timings below are for code that does not match the legacy output.'.format(failed))
+    
+    ### Timings: ###
+    
+    results = []
+    for size in sizes:
+        
+        uw = synthetic.syntheticUnderway(size, rows_per_cruise, seed=seed)
+        d = synthetic.syntheticDiscrete(uw, seed=seed)
+        inputs = stageInputs(uw, d, cycleDict, stages)
+        n_cruises = uw[COLS['uw_cruisename']].nunique()
+        
+        for stage in stages:
+            impls = [('fast', workers) for workers in workers_list]
+            if size <= legacy_max_rows:
+                impls.append(('legacy', 1))
+            for impl,workers in impls:
+                seconds, peak_bytes = measure(STAGES[stage][impl], inputs[stage], cycleDict, workers)
+                results.append({'stage':stage, 'implementation':impl, 'underway_rows':size, 'discrete_rows':len(d), 'cruises':n_cruises, 'workers':workers,
+                                'seconds':seconds, 'rows_per_second':size/seconds if seconds > 0 else float('nan'), 'peak_memory_mb':peak_bytes/1e6})
+                print('{stage:>4} {implementation:<7} rows={underway_rows:<10} cruises={cruises:<5} workers={workers:<3} {seconds:10.3f} s {rows_per_second:14.0f} rows/s {peak_memory_mb:10.1f} MB'.format(**results[-1]))
+        
+        del uw, d, inputs
+    
+    results = pd.DataFrame(results)
+    if ofile is not None:
+        fieldio.writeTable(results, ofile)
+
+#########################################################################
+
+# Column names of the synthetic data, in the layout of the pipeline's column dictionary:
+COLS = {'uw_id':'UWid', 'd_id':'StationDataID',
+        'uw_cruisename':'CruiseName', 'd_cruisename':'CruiseName',
+        'uw_time':'UWTime', 'd_time':'StationTime',
+        'uw_longitude':'UWLongitude', 'd_longitude':'Longitude',
+        'uw_latitude':'UWLatitude', 'd_latitude':'Latitude',
+        'd_shallowest':'Shallowest', 'd_depth':'Depth',
+        'numsamples':'numSamples',
+        'bbtot':'bbtot532', 'bbtot_std':'bbtot532Std',
+        'bbacid':'bbacid', 'bbacid_std':'bbacidStd',
+        'bbprime':'bbprime', 'bbprime_std':'bbprimeStd',
+        'time_tolerance':'5min', 'amt_time_window':'6h', 'amt_radius':1.11,
+        'd_station':'StationInfoID', 'xbt_station':'StationInfoID', 'xbt_depth':'Depth'}
+
+def shiftFast(uw, cycleDict, workers=1):
+    
+    import pandas as pd
+    import fieldparallel
+    
+    shift_stage = fieldparallel.loadStage('03b-shift-bb-data.py')
+    kwargs = dict(cycleDict=cycleDict, cruisename=COLS['uw_cruisename'], datetime=COLS['uw_time'], numsamples=COLS['numsamples'])
+    if workers <= 1:
+        return shift_stage.shiftBBData(uw, **kwargs)
+    
+    crz_pos = fieldparallel.cruisePositions(uw, COLS['uw_cruisename'])
+    return pd.concat(fieldparallel.mapCruises(shift_stage.shiftBBData, (uw,), [(pos,) for pos in crz_pos.values()], workers, **kwargs))
+
+def averageFast(uw, cycleDict, workers=1):
+    
+    import pandas as pd
+    import fieldparallel
+    
+    average_stage = fieldparallel.loadStage('03c-calculate-bbprime-average.py')
+    kwargs = {key:COLS[key] for key in ['numsamples', 'bbtot', 'bbtot_std', 'bbacid', 'bbacid_std', 'bbprime', 'bbprime_std']}
+    kwargs['cruisename'] = COLS['uw_cruisename']
+    if workers <= 1:
+        return average_stage.averageBBData(uw, **kwargs)
+    
+    crz_pos = fieldparallel.cruisePositions(uw, COLS['uw_cruisename'])
+    return pd.concat(fieldparallel.mapCruises(average_stage.averageBBData, (uw,), [(pos,) for pos in crz_pos.values()], workers, **kwargs))
+
+def mergeFast(tables, cycleDict, workers=1):
+    
+    import fieldparallel
+    
+    # tables: (underway, discrete), optionally with XBT data as a third table.
+    merge_stage = fieldparallel.loadStage('04b-merge-field-data.py')
+    uw, d, xbt = tables + (None,)*(3 - len(tables))
+    return merge_stage.mergeFieldData(uw, d, *mergeColumns(), time_tolerance=COLS['time_tolerance'], amt_time_window=COLS['amt_time_window'], amt_radius=COLS['amt_radius'], workers=workers, xbt=xbt, d_station=COLS['d_station'], xbt_station=COLS['xbt_station'], xbt_depth=COLS['xbt_depth'])
+
+def pipelineFast(tables, cycleDict, workers=1):
+    
+    import fieldparallel
+    
+    pipeline = fieldparallel.loadStage('05b-run-field-pipeline.py')
+    uw, d, xbt = tables + (None,)*(3 - len(tables))
+    return pipeline.runFieldPipeline(uw, d, cycleDict, COLS, workers=workers, xbt=xbt)[0]
+
+def shiftLegacy(uw, cycleDict, workers=1):
+    
+    import legacy
+    
+    return legacy.legacyShiftBBData(uw, cycleDict, COLS['uw_cruisename'], COLS['uw_time'], COLS['numsamples'])
+
+def averageLegacy(uw, cycleDict, workers=1):
+    
+    import legacy
+    
+    return legacy.legacyAverageBBData(uw, COLS['uw_cruisename'], COLS['numsamples'], COLS['bbtot'], COLS['bbtot_std'], COLS['bbacid'], COLS['bbacid_std'], COLS['bbprime'], COLS['bbprime_std'])
+
+def mergeLegacy(tables, cycleDict, workers=1):
+    
+    import legacy
+    
+    uw, d = tables
+    return legacy.legacyMergeFieldData(uw, d, *mergeColumns())
+
+def pipelineLegacy(tables, cycleDict, workers=1):
+    
+    uw, d = tables
+    return mergeLegacy((averageLegacy(shiftLegacy(uw, cycleDict), cycleDict), d), cycleDict)
+
+def mergeColumns():
+    
+    return [COLS[key] for key in ['uw_id', 'd_id', 'uw_cruisename', 'd_cruisename', 'uw_time', 'd_time', 'uw_longitude', 'd_longitude', 'uw_latitude', 'd_latitude', 'd_shallowest', 'd_depth']]
+
+STAGES = {'03b':{'fast':shiftFast, 'legacy':shiftLegacy},
+          '03c':{'fast':averageFast, 'legacy':averageLegacy},
+          '04b':{'fast':mergeFast, 'legacy':mergeLegacy},
+          '05b':{'fast':pipelineFast, 'legacy':pipelineLegacy}}
+
+def stageInputs(uw, d, cycleDict, stages):
+    
+    # Every stage gets the output of the stage before it, computed once with the fast path:
+    inputs = {'03b':uw, '05b':(uw, d)}
+    if '03c' in stages or '04b' in stages:
+        inputs['03c'] = shiftFast(uw, cycleDict)
+    if '04b' in stages:
+        inputs['04b'] = (averageFast(inputs['03c'], cycleDict), d)
+    
+    return inputs
+
+def measure(func, table, cycleDict, workers):
+    
+    import multiprocessing
+    import time
+    
+    # Without fork, the stage is measured in this process, with tracemalloc for the peak memory:
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        import tracemalloc
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(table, cycleDict, workers)
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return seconds, peak_bytes
+    
+    # Otherwise in a forked process, which shares the inputs with this one and takes its memory with it when it exits:
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(target=_measureChild, args=(func, table, cycleDict, workers, sender))
+    process.start()
+    seconds, peak_bytes = receiver.recv()
+    process.join()
+    
+    return seconds, peak_bytes
+
+def _measureChild(func, table, cycleDict, workers, sender):
+    
+    import time
+    import fieldprofile
+    
+    start_bytes = fieldprofile.resetPeakMemory()
+    start = time.perf_counter()
+    func(table, cycleDict, workers)
+    seconds = time.perf_counter() - start
+    sender.send((seconds, fieldprofile.peakMemory() - start_bytes))
+
+def checkEquivalence(n_rows, rows_per_cruise, cycleDict, seed):
+    
+    import os
+    import tempfile
+    import pandas as pd
+    import fieldio
+    import fieldparallel
+    import fieldschema
+    import synthetic
+    
+    # Compare every fast path with the legacy implementation on the same synthetic inputs. Yields (check, 'ok' or the first difference found).
+    uw = synthetic.syntheticUnderway(n_rows, rows_per_cruise, seed=seed)
+    d = synthetic.syntheticDiscrete(uw, seed=seed)
+    
+    # The legacy code expects rows in file order, as read from csv:
+    uw = uw.sample(frac=1, random_state=seed).reset_index(drop=True)
+    
+    shifted = shiftLegacy(uw, cycleDict)
+    averaged = averageLegacy(shifted, cycleDict)
+    merged = mergeLegacy((averaged, d), cycleDict)
+    
+    yield '03b shiftBBData', compareTables(shifted, shiftFast(uw, cycleDict))
+    yield '03b shiftBBData, 4 workers', compareTables(shifted, shiftFast(uw, cycleDict, workers=4))
+    yield '03c averageBBData', compareTables(averaged, averageFast(shifted, cycleDict))
+    yield '03c averageBBData, 4 workers', compareTables(averaged, averageFast(shifted, cycleDict, workers=4))
+    yield '04b mergeFieldData', compareTables(merged, mergeFast((averaged, d), cycleDict))
+    yield '04b mergeFieldData, 4 workers', compareTables(merged, mergeFast((averaged, d), cycleDict, workers=4))
+    yield '05b runFieldPipeline', compareTables(merged, pipelineFast((uw, d), cycleDict))
+    yield '05b runFieldPipeline, 4 workers', compareTables(merged, pipelineFast((uw, d), cycleDict, workers=4))
+    
+    # There is no legacy XBT merge; 05b must give the same output as 04b on the 03c output:
+    xbt = synthetic.syntheticXbt(d, seed=seed)
+    merged_xbt = mergeFast((averaged, d, xbt), cycleDict)
+    yield '04b mergeFieldData, XBT', 'ok' if 'XBTTemperature1' in merged_xbt.columns and merged_xbt['XBTTemperature1'].notna().any() else 'FAILED: no XBT records in the merged data'
+    yield '05b runFieldPipeline, XBT', compareTables(merged_xbt, pipelineFast((uw, d, xbt), cycleDict))
+    yield '05b runFieldPipeline, XBT, 4 workers', compareTables(merged_xbt, pipelineFast((uw, d, xbt), cycleDict, workers=4))
+
+    # Compact schema: categorical cruise names and nullable integer IDs:
+    uw_schema = fieldschema.tableSchema(cruisename_cols=[COLS['uw_cruisename']], id_cols=[COLS['uw_id']], datetime_cols=[COLS['uw_time']])
+    d_schema = fieldschema.tableSchema(cruisename_cols=[COLS['d_cruisename']], id_cols=[COLS['d_id']], datetime_cols=[COLS['d_time']])
+    compact_uw = fieldschema.applySchema(uw.copy(), uw_schema)
+    compact_d = fieldschema.applySchema(d.copy(), d_schema)
+    yield '03b shiftBBData, compact schema', compareTables(shifted, shiftFast(compact_uw, cycleDict))
+    yield '05b runFieldPipeline, compact schema', compareTables(merged, pipelineFast((compact_uw, compact_d), cycleDict))
+    
+    # Streaming mode: spill the underway rows by cruise from a file read in small chunks, and shift one cruise at a time:
+    shift_stage = fieldparallel.loadStage('03b-shift-bb-data.py')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for fmt in ['csv', 'parquet']:
+            fp = os.path.join(tmp_dir, 'uw.' + fmt)
+            try:
+                fieldio.writeTable(uw, fp)
+            except ImportError:
+                yield '03b streaming ({})'.format(fmt), 'skipped, pyarrow is not installed'
+                continue
+            spill_dir = os.path.join(tmp_dir, fmt)
+            os.makedirs(spill_dir)
+            spill_fps, dtypes = fieldio.spillByCruise(fp, COLS['uw_cruisename'], spill_dir, max(n_rows//10, 1), datetime_cols=[COLS['uw_time']])
+            streamed = pd.concat([crz_df for _,crz_df in fieldparallel.streamCruises(shift_stage.shiftBBData, spill_fps, dtypes, cycleDict=cycleDict, cruisename=COLS['uw_cruisename'], datetime=COLS['uw_time'], numsamples=COLS['numsamples'])])
+            yield '03b streaming ({})'.format(fmt), compareTables(shifted, streamed)
+        
+        yield 'cache miss after a helper module changes', checkCache(uw, d, cycleDict, tmp_dir)
+        yield 'step peak memory around cruises', checkProfiler(tmp_dir)
+
+def checkCache(uw, d, cycleDict, tmp_dir):
+    
+    import os
+    import shutil
+    import importlib.util
+    import numpy as np
+    import fieldcache
+    import fieldparallel
+    
+    # A rerun is served from the cache, until a helper module the stage depends on changes. The helper is a copy of bbkernels, edited between the runs.
+    pipeline = fieldparallel.loadStage('05b-run-field-pipeline.py')
+    helper_fp = os.path.join(tmp_dir, 'bbkernels_copy.py')
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bbkernels.py'), helper_fp)
+    
+    uw_crz_pos = fieldparallel.cruisePositions(uw, COLS['uw_cruisename'])
+    d_crz_pos = fieldparallel.cruisePositions(d, COLS['d_cruisename'])
+    partitions = [(pos, d_crz_pos.get(crz, np.array([], dtype=int))) for crz,pos in uw_crz_pos.items()]
+    
+    misses = []
+    for edit in [None, None, '\ndef acidAverage(acid, starts, previous=None, out=None, dtype=None):\n    return 0\n']:
+        if edit is not None:
+            with open(helper_fp, 'a') as handle:
+                handle.write(edit)
+        spec = importlib.util.spec_from_file_location('bbkernels_copy', helper_fp)
+        helper = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(helper)
+        cache = fieldcache.openCache(os.path.join(tmp_dir, 'cache'), 'check', modules=[helper])
+        fieldparallel.mapCruises(pipeline.runCruise, (uw, d), partitions, cache=cache, labels=list(uw_crz_pos.keys()), cycleDict=cycleDict, cols=COLS)
+        misses.append(len(cache.misses))
+    
+    if misses != [len(partitions), 0, len(partitions)]:
+        return 'FAILED: cache misses of the first run, the rerun and the run after the helper changed were {}, expected {}'.format(misses, [len(partitions), 0, len(partitions)])
+    return 'ok'
+
+def checkProfiler(tmp_dir):
+    
+    import os
+    import numpy as np
+    import fieldprofile
+    
+    # The peak memory of a step includes what it allocated before the cruises measured inside it, as well as the cruises' own peaks:
+    profiler = fieldprofile.openProfiler(os.path.join(tmp_dir, 'profile.json'), 'check')
+    with fieldprofile.step(profiler, 'step'):
+        start_rss = fieldprofile.procStatus('VmRSS')
+        block = np.ones(int(2e8)//8)
+        del block
+        cruise = fieldprofile.ProfiledCall(len)
+        for _ in range(3):
+            cruise([0])
+    
+    peak = profiler.records[-1]['peak_rss_mb']
+    if peak is None:
+        return 'skipped, peak memory is only measured on Linux'
+    if peak*1e6 < start_rss + 0.9*2e8:
+        return 'FAILED: step peak of {:.0f} MB does not include the {:.0f} MB allocated before its cruises'.format(peak, 2e8/1e6)
+    return 'ok'
+
+def compareTables(expected, result):
+    
+    import pandas as pd
+    
+    # Row order, columns and values must match. Dtypes may differ where the legacy code produced object columns of numbers, e.g. the cycle durations.
+    expected = expected.reset_index(drop=True)
+    result = result.reset_index(drop=True)
+    # Categorical and nullable integer columns are compared by value.
+    for col in expected.columns.intersection(result.columns):
+        if isinstance(result[col].dtype, pd.CategoricalDtype):
+            result[col] = result[col].astype(expected[col].dtype)
+        if expected[col].dtype != result[col].dtype and pd.api.types.is_numeric_dtype(result[col]):
+            expected[col] = pd.to_numeric(expected[col], errors='coerce')
+            result[col] = result[col].astype(float)
+    
+    try:
+        pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+    except AssertionError as error:
+        return 'FAILED: ' + ' '.join(str(error).split())
+    return 'ok'
+
+if __name__ == "__main__": main()
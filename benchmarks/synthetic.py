@@ -0,0 +1,150 @@
+### Synthetic GNATS/AMT inputs for the benchmarks. ###
+# Underway rows follow the bb pH cycle: one row per cycle, with the cycle duration set by the numSamples setting, occasional short (restarted) cycles, and longer gaps when the system was off.
+# GNATS cruises are named s0001, s0002, ... and always use numSamples = 30. AMT cruises are named AMT01, AMT02, ... and change numSamples a few times per cruise, with rare test settings of 10, 25 or 120.
+# Discrete stations sit on the ship track, with several depths per cast, a Shallowest flag on the shallowest bottle, and positions a little off the underway track.
+# XBT casts are dropped at most stations, and carry only the station id, as the XBT files do.
+
+AMT_NSAMPLES = [20, 30, 40, 45, 50, 60, 65, 70, 75, 80, 85, 90, 100]
+TEST_NSAMPLES = [10, 25, 120]
+
+def cycleSeconds(numsamples):
+    
+    # Typical duration of one pH cycle for a numSamples setting:
+    return 2.0*numsamples + 10
+
+def syntheticCycleParameters():
+    
+    # Cycle duration limits in the layout of the bb cycle parameters pickle: the AMT numSamples settings in order, then the GNATS limits.
+    cycleDict = {ns:(1.5*ns + 5, 2.5*ns + 15) for ns in AMT_NSAMPLES}
+    cycleDict['gnats'] = (1.5*30 + 5, 2.5*30 + 15)
+    return cycleDict
+
+def syntheticUnderway(n_rows, rows_per_cruise=50000, gnats_fraction=0.5, seed=0):
+    
+    import numpy as np
+    import pandas as pd
+    
+    rng = np.random.default_rng(seed)
+    
+    # One cruise for small sizes, otherwise as many cruises as needed, alternating GNATS and AMT:
+    n_cruises = max(1, int(np.ceil(n_rows/rows_per_cruise)))
+    crz_rows = np.full(n_cruises, n_rows//n_cruises)
+    crz_rows[:n_rows % n_cruises] += 1
+    is_gnats = np.ceil((np.arange(n_cruises) + 1)*gnats_fraction) > np.ceil(np.arange(n_cruises)*gnats_fraction)
+    
+    crz_dfs = []
+    start = pd.Timestamp('2000-01-01')
+    first_id = 1
+    for i,n in enumerate(crz_rows):
+        
+        crz = 's{:04d}'.format(i+1) if is_gnats[i] else 'AMT{:02d}'.format(i+1)
+        
+        # numSamples: GNATS always 30. AMT changes setting a few times per cruise, with the odd test setting:
+        if is_gnats[i]:
+            numsamples = np.full(n, 30)
+        else:
+            settings = rng.choice(AMT_NSAMPLES, size=4)
+            numsamples = settings[np.minimum((np.arange(n)*4)//max(n, 1), 3)]
+            tests = rng.random(n) < 0.002
+            numsamples[tests] = rng.choice(TEST_NSAMPLES, size=tests.sum())
+        
+        # Cycle durations: normal cycles, restarted (short) cycles, and gaps of minutes to hours:
+        cycle = cycleSeconds(numsamples)*rng.normal(1, 0.05, n)
+        short = rng.random(n) < 0.01
+        cycle[short] = cycle[short]*rng.uniform(0.1, 0.5, short.sum())
+        gaps = rng.random(n) < 0.005
+        cycle[gaps] = rng.exponential(3600, gaps.sum())
+        times = start + pd.to_timedelta(np.round(np.cumsum(cycle)), unit='s')
+        
+        # Ship track: a slowly turning heading at about 10 knots while underway:
+        heading = np.cumsum(rng.normal(0, 0.02, n)) + rng.uniform(0, 2*np.pi)
+        step = 10*0.5144*cycle/111000
+        lat0 = rng.uniform(42, 44) if is_gnats[i] else rng.uniform(-50, 50)
+        lon0 = rng.uniform(-70, -66) if is_gnats[i] else rng.uniform(-40, -10)
+        latitude = lat0 + np.cumsum(step*np.cos(heading))
+        longitude = lon0 + np.cumsum(step*np.sin(heading))
+        
+        # bb values: bbtot and bbacid alternate through the pH cycle, bbprime is what is left after the acid signal.
+        bbtot = rng.lognormal(np.log(0.004), 0.5, n)
+        bbacid = bbtot*rng.uniform(0.2, 0.5, n)
+        crz_dfs.append(pd.DataFrame({
+            'UWid':np.arange(first_id, first_id + n),
+            'CruiseName':crz,
+            'UWTime':times,
+            'UWLatitude':latitude,
+            'UWLongitude':longitude,
+            'numSamples':numsamples,
+            'bbtot532':bbtot,
+            'bbtot532Std':bbtot*rng.uniform(0.02, 0.1, n),
+            'bbacid':bbacid,
+            'bbacidStd':bbacid*rng.uniform(0.02, 0.1, n),
+            'bbprime':bbtot - bbacid,
+            'bbprimeStd':bbtot*rng.uniform(0.02, 0.1, n),
+            'bb470':bbtot*rng.uniform(1.1, 1.3, n),
+            'UWTemperature':rng.normal(15, 5, n),
+            'UWSalinity':rng.normal(34, 1, n),
+        }))
+        
+        first_id += n
+        start = times[-1] + pd.Timedelta(days=int(rng.integers(5, 60)))
+    
+    return pd.concat(crz_dfs, ignore_index=True)
+
+def syntheticDiscrete(uw, stations_per_day=4, depths=(2, 10, 25, 50), seed=0):
+    
+    import numpy as np
+    import pandas as pd
+    
+    rng = np.random.default_rng(seed)
+    
+    # Stations are placed at random underway rows, stations_per_day on average:
+    days = (uw['UWTime'].max() - uw['UWTime'].min()).total_seconds()/86400 if len(uw) > 0 else 0
+    n_stations = max(1, int(days*stations_per_day)) if len(uw) > 0 else 0
+    n_stations = min(n_stations, len(uw))
+    rows = uw.iloc[np.sort(rng.choice(len(uw), size=n_stations, replace=False))]
+    
+    # The bottles of a cast share a station time, some minutes off the nearest underway time, and a position slightly off the underway track.
+    # A few stations are taken far from the track, so that they do not merge.
+    offset = pd.to_timedelta(rng.integers(-400, 400, n_stations), unit='s')
+    off_track = np.where(rng.random(n_stations) < 0.05, 0.1, 0.002)
+    stations = pd.DataFrame({
+        'StationInfoID':np.arange(1, n_stations + 1),
+        'CruiseName':rows['CruiseName'].values,
+        'StationTime':(rows['UWTime'] + offset).values,
+        'Latitude':rows['UWLatitude'].values + rng.normal(0, 1, n_stations)*off_track,
+        'Longitude':rows['UWLongitude'].values + rng.normal(0, 1, n_stations)*off_track,
+    })
+    
+    # One row per bottle; some casts skip their shallowest bottle, so the Shallowest bottle is deeper than 10m:
+    n_depths = len(depths)
+    d = stations.loc[stations.index.repeat(n_depths)].reset_index(drop=True)
+    d.insert(0, 'StationDataID', np.arange(1, len(d) + 1))
+    depth = np.tile(np.asarray(depths, dtype=float), n_stations)
+    deep_cast = np.repeat(rng.random(n_stations) < 0.1, n_depths)
+    depth[deep_cast] = depth[deep_cast] + 15
+    d['Depth'] = depth
+    d['Shallowest'] = np.tile((np.arange(n_depths)==0).astype(int), n_stations)
+    d['Chl'] = rng.lognormal(0, 0.7, len(d))*np.exp(-depth/50)
+    d['POC'] = rng.lognormal(4, 0.5, len(d))
+    
+    return d.sort_values('StationTime', kind='stable', ignore_index=True)
+
+def syntheticXbt(d, max_depth=100, step=2, cast_fraction=0.8, seed=0):
+    
+    import numpy as np
+    import pandas as pd
+    
+    rng = np.random.default_rng(seed)
+    
+    # One cast every step m down to max_depth at most stations, with temperature falling off with depth.
+    # A few casts are from stations without discrete data, so that they cannot be placed in a cruise.
+    stations = d['StationInfoID'].drop_duplicates().to_numpy()
+    stations = stations[rng.random(len(stations)) < cast_fraction]
+    stations = np.concatenate([stations, d['StationInfoID'].max() + 1 + np.arange(max(1, len(stations)//20))])
+    depths = np.arange(step/2, max_depth, step)
+    
+    xbt = pd.DataFrame({'StationInfoID':np.repeat(stations, len(depths)), 'Depth':np.tile(depths, len(stations))})
+    surface = np.repeat(rng.uniform(5, 25, len(stations)), len(depths))
+    xbt['Temperature1'] = surface - 10*(1 - np.exp(-xbt['Depth']/40)) + rng.normal(0, 0.05, len(xbt))
+    
+    return xbt
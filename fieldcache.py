@@ -0,0 +1,130 @@
+### Per-cruise result cache for the workflow stages. ###
+# A stage's result for one cruise is stored under a key built from a content hash of that cruise's input rows, the stage parameters, and the stage code.
+# The stage code is the module of the cached function plus every module its results depend on (other stages and helpers such as bbkernels), given when the cache is opened.
+# When the workflow is rerun, cruises whose rows and parameters have not changed are read back from the cache, and only new or recalibrated cruises are recomputed.
+# The cache directory is kept under a size limit by evicting the least recently used results.
+
+class CruiseCache:
+    
+    def __init__(self, cache_dir, stage, max_gb=None, modules=()):
+        
+        import os
+        
+        self.stage = stage
+        self.modules = list(modules)
+        self.code_hashes = {}
+        self.cache_dir = os.path.join(cache_dir, stage)
+        self.max_bytes = None if max_gb is None else int(max_gb * 1e9)
+        self.hits = []
+        self.misses = []
+        self.evicted = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+    
+    def key(self, tables, func, params):
+        
+        import hashlib
+        import pickle
+        import pandas as pd
+        
+        sha = hashlib.sha256()
+        
+        # The stage code, so that results are recomputed after the stage itself, or any module it depends on, changes:
+        sha.update(self.codeHash(func))
+        
+        # The stage parameters, e.g. the bb cycle limits or merge tolerances:
+        sha.update(pickle.dumps(params, protocol=4))
+        
+        # The cruise's input rows, including column names and dtypes, but not the row index:
+        for table in tables:
+            sha.update(repr([(col, str(dtype)) for col,dtype in table.dtypes.items()]).encode())
+            sha.update(pd.util.hash_pandas_object(table, index=False).values.tobytes())
+        
+        return sha.hexdigest()
+    
+    def codeHash(self, func):
+        
+        import hashlib
+        import inspect
+        
+        # Hash of the sources of the function's module and of the modules the stage depends on. Sources are read once per cache.
+        module = inspect.getmodule(func)
+        name = getattr(module, '__name__', func.__qualname__)
+        if name not in self.code_hashes:
+            sha = hashlib.sha256()
+            for module in [module] + self.modules:
+                try:
+                    sha.update(inspect.getsource(module).encode())
+                except (TypeError, OSError):
+                    sha.update(getattr(module, '__name__', func.__qualname__).encode())
+            self.code_hashes[name] = sha.digest()
+        
+        return self.code_hashes[name]
+    
+    def get(self, key, crz=None):
+        
+        import os
+        import pickle
+        
+        fp = os.path.join(self.cache_dir, key + '.pkl')
+        try:
+            with open(fp, 'rb') as handle:
+                result = pickle.load(handle)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses.append(crz)
+            return None
+        
+        # Mark the result as recently used:
+        os.utime(fp)
+        self.hits.append(crz)
+        return result
+    
+    def put(self, key, result):
+        
+        import os
+        import pickle
+        
+        # Write to a temporary file first, so that an interrupted run never leaves a partial result behind:
+        fp = os.path.join(self.cache_dir, key + '.pkl')
+        with open(fp + '.tmp', 'wb') as handle:
+            pickle.dump(result, handle, protocol=4)
+        os.replace(fp + '.tmp', fp)
+    
+    def evict(self):
+        
+        import os
+        
+        if self.max_bytes is None:
+            return []
+        
+        # Remove the least recently used results until the cache fits within its size limit:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        
+        total = sum(size for _,size,_ in entries)
+        evicted = []
+        for _,size,fp in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(fp)
+            total -= size
+            evicted.append(fp)
+        
+        self.evicted += len(evicted)
+        return evicted
+    
+    def report(self):
+        
+        recomputed = ', '.join(str(crz) for crz in self.misses)
+        return '{} cache: {} hits, {} misses, {} evicted. Recomputed cruises: {}'.format(self.stage, len(self.hits), len(self.misses), self.evicted, recomputed if recomputed else 'none')
+
+def openCache(cache_dir, stage, max_gb=None, modules=()):
+    
+    # modules: the modules the stage's results depend on besides the module of the cached function, e.g. the stages loaded by 05b and the helpers they call.
+    # Stages run without a cache when no cache directory is given:
+    if cache_dir is None:
+        return None
+    return CruiseCache(cache_dir, stage, max_gb, modules)
@@ -0,0 +1,547 @@
+### Shared reading and writing of workflow tables. ###
+# Every stage reads and writes its tables through these functions, so that intermediates can be either csv or a typed columnar format.
+# The format is chosen by file extension, or forced with the fmt argument:
+#   .csv                 --> csv
+#   .parquet, .pq        --> parquet (requires pyarrow)
+#   .feather, .arrow     --> feather (requires pyarrow)
+# Columnar formats keep timestamps, dtypes and column order, so no text parsing is needed between stages.
+# A path ending in / (or an existing directory) is a cruise-partitioned dataset instead of a single file, see "Cruise-partitioned datasets" below.
+
+TABLE_FORMATS = {'.csv':'csv', '.parquet':'parquet', '.pq':'parquet', '.feather':'feather', '.arrow':'feather'}
+
+def tableFormat(fp, fmt=None):
+    
+    import os
+    
+    if fmt is not None:
+        if fmt not in TABLE_FORMATS.values():
+            raise ValueError('Unknown table format: {}. Must be one of: csv, parquet, feather.'.format(fmt))
+        return fmt
+    
+    ext = os.path.splitext(fp)[1].lower()
+    if ext not in TABLE_FORMATS:
+        raise ValueError('Cannot infer table format from file extension of {}. Use .csv, .parquet or .feather.'.format(fp))
+    return TABLE_FORMATS[ext]
+
+def tableColumns(fp, fmt=None):
+    
+    import pandas as pd
+    
+    # Read only the header/schema of a table (of a dataset: of its first partition):
+    if isDataset(fp):
+        partitions = datasetPartitions(fp, fmt)
+        return tableColumns(next(iter(partitions.values())), datasetFormat(fp, fmt)) if len(partitions) > 0 else []
+    fmt = tableFormat(fp, fmt)
+    if fmt == 'csv':
+        return pd.read_csv(fp, nrows=0).columns.tolist()
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(fp).names
+    else:
+        import pyarrow.feather as feather
+        return feather.read_table(fp, memory_map=True).schema.names
+
+def stageColumns(fp, required, extra=None, match=None, fmt=None):
+    
+    # Decide which columns a stage loads. If extra is None, all columns are loaded.
+    # Otherwise, only the required columns, any extra columns, and columns for which match(column) is True, in file order.
+    if extra is None:
+        return None
+    
+    wanted = set(required) | set(extra)
+    return [col for col in tableColumns(fp, fmt) if (col in wanted) or (match is not None and match(col))]
+
+def readTable(fp, columns=None, datetime_cols=None, fmt=None, schema=None, na_values=None, cruises=None, cruisename=None):
+    
+    import pandas as pd
+    import fieldschema
+    
+    # schema: optional fieldschema.tableSchema, giving compact types to cruise names, IDs, timestamps and measurements.
+    # na_values: optional list of fill values (e.g. -999 in database exports) to read as missing.
+    # cruises: optional list of cruise names or patterns (e.g. AMT2*) to read, out of the cruise name column cruisename. Of a dataset, only the matching partitions are read.
+    if isDataset(fp):
+        return readDataset(fp, columns, datetime_cols, fmt, schema, na_values, cruises)
+    fmt = tableFormat(fp, fmt)
+    
+    if fmt == 'csv':
+        table = pd.read_csv(fp, usecols=columns, dtype=fieldschema.csvDtypes(schema, columns), na_values=na_values)
+    elif fmt == 'parquet':
+        # Only the row groups that can hold the selected cruises are read:
+        filters = None
+        if cruises is not None:
+            filters = [(cruisename, 'in', selectCruises(pd.read_parquet(fp, columns=[cruisename])[cruisename].unique(), cruises))]
+        if filters is not None and len(filters[0][2]) == 0:
+            import pyarrow.parquet as pq
+            table = pq.read_schema(fp).empty_table().to_pandas()
+            table = table[columns] if columns is not None else table
+        else:
+            table = maskValues(pd.read_parquet(fp, columns=columns, filters=filters), na_values)
+    else:
+        table = maskValues(pd.read_feather(fp, columns=columns), na_values)
+    
+    if cruises is not None:
+        table = table.loc[cruiseMask(table[cruisename], cruises)].reset_index(drop=True)
+    
+    # Keep the column order of the file, whatever order the columns were requested in:
+    if columns is not None and fmt != 'csv':
+        file_cols = tableColumns(fp, fmt)
+        table = table[[col for col in file_cols if col in table.columns]]
+    
+    # Timestamps only need to be parsed when they were stored as text:
+    for col in (datetime_cols or []):
+        if col in table.columns:
+            table[col] = fieldschema.parseTimes(table[col])
+    
+    return fieldschema.applySchema(table, schema)
+
+def maskValues(table, na_values):
+    
+    import pandas as pd
+    
+    # Read fill values as missing in numeric columns, as read_csv does with na_values for csv files:
+    if not na_values:
+        return table
+    numeric = [col for col in table.columns if pd.api.types.is_numeric_dtype(table[col]) and not pd.api.types.is_bool_dtype(table[col])]
+    fill = table[numeric].isin(na_values)
+    if fill.values.any():
+        table = table.copy()
+        table[numeric] = table[numeric].mask(fill)
+    return table
+
+def writeTable(table, fp, fmt=None, cruisename=None, cruises=None):
+    
+    # A dataset is written one partition per cruise (of the cruise name column cruisename), leaving the partitions of cruises that do not match cruises as they are:
+    if isDataset(fp):
+        writer = TableWriter(fp, fmt, cruisename, cruises)
+        writer.write(table)
+        writer.close()
+        return
+    
+    fmt = tableFormat(fp, fmt)
+    
+    if fmt == 'csv':
+        table.to_csv(fp, index=False)
+    elif fmt == 'parquet':
+        table.to_parquet(fp, index=False)
+    else:
+        table.reset_index(drop=True).to_feather(fp)
+
+
+### Database sources: ###
+# Tables can also be read straight from the database they are exported from, instead of from a csv export.
+# database is the path of a SQLite file (e.g. a local stand-in of the underway and station tables), or a SQLAlchemy URL for a database server (requires sqlalchemy).
+
+def openDatabase(database):
+    
+    import os
+    
+    if '://' in database:
+        import sqlalchemy
+        return sqlalchemy.create_engine(database)
+    
+    import sqlite3
+    
+    # sqlite3 would silently create an empty database for a mistyped path:
+    if not os.path.exists(database):
+        raise FileNotFoundError('SQLite database not found: {}'.format(database))
+    return sqlite3.connect(database)
+
+def quoteName(name):
+    
+    # Quote a table or column name, keeping schema-qualified table names (e.g. dbo.UWDataTable) as separate parts:
+    return '.'.join('"' + part.replace('"', '""') + '"' for part in name.split('.'))
+
+def sqlColumns(con, table):
+    
+    import pandas as pd
+    
+    return pd.read_sql_query('SELECT * FROM {} WHERE 1=0'.format(quoteName(table)), con).columns.tolist()
+
+def quoteLiteral(value):
+    
+    return "'" + str(value).replace("'", "''") + "'"
+
+def readSql(con, table, columns=None, datetime_cols=None, schema=None, na_values=None, cruises=None, cruisename=None):
+    
+    import pandas as pd
+    
+    return pd.concat(list(iterSql(con, table, None, columns, datetime_cols, schema, na_values, cruises, cruisename)), ignore_index=True)
+
+def iterSql(con, table, chunksize, columns=None, datetime_cols=None, schema=None, na_values=None, cruises=None, cruisename=None):
+    
+    import pandas as pd
+    import fieldschema
+    
+    # Only the requested columns are selected, so dropped columns are never transferred. With chunksize None, the whole table comes as one chunk.
+    query = 'SELECT {} FROM {}'.format('*' if columns is None else ', '.join(quoteName(col) for col in columns), quoteName(table))
+    
+    # Only the rows of the selected cruises are transferred: the cruise names matching the patterns are looked up first, and selected by the query.
+    if cruises is not None:
+        names = pd.read_sql_query('SELECT DISTINCT {0} FROM {1}'.format(quoteName(cruisename), quoteName(table)), con).iloc[:, 0].dropna()
+        names = selectCruises(names, cruises)
+        query += ' WHERE {} IN ({})'.format(quoteName(cruisename), ', '.join(quoteLiteral(name) for name in names)) if len(names) > 0 else ' WHERE 1=0'
+    chunks = pd.read_sql_query(query, con, chunksize=chunksize)
+    if chunksize is None:
+        chunks = [chunks]
+    
+    for chunk in chunks:
+        chunk = maskValues(chunk, na_values)
+        for col in (datetime_cols or []):
+            if col in chunk.columns:
+                chunk[col] = fieldschema.parseTimes(chunk[col])
+        yield fieldschema.applySchema(chunk, schema)
+
+
+### Streaming: ###
+# For underway files larger than memory, a stage reads its input in chunks and spills the rows of every cruise to its own temporary file.
+# Cruises are then read back and processed one at a time, so peak memory is bounded by the largest cruise rather than the whole archive.
+# Spill files hold a sequence of pickled chunks, which keeps dtypes exactly as read.
+
+def iterTable(fp, chunksize, columns=None, datetime_cols=None, fmt=None, schema=None, na_values=None, cruises=None, cruisename=None):
+    
+    import pandas as pd
+    import fieldschema
+    
+    # A dataset is read partition by partition, skipping the partitions of cruises that do not match cruises. Of a single file, the rows of those cruises are dropped from every chunk.
+    if isDataset(fp):
+        for part_fp in datasetPartitions(fp, fmt, cruises).values():
+            yield from iterTable(part_fp, chunksize, columns, datetime_cols, datasetFormat(fp, fmt), schema, na_values)
+        return
+    if cruises is not None:
+        for chunk in iterTable(fp, chunksize, columns, datetime_cols, fmt, schema, na_values):
+            yield chunk.loc[cruiseMask(chunk[cruisename], cruises)]
+        return
+    
+    fmt = tableFormat(fp, fmt)
+    
+    if fmt == 'csv':
+        chunks = pd.read_csv(fp, usecols=columns, chunksize=chunksize, dtype=fieldschema.csvDtypes(schema, columns), na_values=na_values)
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(fp).iter_batches(batch_size=chunksize, columns=columns))
+    else:
+        import pyarrow as pa
+        reader = pa.ipc.open_file(pa.memory_map(fp))
+        chunks = (reader.get_batch(i).to_pandas() for i in range(reader.num_record_batches))
+    
+    file_cols = tableColumns(fp, fmt) if fmt != 'csv' else None
+    for chunk in chunks:
+        # Keep the column order of the file, whatever order the columns were requested in:
+        if file_cols is not None:
+            chunk = chunk[[col for col in file_cols if col in chunk.columns and (columns is None or col in columns)]]
+        if fmt != 'csv':
+            chunk = maskValues(chunk, na_values)
+        for col in (datetime_cols or []):
+            if col in chunk.columns:
+                chunk[col] = fieldschema.parseTimes(chunk[col])
+        yield fieldschema.applySchema(chunk, schema)
+
+def spillByCruise(fp, cruisename, spill_dir, chunksize, columns=None, datetime_cols=None, fmt=None, schema=None, cruises=None):
+    
+    import os
+    
+    # Stream the table in chunks, appending each cruise's rows to its own spill file.
+    # Cruises are returned in order of first appearance, with the dtypes the columns would have had if the whole table were read at once.
+    spill_fps = {}
+    chunk_dtypes = []
+    for chunk in iterTable(fp, chunksize, columns, datetime_cols, fmt, schema, cruises=cruises, cruisename=cruisename):
+        chunk_dtypes.append([(col, chunk[col].dtype, chunk[col].isnull().all()) for col in chunk.columns])
+        for crz,crz_chunk in chunk.groupby(cruisename, sort=False, observed=True):
+            if crz not in spill_fps:
+                spill_fps[crz] = os.path.join(spill_dir, 'cruise{:05d}.pkl'.format(len(spill_fps)))
+            writeSpill(crz_chunk, spill_fps[crz])
+    
+    return spill_fps, commonDtypes(chunk_dtypes)
+
+def commonDtypes(chunk_dtypes):
+    
+    import numpy as np
+    import pandas as pd
+    
+    # chunk_dtypes: for every chunk, a list of (column, dtype, column is all null) entries.
+    # Numeric and datetime columns take the dtype that can hold every chunk, e.g. float64 for an int column with nulls in one chunk.
+    # Categorical columns take the union of the chunks' categories, in order of first appearance.
+    # Other columns take the dtype of their non-null chunks, or object if those disagree.
+    dtypes = {}
+    for col in dict.fromkeys(col for entries in chunk_dtypes for col,_,_ in entries):
+        entries = [(dtype, all_null) for chunk in chunk_dtypes for c,dtype,all_null in chunk if c == col]
+        all_dtypes = [dtype for dtype,_ in entries]
+        filled_dtypes = list(dict.fromkeys(dtype for dtype,all_null in entries if not all_null))
+        if all(isinstance(dtype, np.dtype) and dtype.kind in 'iufMm' for dtype in all_dtypes):
+            try:
+                dtypes[col] = np.result_type(*all_dtypes)
+                continue
+            except TypeError:
+                pass
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in all_dtypes):
+            dtypes[col] = pd.CategoricalDtype(pd.Index([cat for dtype in all_dtypes for cat in dtype.categories]).unique())
+            continue
+        if len(filled_dtypes) == 0:
+            dtypes[col] = all_dtypes[0]
+        elif len(filled_dtypes) == 1:
+            dtypes[col] = filled_dtypes[0]
+        else:
+            dtypes[col] = np.dtype(object)
+    
+    return dtypes
+
+def spillTable(table, fp, chunksize):
+    
+    # Spill a table in chunks, returning the (column, dtype, column is all null) entries used by commonDtypes:
+    for start in range(0, len(table), chunksize):
+        writeSpill(table.iloc[start:start + chunksize], fp)
+    
+    return [(col, table[col].dtype, table[col].isnull().all()) for col in table.columns]
+
+def writeSpill(table, fp):
+    
+    import pickle
+    
+    with open(fp, 'ab') as handle:
+        pickle.dump(table, handle, protocol=4)
+
+def iterSpill(fp, dtypes=None):
+    
+    import pickle
+    
+    with open(fp, 'rb') as handle:
+        while True:
+            try:
+                chunk = pickle.load(handle)
+            except EOFError:
+                return
+            yield castDtypes(chunk, dtypes)
+
+def readSpill(fp, dtypes=None):
+    
+    import pandas as pd
+    
+    return pd.concat(list(iterSpill(fp, dtypes)))
+
+def castDtypes(table, dtypes):
+    
+    if dtypes is None:
+        return table
+    
+    changed = {col:dtype for col,dtype in dtypes.items() if col in table.columns and table[col].dtype != dtype}
+    return table.astype(changed) if changed else table
+
+def mergeSortedSpills(spill_fps, by, dtypes=None):
+    
+    import numpy as np
+    import pandas as pd
+    
+    # Merge spill files that are each sorted by the timestamp column `by` into one stream of chunks in global `by` order.
+    # Every chunk holds all rows that share its timestamps, and rows keep the order of spill_fps for equal timestamps.
+    # Rows with null timestamps come out in the last chunk.
+    nat = np.iinfo('int64').min
+    never = np.iinfo('int64').max
+    
+    def keys(chunk):
+        return chunk[by].values.astype('datetime64[ns]').view('int64')
+    
+    def lastKey(chunk):
+        chunk_keys = keys(chunk)
+        chunk_keys = chunk_keys[chunk_keys != nat]
+        return chunk_keys.max() if len(chunk_keys) > 0 else never
+    
+    streams = [iterSpill(fp, dtypes) for fp in spill_fps]
+    buffers = [None]*len(streams)
+    exhausted = [False]*len(streams)
+    
+    def refill(i):
+        chunk = next(streams[i], None)
+        if chunk is None:
+            exhausted[i] = True
+        else:
+            buffers[i] = chunk if buffers[i] is None else pd.concat([buffers[i], chunk])
+    
+    while True:
+        
+        for i in range(len(streams)):
+            while not exhausted[i] and (buffers[i] is None or len(buffers[i]) == 0):
+                refill(i)
+        
+        open_streams = [i for i in range(len(streams)) if not exhausted[i]]
+        if len(open_streams) == 0:
+            break
+        
+        # Future rows of a stream can not be earlier than the last timestamp in its buffer, so everything before the smallest of these is final:
+        frontier = min(lastKey(buffers[i]) for i in open_streams)
+        if frontier == never:
+            # The open streams only hold null timestamps, which all go in the last chunk:
+            for i in open_streams:
+                while not exhausted[i]:
+                    refill(i)
+            break
+        
+        emit = []
+        for i,chunk in enumerate(buffers):
+            if chunk is None:
+                continue
+            chunk_keys = keys(chunk)
+            final = (chunk_keys < frontier) & (chunk_keys != nat)
+            emit.append(chunk.loc[final])
+            buffers[i] = chunk.loc[~final]
+        
+        emit = [chunk for chunk in emit if len(chunk) > 0]
+        if len(emit) > 0:
+            yield pd.concat(emit)
+        
+        # Streams holding only the frontier timestamp move on to their next chunk:
+        for i in open_streams:
+            if lastKey(buffers[i]) == frontier:
+                refill(i)
+    
+    remaining = [chunk for chunk in buffers if chunk is not None and len(chunk) > 0]
+    if len(remaining) > 0:
+        yield pd.concat(remaining)
+
+class TableWriter:
+    
+    # Writes a table piece by piece, e.g. one cruise at a time, to a csv, parquet, or feather file.
+    # To a dataset, every piece is split by cruise into the cruises' partitions. The partitions are written to temporary files and only replace the old ones on close,
+    # when the old partitions of cruises that match cruises (all cruises, if it is None) but were not written are removed.
+    
+    def __init__(self, fp, fmt=None, cruisename=None, cruises=None):
+        
+        self.fp = fp
+        self.dataset = isDataset(fp)
+        self.writer = None
+        self.schema = None
+        if self.dataset:
+            if cruisename is None:
+                raise ValueError('Writing the dataset {} needs the name of the cruise name column to partition by.'.format(fp))
+            self.fmt = datasetFormat(fp, fmt)
+            self.cruisename = cruisename
+            self.cruises = cruises
+            self.partitions = {}
+        else:
+            self.fmt = tableFormat(fp, fmt)
+    
+    def write(self, table):
+        
+        if self.dataset:
+            import os
+            for crz,crz_table in table.groupby(self.cruisename, sort=False, observed=True):
+                if crz not in self.partitions:
+                    os.makedirs(self.fp, exist_ok=True)
+                    self.partitions[crz] = TableWriter(partitionPath(self.fp, crz, self.fmt) + '.tmp', self.fmt)
+                self.partitions[crz].write(crz_table)
+            return
+        
+        if self.fmt == 'csv':
+            table.to_csv(self.fp, index=False, mode='w' if self.writer is None else 'a', header=self.writer is None)
+            self.writer = True
+            return
+        
+        import pyarrow as pa
+        
+        if self.writer is None:
+            self.schema = pa.Schema.from_pandas(table, preserve_index=False)
+            if self.fmt == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.fp, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.fp, self.schema)
+        
+        self.writer.write_table(pa.Table.from_pandas(table, schema=self.schema, preserve_index=False))
+    
+    def close(self):
+        
+        if self.dataset:
+            import os
+            os.makedirs(self.fp, exist_ok=True)
+            for crz,part_fp in datasetPartitions(self.fp, self.fmt, self.cruises).items():
+                if crz not in self.partitions:
+                    os.remove(part_fp)
+            for writer in self.partitions.values():
+                writer.close()
+                os.replace(writer.fp, writer.fp[:-len('.tmp')])
+            return
+        
+        if self.writer is not None and self.fmt != 'csv':
+            self.writer.close()
+
+
+### Cruise-partitioned datasets: ###
+# A dataset is a directory holding one table per cruise, named after the cruise (e.g. 03b-shifted.parquet/AMT28.parquet), with the same columns as a single-file table.
+# Reprocessing a few cruises (--cruises) then reads only their partitions, and replaces only their partitions, leaving the other cruises' outputs as they are.
+# Partitions are in the format given by fmt, or else by the directory name's extension, or else by the partitions already in the directory (csv for a new, plain directory).
+# Read as one table, the partitions are concatenated in order of cruise name.
+
+def isDataset(fp):
+    
+    import os
+    
+    return fp.endswith('/') or fp.endswith(os.sep) or os.path.isdir(fp)
+
+def datasetFormat(fp, fmt=None):
+    
+    import os
+    
+    if fmt is not None:
+        return tableFormat(fp, fmt)
+    ext = os.path.splitext(fp.rstrip('/' + os.sep))[1].lower()
+    if ext in TABLE_FORMATS:
+        return TABLE_FORMATS[ext]
+    if os.path.isdir(fp):
+        for name in sorted(os.listdir(fp)):
+            if os.path.splitext(name)[1].lower() in TABLE_FORMATS:
+                return TABLE_FORMATS[os.path.splitext(name)[1].lower()]
+    return 'csv'
+
+def partitionPath(fp, crz, fmt):
+    
+    import os
+    import urllib.parse
+    
+    # Cruise names are quoted, so that any name makes a valid file name:
+    ext = {'csv':'.csv', 'parquet':'.parquet', 'feather':'.feather'}[fmt]
+    return os.path.join(fp, urllib.parse.quote(str(crz), safe='') + ext)
+
+def datasetPartitions(fp, fmt=None, cruises=None):
+    
+    import os
+    import urllib.parse
+    
+    # The partition files of a dataset, by cruise name, in order of cruise name. With cruises, only the partitions of matching cruises.
+    if not os.path.isdir(fp):
+        return {}
+    fmt = datasetFormat(fp, fmt)
+    partitions = {}
+    for name in sorted(os.listdir(fp)):
+        stem, ext = os.path.splitext(name)
+        if TABLE_FORMATS.get(ext.lower()) == fmt:
+            partitions[urllib.parse.unquote(stem)] = os.path.join(fp, name)
+    
+    return {crz:partitions[crz] for crz in selectCruises(list(partitions), cruises)}
+
+def readDataset(fp, columns=None, datetime_cols=None, fmt=None, schema=None, na_values=None, cruises=None):
+    
+    import pandas as pd
+    import fieldschema
+    
+    partitions = datasetPartitions(fp, fmt, cruises)
+    tables = [readTable(part_fp, columns, datetime_cols, datasetFormat(fp, fmt), schema, na_values) for part_fp in partitions.values()]
+    if len(tables) == 0:
+        return pd.DataFrame(columns=columns if columns is not None else tableColumns(fp, fmt))
+    
+    # Categorical columns (cruise names) have different categories in every partition, so are combined again after concatenating:
+    return fieldschema.applySchema(pd.concat(tables, ignore_index=True), schema)
+
+def selectCruises(names, cruises=None):
+    
+    import fnmatch
+    
+    # The names that equal, or match the shell-style pattern of, any of cruises (all names if cruises is None):
+    if cruises is None:
+        return list(names)
+    return [name for name in names if any(fnmatch.fnmatchcase(str(name), pattern) for pattern in cruises)]
+
+def cruiseMask(values, cruises):
+    
+    import pandas as pd
+    
+    names = pd.unique(values.dropna())
+    return values.isin(selectCruises(names, cruises))
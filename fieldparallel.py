@@ -0,0 +1,139 @@
+### Per-cruise parallelism for the workflow stages. ###
+# Cruises are independent in every stage, so a stage can hand its cruises to a pool of worker processes.
+# The full tables are never pickled: workers are forked after the tables are set aside here, and each task only carries the row positions of its cruise.
+# Each worker slices its own cruise out of the inherited tables, and results come back in the order the cruises were given.
+
+_TABLES = ()
+
+def loadStage(script):
+    
+    import os
+    import sys
+    import importlib.util
+    
+    # The stage scripts are named with hyphens, so they are loaded from their file path (in the repository directory) rather than imported by name.
+    # Registering them in sys.modules lets their functions be found again by name, e.g. when pickled for the pool workers.
+    name = 'stage_' + os.path.splitext(script)[0].replace('-', '_')
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(os.path.dirname(os.path.abspath(__file__)), script))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    
+    return sys.modules[name]
+
+def cruisePositions(table, cruisename):
+    
+    import pandas as pd
+    import numpy as np
+    
+    # Row positions of every cruise, with cruises in order of first appearance. Rows without a cruise name are left out.
+    crz_codes, crz_names = pd.factorize(table[cruisename])
+    order = np.argsort(crz_codes, kind='stable')
+    bounds = np.searchsorted(crz_codes[order], np.arange(len(crz_names) + 1))
+    
+    return {crz:order[bounds[i]:bounds[i+1]] for i,crz in enumerate(crz_names)}
+
+def mapCruises(func, tables, partitions, workers=1, cache=None, labels=None, profiler=None, **kwargs):
+    
+    # tables: tuple of DataFrames shared by all tasks.
+    # partitions: list with one entry per cruise; each entry is a tuple holding the row positions of that cruise in each table.
+    # func is called as func(*cruise_tables, **kwargs) and the results are returned in the order of partitions.
+    # cache: optional fieldcache.CruiseCache. Cruises found in it are not recomputed; labels name the cruises in its report.
+    # profiler: optional fieldprofile.Profiler. Each computed cruise is measured in the process that runs it, and recorded under its label.
+    labels = labels if labels is not None else list(range(len(partitions)))
+    if cache is None:
+        return _mapProfiled(func, tables, partitions, workers, kwargs, profiler, labels)
+    
+    keys = [cache.key([table.iloc[pos] for table,pos in zip(tables, positions)], func, kwargs) for positions in partitions]
+    results = [cache.get(key, crz) for key,crz in zip(keys, labels)]
+    if profiler is not None:
+        for crz,result in zip(labels, results):
+            if result is not None:
+                profiler.addCruise(func.__name__, crz, {}, cached=True)
+    
+    # Only compute the cruises that were not in the cache:
+    missing = [i for i,result in enumerate(results) if result is None]
+    computed = _mapProfiled(func, tables, [partitions[i] for i in missing], workers, kwargs, profiler, [labels[i] for i in missing])
+    for i,result in zip(missing, computed):
+        cache.put(keys[i], result)
+        results[i] = result
+    cache.evict()
+    
+    return results
+
+def _mapProfiled(func, tables, partitions, workers, kwargs, profiler, labels):
+    
+    if profiler is None:
+        return _mapPartitions(func, tables, partitions, workers, kwargs)
+    
+    import fieldprofile
+    
+    results = []
+    for crz,(result,metrics) in zip(labels, _mapPartitions(fieldprofile.ProfiledCall(func), tables, partitions, workers, kwargs)):
+        profiler.addCruise(func.__name__, crz, metrics)
+        results.append(result)
+    return results
+
+def _mapPartitions(func, tables, partitions, workers, kwargs):
+    
+    global _TABLES
+    
+    if workers <= 1 or len(partitions) <= 1:
+        return [func(*[table.iloc[pos] for table,pos in zip(tables, positions)], **kwargs) for positions in partitions]
+    
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    
+    n_workers = min(workers, len(partitions))
+    
+    # Without fork (e.g. on Windows), each task has to carry its own cruise tables instead.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        cruise_tables = [tuple(table.iloc[pos] for table,pos in zip(tables, positions)) for positions in partitions]
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            return list(pool.map(_runTables, [func]*len(partitions), cruise_tables, [kwargs]*len(partitions)))
+    
+    _TABLES = tables
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            return list(pool.map(_runPartition, [func]*len(partitions), partitions, [kwargs]*len(partitions)))
+    finally:
+        _TABLES = ()
+
+def _runPartition(func, positions, kwargs):
+    
+    return func(*[table.iloc[pos] for table,pos in zip(_TABLES, positions)], **kwargs)
+
+def _runTables(func, cruise_tables, kwargs):
+    
+    return func(*cruise_tables, **kwargs)
+
+def streamCruises(func, spill_fps, dtypes, workers=1, cache=None, crz_list=None, tables=(), table_positions=(), profiler=None, **kwargs):
+    
+    import pandas as pd
+    import numpy as np
+    import fieldio
+    
+    # Streaming counterpart of mapCruises: the cruises' underway rows come from spill files (see fieldio.spillByCruise), and are read back only when their cruise is processed.
+    # At most `workers` cruises are held in memory at once. Results are yielded as (cruise, result), in the order of crz_list (by default, the order of spill_fps).
+    # tables/table_positions: other, smaller tables held in memory (e.g. discrete data), and the row positions of each cruise in them.
+    # Cruises in crz_list without a spill file get an empty underway table.
+    crz_list = list(spill_fps.keys()) if crz_list is None else list(crz_list)
+    no_rows = np.array([], dtype=int)
+    empty_uw = pd.DataFrame({col:pd.Series(dtype=dtype) for col,dtype in dtypes.items()})
+    
+    batch_size = max(workers, 1)
+    for start in range(0, len(crz_list), batch_size):
+        
+        batch = crz_list[start:start + batch_size]
+        crz_dfs = [fieldio.readSpill(spill_fps[crz], dtypes) if crz in spill_fps else empty_uw for crz in batch]
+        offsets = np.cumsum([0] + [len(crz_df) for crz_df in crz_dfs])
+        batch_df = pd.concat(crz_dfs)
+        del crz_dfs
+        
+        partitions = [(np.arange(offsets[i], offsets[i+1]),) + tuple(positions.get(crz, no_rows) for positions in table_positions) for i,crz in enumerate(batch)]
+        results = mapCruises(func, (batch_df,) + tuple(tables), partitions, workers, cache=cache, labels=batch, profiler=profiler, **kwargs)
+        del batch_df
+        
+        for crz,result in zip(batch, results):
+            yield crz, result
@@ -0,0 +1,251 @@
+### Stage and per-cruise profiling for the workflow scripts. ###
+# With --profile, a script records wall time, CPU time, peak resident memory (RSS), rows in and out, and bytes read and written:
+#   - for each step of the stage (e.g. read, process, write), measured in the main process
+#   - for each cruise, measured in whichever process ran it (the main process, or a pool worker)
+# The records are saved to a json or csv metrics file, together with a summary that suggests ncpus and mem values for the PBS directives.
+# Memory and I/O are read from /proc, so they are only recorded on Linux; elsewhere they are left empty.
+
+# Peaks of the measurements still open in this process (e.g. a step, while the cruises inside it are measured), innermost last:
+_OPEN = []
+
+class Profiler:
+    
+    def __init__(self, fp, stage, workers=1):
+        
+        import os
+        import time
+        
+        self.fp = fp
+        self.stage = stage
+        self.workers = workers
+        self.records = []
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        self.start_cpu = processCpu()
+    
+    def addStep(self, step, metrics, extra=None):
+        
+        self.records.append(dict({'kind':'step', 'stage':self.stage, 'step':step, 'cruise':None, 'cached':False}, **metrics, **(extra or {})))
+    
+    def addCruise(self, step, crz, metrics, cached=False):
+        
+        self.records.append(dict({'kind':'cruise', 'stage':self.stage, 'step':step, 'cruise':str(crz), 'cached':cached}, **metrics))
+    
+    def summary(self):
+        
+        import os
+        import math
+        import time
+        
+        steps = [record for record in self.records if record['kind'] == 'step']
+        cruises = [record for record in self.records if record['kind'] == 'cruise' and not record['cached']]
+        
+        wall = time.perf_counter() - self.start
+        main_peak = max([record['peak_rss_mb'] or 0 for record in steps] + [0])
+        cruise_growth = max([record['rss_growth_mb'] or 0 for record in cruises] + [0])
+        
+        # ncpus: more workers stop helping once the work left in the main process (reading, writing, merging), or the longest single cruise, takes longer than each worker's share of the cruises.
+        cruise_wall = sum(record['wall_s'] for record in cruises)
+        longest = max(cruises, key=lambda record: record['wall_s']) if len(cruises) > 0 else None
+        parallel_wall = sum(record['wall_s'] for record in steps if record.get('parallel'))
+        serial_wall = max(wall - parallel_wall, 0)
+        if longest is None or cruise_wall == 0:
+            ncpus = 1
+        else:
+            ncpus = math.ceil(cruise_wall/max(serial_wall, longest['wall_s'], 1e-9))
+            ncpus = max(1, min(ncpus, len(cruises), os.cpu_count() or 1))
+        
+        # mem: the main process at its peak, plus the memory each extra worker allocates for its largest cruise, with 20% headroom.
+        mem_mb = main_peak + (ncpus*cruise_growth if ncpus > 1 else 0)
+        mem_gb = max(1, math.ceil(1.2*mem_mb/1000))
+        
+        return {'kind':'summary', 'stage':self.stage, 'wall_s':wall,
+                'cpu_s':processCpu() - self.start_cpu,
+                'peak_rss_mb':main_peak, 'rss_growth_mb':cruise_growth, 'workers':self.workers,
+                'cruises':len(cruises), 'cached_cruises':sum(1 for record in self.records if record['kind'] == 'cruise' and record['cached']),
+                'longest_cruise':None if longest is None else longest['cruise'], 'longest_cruise_s':None if longest is None else longest['wall_s'],
+                'suggested_ncpus':ncpus, 'suggested_mem_gb':mem_gb, 'pbs':'#PBS -l ncpus={},mem={}gb'.format(ncpus, mem_gb)}
+    
+    def report(self, summary=None):
+        
+        summary = summary if summary is not None else self.summary()
+        lines = ['{} profile: {:.1f} s wall, {:.1f} s CPU, peak RSS {:.0f} MB in the main process, {} cruises computed ({} from cache).'.format(self.stage, summary['wall_s'], summary['cpu_s'], summary['peak_rss_mb'], summary['cruises'], summary['cached_cruises'])]
+        if summary['longest_cruise'] is not None:
+            lines.append('Longest cruise: {} ({:.1f} s). Largest cruise allocation: {:.0f} MB.'.format(summary['longest_cruise'], summary['longest_cruise_s'], summary['rss_growth_mb']))
+        lines.append('Suggested PBS resources (this run used {} workers): {}'.format(summary['workers'], summary['pbs']))
+        return '\n'.join(lines)
+    
+    def save(self):
+        
+        import os
+        import json
+        import pandas as pd
+        import fieldio
+        
+        summary = self.summary()
+        if os.path.splitext(self.fp)[1].lower() == '.json':
+            with open(self.fp, 'w') as handle:
+                json.dump({'summary':summary, 'records':self.records}, handle, indent=1, default=str)
+        else:
+            fieldio.writeTable(pd.DataFrame(self.records + [summary]), self.fp)
+        
+        print(self.report(summary))
+
+def openProfiler(fp, stage, workers=1):
+    
+    # Scripts run without profiling when no metrics file is given:
+    if fp is None:
+        return None
+    return Profiler(fp, stage, workers)
+
+class step:
+    
+    # Context manager measuring one step of a stage in the main process:
+    #   with fieldprofile.step(profiler, 'read') as record:
+    #       uw = fieldio.readTable(...)
+    #       record['rows_out'] = len(uw)
+    # With profiler None, nothing is measured.
+    
+    def __init__(self, profiler, name, parallel=False):
+        
+        self.profiler = profiler
+        self.name = name
+        self.parallel = parallel
+        self.record = {'rows_in':None, 'rows_out':None}
+    
+    def __enter__(self):
+        
+        if self.profiler is not None:
+            self.start = measureStart()
+        return self.record
+    
+    def __exit__(self, *exc):
+        
+        if self.profiler is not None:
+            self.profiler.addStep(self.name, dict(measureEnd(self.start), **self.record), {'parallel':self.parallel})
+        return False
+
+class ProfiledCall:
+    
+    # Wraps a per-cruise function so that it returns (result, metrics). Module-level, so that it can be sent to pool workers.
+    
+    def __init__(self, func):
+        
+        self.func = func
+        self.__name__ = getattr(func, '__name__', 'cruise')
+    
+    def __call__(self, *tables, **kwargs):
+        
+        start = measureStart()
+        result = self.func(*tables, **kwargs)
+        metrics = measureEnd(start)
+        metrics['rows_in'] = sum(len(table) for table in tables)
+        metrics['rows_out'] = resultRows(result)
+        return result, metrics
+
+def processCpu():
+    
+    import time
+    
+    # CPU time of this process and of its finished worker processes (without the resource module, e.g. on Windows, of this process only):
+    try:
+        import resource
+    except ImportError:
+        return time.process_time()
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+
+def resultRows(result):
+    
+    # Rows of a cruise result, or of the first table of a tuple of results (e.g. the merged data of the pipeline):
+    if isinstance(result, tuple):
+        result = result[0]
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+def measureStart():
+    
+    import os
+    import time
+    
+    rss = resetPeakMemory()
+    peak = {'max':0}
+    _OPEN.append(peak)
+    return {'wall':time.perf_counter(), 'cpu':time.process_time(), 'rss':rss, 'peak':peak, 'io':ioCounters(), 'pid':os.getpid()}
+
+def measureEnd(start):
+    
+    import time
+    
+    wall = time.perf_counter() - start['wall']
+    cpu = time.process_time() - start['cpu']
+    peak = max(peakMemory(), start['peak']['max'])
+    io = ioCounters()
+    
+    # The enclosing measurements see this peak too:
+    _OPEN[:] = [entry for entry in _OPEN if entry is not start['peak']]
+    foldPeak(peak)
+    
+    return {'wall_s':wall, 'cpu_s':cpu,
+            'peak_rss_mb':peak/1e6 if peak > 0 else None,
+            'rss_growth_mb':max(peak - start['rss'], 0)/1e6 if peak > 0 else None,
+            'read_bytes':io[0] - start['io'][0] if io is not None and start['io'] is not None else None,
+            'write_bytes':io[1] - start['io'][1] if io is not None and start['io'] is not None else None,
+            'pid':start['pid']}
+
+def resetPeakMemory():
+    
+    # Reset the peak RSS of this process (Linux), and return the current RSS.
+    # The peak before the reset is kept by every measurement still open, so that a step still sees its own peak from before the cruises run inside it.
+    foldPeak(procStatus('VmHWM'))
+    try:
+        with open('/proc/self/clear_refs', 'w') as handle:
+            handle.write('5')
+    except OSError:
+        pass
+    return procStatus('VmRSS')
+
+def foldPeak(peak):
+    
+    for entry in _OPEN:
+        entry['max'] = max(entry['max'], peak)
+
+def peakMemory():
+    
+    import sys
+    
+    peak = procStatus('VmHWM')
+    if peak > 0:
+        return peak
+    
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS:
+    try:
+        import resource
+    except ImportError:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+def procStatus(field):
+    
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return 0
+
+def ioCounters():
+    
+    # Bytes read and written by this process through system calls, including files served from the page cache:
+    try:
+        with open('/proc/self/io') as handle:
+            counters = dict(line.split(':') for line in handle)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
@@ -0,0 +1,71 @@
+### Compact column types for the workflow tables. ###
+# A schema names the cruise name, ID and timestamp columns of a table, and which measurement columns may be stored as float32:
+#   cruise names --> categorical, so each name is stored once and per-cruise grouping works on integer codes
+#   IDs          --> nullable integers (Int64), so IDs stay integers when a merge leaves some of them empty
+#   timestamps   --> datetime64, parsed once when the table is read, with an explicit format if one is given
+#   float32      --> optional; a function of the column name, e.g. lambda col: 'bb' in col. Only float64 columns are converted.
+# Columns named in a schema but missing from a table are skipped, so the same schema can be used with --loadColumns.
+
+def tableSchema(cruisename_cols=(), id_cols=(), datetime_cols=(), float32=None, time_format=None):
+    
+    return {'category':list(cruisename_cols), 'id':list(id_cols), 'datetime':list(datetime_cols), 'float32':float32, 'time_format':time_format}
+
+def csvDtypes(schema, columns=None):
+    
+    # Cruise names are read straight into categoricals, so they never exist as one Python string per row:
+    if schema is None:
+        return None
+    return {col:'category' for col in schema['category'] if columns is None or col in columns}
+
+def applySchema(table, schema):
+    
+    import pandas as pd
+    import numpy as np
+    
+    if schema is None:
+        return table
+    
+    for col in schema['category']:
+        if col in table.columns and not isinstance(table[col].dtype, pd.CategoricalDtype):
+            table[col] = table[col].astype('category')
+    
+    for col in schema['id']:
+        if col in table.columns:
+            table[col] = toIds(table[col])
+    
+    for col in schema['datetime']:
+        if col in table.columns:
+            table[col] = parseTimes(table[col], schema['time_format'])
+    
+    if schema['float32'] is not None:
+        downcast = {col:'float32' for col in table.columns if table[col].dtype == np.float64 and schema['float32'](col)}
+        if downcast:
+            table = table.astype(downcast)
+    
+    return table
+
+def parseTimes(values, time_format=None):
+    
+    import pandas as pd
+    
+    # Timestamps that were already parsed (e.g. read from parquet) are passed through untouched:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, format=time_format)
+
+def toIds(values):
+    
+    import pandas as pd
+    import numpy as np
+    
+    if pd.api.types.is_integer_dtype(values):
+        return values.astype('Int64')
+    
+    # IDs read as floats (e.g. 12.0, because of empty rows) keep their integer part:
+    values = pd.to_numeric(values)
+    return pd.Series(np.trunc(values.to_numpy(dtype=float, na_value=np.nan)), index=values.index, name=values.name).astype('Int64')
+
+def idStrings(values):
+    
+    # IDs as text, e.g. for building the merged field data ID. Missing IDs become 'nan', as str() of a float NaN would.
+    return toIds(values).astype(str).where(values.notna(), 'nan')
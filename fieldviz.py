@@ -0,0 +1,237 @@
+### Downsampled views of the underway tracks, for QC plots of large archives. ###
+# Plotting millions of underway points is slow, so every variable of every cruise is kept as a pyramid of min/max decimations:
+#   level 0 --> every point of the time series (one per timestamp, in time order)
+#   level k --> the minimum and maximum of every run of 2*factor points of level k-1, about n/factor^k points
+# The extremes of every bucket keep spikes and the envelope of the data at every level. A view of a time window reads the finest level that fits its point budget,
+# so zooming from the whole archive down to a single pH cycle only ever reads a few thousand points. Views may also be reduced with LTTB (largest triangle three buckets).
+# Flagged points (a nonzero 06b <variable>_qc flag, or a nonzero value in any of the given flag columns) and discrete matchups (rows of 04b output with a discrete id) are always shown.
+# Works on 03c output (underway rows) and on 04b/06b output (merged rows, in which underway records repeat once per matched discrete sample; each timestamp is taken once).
+# The pyramids are built cruise by cruise, over a process pool with workers, and kept in the per-cruise cache (fieldcache), so unchanged cruises are only built once.
+# Plotting needs matplotlib; the views themselves are plain DataFrames.
+#   viz = fieldviz.openViz('04-merged-field-data.parquet', 'UWTime', ['bbprimeAvg', 'UWTemperature'], id_col='StationDataID', cache_dir='viz-cache')
+#   viz.view('bbprimeAvg', '2019-01-01', '2019-01-02', cruises=['s01*'])
+#   viz.plot('bbprimeAvg')
+
+class FieldViz:
+    
+    def __init__(self, table, time, variables, cruisename='CruiseName', id_col=None, flag_cols=None, factor=4, min_points=500, workers=1, cache_dir=None, cache_max_gb=None):
+        
+        import fieldcache
+        import fieldparallel
+        
+        missing = [col for col in [cruisename, time] + list(variables) if col not in table.columns]
+        if missing:
+            raise ValueError('Columns {} are not in the table'.format(missing))
+        
+        # Flags of a variable: its 06b flag column, if the table has one, and any other flag columns given (e.g. cycle_duration_flag):
+        self.variables = list(variables)
+        self.flags = {variable:[col for col in [variable + '_qc'] + list(flag_cols or []) if col in table.columns] for variable in self.variables}
+        used = list(dict.fromkeys([cruisename, time] + self.variables + [col for cols in self.flags.values() for col in cols] + ([id_col] if id_col in table.columns else [])))
+        
+        cache = fieldcache.openCache(cache_dir, 'fieldviz', cache_max_gb)
+        crz_pos = fieldparallel.cruisePositions(table, cruisename)
+        pyramids = fieldparallel.mapCruises(buildPyramids, (table[used],), [(pos,) for pos in crz_pos.values()], workers, cache=cache, labels=list(crz_pos.keys()),
+                                            time=time, flags=self.flags, id_col=id_col if id_col in table.columns else None, factor=factor, min_points=min_points)
+        self.pyramids = {str(crz):pyramid for crz,pyramid in zip(crz_pos.keys(), pyramids)}
+        self.cache = cache
+    
+    def view(self, variable, start=None, end=None, cruises=None, max_points=2000, method='minmax'):
+        
+        import numpy as np
+        import pandas as pd
+        import fieldio
+        
+        # Downsampled points of variable between start and end (timestamps or strings; None for the start or end of the data), of the cruises matching cruises (names or shell-style patterns).
+        # The point budget is shared by the cruises in proportion to their points in the window. Flagged points and matchups come on top of it.
+        start = np.datetime64(pd.Timestamp(start), 'ns') if start is not None else None
+        end = np.datetime64(pd.Timestamp(end), 'ns') if end is not None else None
+        crz_list = fieldio.selectCruises(self.pyramids.keys(), cruises)
+        windows = {crz:timeWindow(self.pyramids[crz][variable]['time'], start, end) for crz in crz_list}
+        n_window = sum(hi - lo for lo,hi in windows.values())
+        
+        # The points of every cruise are gathered as arrays, and the view is built as one table:
+        names, columns = [], {'time':[], 'value':[], 'flagged':[], 'matchup':[]}
+        for crz in crz_list:
+            pyramid = self.pyramids[crz][variable]
+            lo, hi = windows[crz]
+            if hi <= lo:
+                continue
+            budget = max(2, int(max_points*(hi - lo)/n_window))
+            idx = viewIndices(pyramid, lo, hi, budget, method)
+            names.append((crz, len(idx)))
+            for col in columns:
+                columns[col].append(pyramid[col][idx])
+        
+        view = pd.DataFrame({'CruiseName':pd.Categorical(np.repeat([crz for crz,_ in names], [n for _,n in names]).astype(str), categories=crz_list),
+                             'time':np.concatenate(columns['time']) if names else np.array([], dtype='datetime64[ns]'),
+                             variable:np.concatenate(columns['value']) if names else np.array([], dtype=float),
+                             'flagged':np.concatenate(columns['flagged']) if names else np.array([], dtype=bool),
+                             'matchup':np.concatenate(columns['matchup']) if names else np.array([], dtype=bool)})
+        return view.sort_values('time', kind='stable', ignore_index=True)
+    
+    def plot(self, variable, cruises=None, start=None, end=None, ax=None, max_points=2000, method='minmax'):
+        
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        
+        # Plot the downsampled track of variable, with flagged points (red x) and discrete matchups (black o).
+        # The view is recomputed whenever the x limits change, so zooming and panning read only the points of the new window.
+        if ax is None:
+            _, ax = plt.subplots()
+        
+        def draw(start, end):
+            
+            view = self.view(variable, start, end, cruises, max_points, method)
+            for artist in list(ax.lines) + list(ax.collections):
+                artist.remove()
+            # Cruises are drawn as separate lines, so that no line joins the end of one cruise to the start of the next:
+            for crz,crz_view in view.groupby('CruiseName', sort=False, observed=True):
+                ax.plot(crz_view['time'], crz_view[variable], '-', lw=0.8, color='tab:blue')
+            ax.scatter(view.loc[view['flagged'], 'time'], view.loc[view['flagged'], variable], marker='x', color='tab:red', s=12, zorder=3, label='flagged')
+            ax.scatter(view.loc[view['matchup'], 'time'], view.loc[view['matchup'], variable], marker='o', facecolor='none', edgecolor='k', s=20, zorder=3, label='matchup')
+            ax.set_ylabel(variable)
+            return view
+        
+        def redraw(ax):
+            
+            lo, hi = ax.get_xlim()
+            ax.callbacks.disconnect(ax._fieldviz_cid)
+            draw(mdates.num2date(lo).replace(tzinfo=None), mdates.num2date(hi).replace(tzinfo=None))
+            ax.set_xlim(lo, hi)
+            ax._fieldviz_cid = ax.callbacks.connect('xlim_changed', redraw)
+            ax.figure.canvas.draw_idle()
+        
+        draw(start, end)
+        ax._fieldviz_cid = ax.callbacks.connect('xlim_changed', redraw)
+        return ax
+
+def openViz(fp, time, variables, cruisename='CruiseName', id_col=None, flag_cols=None, fmt=None, cruises=None, time_format=None, **kwargs):
+    
+    import fieldio
+    import fieldschema
+    
+    # FieldViz of a 03c, 04b or 06b output file or dataset, reading only the columns the views need:
+    available = fieldio.tableColumns(fp, fmt)
+    wanted = [cruisename, time, id_col] + list(variables) + [variable + '_qc' for variable in variables] + list(flag_cols or [])
+    columns = [col for col in dict.fromkeys(wanted) if col is not None and col in available]
+    schema = fieldschema.tableSchema(cruisename_cols=[cruisename], datetime_cols=[time], time_format=time_format)
+    table = fieldio.readTable(fp, columns=columns, fmt=fmt, schema=schema, cruises=cruises, cruisename=cruisename)
+    
+    return FieldViz(table, time, variables, cruisename, id_col, flag_cols, **kwargs)
+
+def buildPyramids(table_crz, time, flags, id_col=None, factor=4, min_points=500):
+    
+    import numpy as np
+    import pandas as pd
+    
+    # The pyramid of every variable of one cruise (flags: the flag columns of every variable):
+    times = table_crz[time]
+    times = (times if pd.api.types.is_datetime64_any_dtype(times) else pd.to_datetime(times)).to_numpy().astype('datetime64[ns]')
+    matchup = table_crz[id_col].notna().to_numpy() if id_col is not None else np.zeros(len(table_crz), dtype=bool)
+    
+    pyramids = {}
+    for variable,flag_cols in flags.items():
+        values = table_crz[variable].to_numpy(dtype=float, na_value=np.nan)
+        flagged = np.zeros(len(table_crz), dtype=bool)
+        for col in flag_cols:
+            flagged |= table_crz[col].fillna(0).to_numpy() != 0
+        
+        # The time series: rows with a value and a time, once per timestamp, in time order. A timestamp is flagged, or a matchup, if any of its rows is.
+        has_value = ~np.isnan(values) & ~np.isnat(times)
+        unique_times, first, rows = np.unique(times[has_value], return_index=True, return_inverse=True)
+        rows = rows.reshape(-1)
+        series_flagged = np.bincount(rows, weights=flagged[has_value], minlength=len(unique_times)) > 0
+        series_matchup = np.bincount(rows, weights=matchup[has_value], minlength=len(unique_times)) > 0
+        series_values = values[has_value][first]
+        
+        pyramids[variable] = {'time':unique_times, 'value':series_values, 'flagged':series_flagged, 'matchup':series_matchup,
+                              'levels':minMaxLevels(series_values, factor, min_points)}
+    
+    return pyramids
+
+def minMaxLevels(values, factor=4, min_points=500):
+    
+    import numpy as np
+    
+    # Levels 1, 2, ... of the pyramid, as positions into the series (level 0, every point, is not stored).
+    # Each level is decimated from the one before, whose points include the extremes of every bucket, so every level holds the true extremes of its buckets.
+    levels = []
+    idx = np.arange(len(values))
+    while len(idx) > min_points:
+        idx = minMaxIndices(values, idx, 2*factor)
+        levels.append(idx)
+    
+    return levels
+
+def minMaxIndices(values, idx, bucket):
+    
+    import numpy as np
+    
+    # Of the points at positions idx, keep the minimum and maximum of every run of bucket points, and the first and last point:
+    n_buckets = -(-len(idx)//bucket)
+    pad = n_buckets*bucket - len(idx)
+    bucket_values = values[idx]
+    lows = np.append(bucket_values, np.full(pad, np.inf)).reshape(n_buckets, bucket).argmin(axis=1)
+    highs = np.append(bucket_values, np.full(pad, -np.inf)).reshape(n_buckets, bucket).argmax(axis=1)
+    offsets = np.arange(n_buckets)*bucket
+    keep = np.unique(np.concatenate([offsets + lows, offsets + highs, [0, len(idx) - 1]]))
+    
+    return idx[keep]
+
+def lttbIndices(times, values, idx, n_out):
+    
+    import numpy as np
+    
+    # Largest triangle three buckets: of the points at positions idx, keep the first and last, and from every bucket in between the point that makes the largest triangle
+    # with the point kept from the bucket before and the mean of the bucket after. Keeps the visual shape of the line in n_out points.
+    if len(idx) <= n_out:
+        return idx
+    if n_out < 3:
+        return idx[[0, -1]]
+    x = (times[idx] - times[idx[0]])/np.timedelta64(1, 's')
+    y = values[idx]
+    bounds = np.linspace(1, len(idx) - 1, n_out - 1).astype(int)
+    
+    keep = [0]
+    for i in range(n_out - 2):
+        lo, hi = bounds[i], bounds[i + 1]
+        next_lo, next_hi = hi, bounds[i + 2] if i + 2 < len(bounds) else len(idx)
+        cx, cy = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        ax, ay = x[keep[-1]], y[keep[-1]]
+        areas = np.abs((ax - cx)*(y[lo:hi] - ay) - (ax - x[lo:hi])*(cy - ay))
+        keep.append(lo + int(np.argmax(areas)))
+    keep.append(len(idx) - 1)
+    
+    return idx[np.array(keep)]
+
+def timeWindow(times, start=None, end=None):
+    
+    import numpy as np
+    
+    # Series positions [lo, hi) of the points between start and end:
+    lo = np.searchsorted(times, start, 'left') if start is not None else 0
+    hi = np.searchsorted(times, end, 'right') if end is not None else len(times)
+    return int(lo), int(hi)
+
+def viewIndices(pyramid, lo, hi, max_points, method='minmax'):
+    
+    import numpy as np
+    
+    # Series positions of the view of the window [lo, hi): every point if they fit the budget, else the points of the finest level that fits.
+    # If no level fits, the coarsest level of the window is decimated further. With LTTB, the finest level with at most 8 times the budget is reduced by LTTB instead.
+    idx = np.arange(lo, hi)
+    limit = 8*max_points if method == 'lttb' else max_points
+    for level in pyramid['levels']:
+        if len(idx) <= limit:
+            break
+        idx = level[np.searchsorted(level, lo):np.searchsorted(level, hi)]
+    
+    if method == 'lttb':
+        idx = lttbIndices(pyramid['time'], pyramid['value'], idx, max_points)
+    elif len(idx) > max_points:
+        idx = minMaxIndices(pyramid['value'], idx, max(2, -(-2*len(idx)//max_points)))
+    
+    # Flagged points and matchups are always shown:
+    always = lo + np.flatnonzero(pyramid['flagged'][lo:hi] | pyramid['matchup'][lo:hi])
+    
+    return np.union1d(idx, always)